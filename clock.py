@@ -0,0 +1,177 @@
+#
+# Clocks and timers.
+#
+#  The node server never calls time.sleep() or time.monotonic() for its
+#  own timing (polling, delays between commands, heartbeats, ...), it
+#  asks a clock.  Normally that's the real clock.  Tools and tests can
+#  swap in a VirtualClock so hours of polling and reconnects go by in
+#  seconds.
+#
+#  Waiting on the device itself (socket timeouts, serial pacing) is
+#  real time and doesn't go through here.
+
+from udi_interface import LOGGER
+import heapq
+import itertools
+import threading
+import time
+
+
+'''
+Returned by call_later(), cancel() stops the call if it hasn't
+happened yet.
+'''
+class Timer:
+    def __init__(self, when, fn, args):
+        self.when = when
+        self.fn = fn
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def run(self):
+        if not self.cancelled:
+            self.fn(*self.args)
+
+
+'''
+The real clock.  Timers run on a single scheduler thread, started the
+first time one is needed, that sleeps until the earliest one is due.
+Timer callbacks should be quick, anything slow holds up the timers
+behind it.
+'''
+class Clock:
+    def __init__(self):
+        self.lock = threading.Condition()
+        self.timers = []
+        self.seq = itertools.count()  # keeps the heap stable for equal times
+        self.thread = None
+
+    def time(self):
+        return time.time()
+
+    def monotonic(self):
+        return time.monotonic()
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds)
+
+    def call_later(self, delay, fn, *args):
+        timer = Timer(self.monotonic() + max(0, delay), fn, args)
+        with self.lock:
+            heapq.heappush(self.timers, (timer.when, next(self.seq), timer))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.__scheduler, name='clock')
+                self.thread.daemon = True
+                self.thread.start()
+            self.lock.notify()
+        return timer
+
+    def __scheduler(self):
+        while True:
+            with self.lock:
+                while True:
+                    while self.timers and self.timers[0][2].cancelled:
+                        heapq.heappop(self.timers)
+                    if not self.timers:
+                        self.lock.wait()
+                        continue
+                    wait = self.timers[0][0] - self.monotonic()
+                    if wait <= 0:
+                        timer = heapq.heappop(self.timers)[2]
+                        break
+                    self.lock.wait(wait)
+            try:
+                timer.run()
+            except Exception as e:
+                # Don't let one bad callback stop all the timers
+                LOGGER.error('Timer callback failed: {}'.format(e))
+
+
+'''
+A clock that only moves when something sleeps or advance() is called.
+
+With auto set (the default), sleep() gives up a small slice of real
+time, so threads blocked on sockets get a chance to run, and then moves
+the clock forward to when the sleep would have ended (unless another
+thread already moved it further).  A sleep of an hour takes about a
+millisecond.
+
+With auto off, sleep() blocks until some other thread moves the clock
+past the end of the sleep with advance().
+
+Timers run in the thread that moves the clock past their time.
+'''
+class VirtualClock(Clock):
+    def __init__(self, start=0.0, auto=True, granularity=0.001, epoch=None):
+        super().__init__()
+        self.now = start
+        self.auto = auto
+        self.granularity = granularity
+        self.epoch = time.time() - start if epoch is None else epoch
+        self.sleeps = 0
+        self.slept = 0.0
+
+    def time(self):
+        return self.epoch + self.monotonic()
+
+    def monotonic(self):
+        with self.lock:
+            return self.now
+
+    def sleep(self, seconds):
+        with self.lock:
+            until = self.now + max(0, seconds)
+            self.sleeps += 1
+            self.slept += max(0, seconds)
+
+        if self.auto:
+            time.sleep(self.granularity)
+            self.advance_to(until)
+        else:
+            with self.lock:
+                while self.now < until:
+                    self.lock.wait()
+
+    def advance(self, seconds):
+        with self.lock:
+            until = self.now + seconds
+        self.advance_to(until)
+
+    # Move the clock forward, running any timers due on the way
+    def advance_to(self, until):
+        while True:
+            with self.lock:
+                if self.timers and self.timers[0][0] <= until:
+                    (when, _, timer) = heapq.heappop(self.timers)
+                    self.now = max(self.now, when)
+                else:
+                    timer = None
+                    self.now = max(self.now, until)
+                self.lock.notify_all()
+            if timer is None:
+                return
+            try:
+                timer.run()
+            except Exception as e:
+                LOGGER.error('Timer callback failed: {}'.format(e))
+
+    def call_later(self, delay, fn, *args):
+        with self.lock:
+            timer = Timer(self.now + max(0, delay), fn, args)
+            heapq.heappush(self.timers, (timer.when, next(self.seq), timer))
+        return timer
+
+
+_default = Clock()
+
+# The clock objects use when they aren't given one
+def default():
+    return _default
+
+def set_default(clock):
+    global _default
+    _default = clock
@@ -0,0 +1,194 @@
+#
+# Stream of zone changes and keypad events.
+#
+#  Every value change the node server decodes, and every keypad press,
+#  is published once to BUS and fanned out to whoever is listening on
+#  the HTTP server's /events (Server-Sent Events) or /events.jsonl (one
+#  JSON object per line).
+#
+#    - Each event is numbered and rendered once, however many
+#      subscribers there are.  Publishing never waits on a subscriber.
+#    - Each subscriber has a queue of at most QUEUE_MAX events.  One that
+#      falls that far behind is sent an 'overflow' event and dropped, it
+#      can reconnect and resume from the last event it got.
+#    - The last BACKLOG events are kept so a subscriber can resume from
+#      a sequence number (?since=, or Last-Event-ID for SSE).  When they
+#      aren't all there any more, it's sent a 'reset' event first and
+#      should read /api/state again.
+
+from udi_interface import LOGGER
+import collections
+import json
+import threading
+import urllib.parse
+import clock
+import stateapi
+
+# Keypad keys, by the command the zone node sends the ISY.  The fast
+# on/off ones are sent for the same press as DON/DOF.
+KEYS = {
+        'DON': 'power_on',
+        'DOF': 'power_off',
+        'BRT': 'plus',
+        'DIM': 'minus',
+        'GV12': 'volume_up',
+        'GV13': 'volume_down',
+        'GV14': 'source',
+        'GV15': 'previous',
+        'GV16': 'next',
+        'GV17': 'play',
+        'GV18': 'favorite_1',
+        'GV19': 'favorite_2',
+        }
+
+
+class Event:
+    __slots__ = ('seq', 'type', 'json')
+
+    def __init__(self, seq, type, data):
+        self.seq = seq
+        self.type = type
+        self.json = json.dumps(dict(data, seq=seq, type=type), sort_keys=True, separators=(',', ':'))
+
+    # Event id, has the boot ID so an id from before a restart is noticed
+    @property
+    def id(self):
+        return '{}-{}'.format(stateapi.BOOT, self.seq)
+
+    def sse(self):
+        return 'id: {}\nevent: {}\ndata: {}\n\n'.format(self.id, self.type, self.json)
+
+    def jsonl(self):
+        return self.json + '\n'
+
+
+class Subscriber:
+    def __init__(self, bus, limit):
+        self.bus = bus
+        self.limit = limit
+        self.events = collections.deque()
+        self.ready = threading.Condition(bus.lock)
+        self.overflowed = False
+        self.closed = False
+
+    # Called with the bus lock held
+    def put(self, event):
+        if len(self.events) >= self.limit:
+            self.overflowed = True
+        else:
+            self.events.append(event)
+        self.ready.notify()
+
+    '''
+    Events waiting, waits up to timeout seconds for some.  Returns an
+    empty list on timeout and None once the subscriber has overflowed.
+    '''
+    def get(self, timeout):
+        with self.ready:
+            if not self.events and not self.overflowed:
+                self.ready.wait(timeout)
+            if self.overflowed and not self.events:
+                return None
+            events = list(self.events)
+            self.events.clear()
+            return events
+
+    def close(self):
+        self.bus.unsubscribe(self)
+
+
+class EventBus:
+    BACKLOG = 1000    # events kept for resuming
+    QUEUE_MAX = 500   # events a subscriber can fall behind
+    KEEPALIVE = 15    # seconds, a quiet stream gets a comment this often
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.seq = 0
+        self.backlog = collections.deque(maxlen=self.BACKLOG)
+        self.subscribers = set()
+        self.dropped = 0  # subscribers dropped for falling behind
+
+    def publish(self, type, **data):
+        data['time'] = clock.default().time()
+        with self.lock:
+            self.seq += 1
+            event = Event(self.seq, type, data)
+            self.backlog.append(event)
+            for sub in self.subscribers:
+                if not sub.overflowed:
+                    sub.put(event)
+                    if sub.overflowed:
+                        self.dropped += 1
+        return event
+
+    '''
+    A new subscriber.  With since (a sequence number) it first gets the
+    events after that one, or a 'reset' event if they aren't all kept.
+    '''
+    def subscribe(self, since=None, limit=None):
+        with self.lock:
+            sub = Subscriber(self, limit or self.QUEUE_MAX)
+            if since is not None:
+                first = self.backlog[0].seq if self.backlog else self.seq + 1
+                if since > self.seq or since < first - 1:
+                    sub.events.append(Event(self.seq, 'reset', {'since': since}))
+                else:
+                    sub.events.extend(e for e in self.backlog if e.seq > since)
+            self.subscribers.add(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self.lock:
+            sub.closed = True
+            self.subscribers.discard(sub)
+
+    '''
+    Webserver stream route for /events (SSE) and /events.jsonl.
+    '''
+    def stream(self, request, jsonl=False):
+        since = resume_point(request)
+        LOGGER.debug('Event subscriber {} since {}'.format(request.client, since))
+        return ('application/x-ndjson' if jsonl else 'text/event-stream', self.__frames(since, jsonl))
+
+    # Subscribes when the first frame is asked for, so a stream that's
+    # never sent never subscribes
+    def __frames(self, since, jsonl):
+        sub = self.subscribe(since)
+        last = since
+        try:
+            while True:
+                events = sub.get(self.KEEPALIVE)
+                if events is None:
+                    event = Event(last or 0, 'overflow', {'resume': last})
+                    LOGGER.warning('Event subscriber fell {} events behind, dropped'.format(sub.limit))
+                    yield event.jsonl() if jsonl else event.sse()
+                    return
+                if not events:
+                    yield '\n' if jsonl else ': keepalive\n\n'
+                    continue
+                last = events[-1].seq
+                yield ''.join(e.jsonl() if jsonl else e.sse() for e in events)
+        finally:
+            sub.close()
+
+
+'''
+The sequence number a request wants to resume after, from ?since= or
+the Last-Event-ID header.  None if it has neither, -1 (start over with
+a reset) for an id from before a restart.
+'''
+def resume_point(request):
+    since = urllib.parse.parse_qs(request.query).get('since', [None])[0]
+    if since is None:
+        (boot, _, since) = (request.headers.get('Last-Event-ID') or '').rpartition('-')
+        if boot != stateapi.BOOT:
+            # from before a restart, there's nothing to resume
+            since = '-1' if since else None
+    try:
+        return int(since) if since is not None else None
+    except ValueError:
+        return None
+
+
+BUS = EventBus()
@@ -0,0 +1,315 @@
+#
+# Zone history.
+#
+#  Every change to a zone value is recorded in a SQLite database, so
+#  listening statistics (hours per zone and per source, how loud) can be
+#  had without anything polling the controller.
+#
+#    - record() only puts the change on a queue, it never waits on the
+#      database.  If the queue is full the change is dropped and counted.
+#    - A writer thread inserts the queued changes in batches, one
+#      transaction each, with the database in WAL mode so queries don't
+#      hold up the writer or each other.
+#    - Once an hour the changes are rolled up into per-hour totals (how
+#      long each zone was on, on each source and at each volume).  Raw
+#      changes are kept for RAW_DAYS, hourly totals for HOURLY_DAYS.
+#
+#  Queries open their own connection and can be made from any thread.
+#  When the node server stops, the zones' power is recorded as unknown
+#  ('?') and each zone's values are recorded again once the controller
+#  reports it, so the time in between doesn't count.
+
+from udi_interface import LOGGER
+import os
+import queue
+import sqlite3
+import threading
+import time
+import clock
+
+# Zone drivers that are recorded, and what they're called here
+FIELDS = {
+        'ST': 'power',
+        'GV0': 'source',
+        'SVOL': 'volume',
+        'GV2': 'treble',
+        'GV3': 'bass',
+        'GV4': 'balance',
+        'GV5': 'loudness',
+        'GV6': 'dnd',
+        'GV7': 'party',
+        'GV8': 'mute',
+        }
+
+HOUR = 3600
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS changes (
+    ts REAL NOT NULL,
+    zone TEXT NOT NULL,
+    field TEXT NOT NULL,
+    value TEXT
+);
+CREATE INDEX IF NOT EXISTS changes_zone_ts ON changes (zone, ts);
+CREATE INDEX IF NOT EXISTS changes_ts ON changes (ts);
+
+CREATE TABLE IF NOT EXISTS hourly (
+    hour INTEGER NOT NULL,
+    zone TEXT NOT NULL,
+    field TEXT NOT NULL,
+    value TEXT NOT NULL,
+    seconds REAL NOT NULL,
+    PRIMARY KEY (field, zone, hour, value)
+);
+CREATE INDEX IF NOT EXISTS hourly_hour ON hourly (hour);
+
+CREATE TABLE IF NOT EXISTS current (
+    zone TEXT NOT NULL,
+    field TEXT NOT NULL,
+    value TEXT,
+    PRIMARY KEY (zone, field)
+);
+
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value
+);
+'''
+
+
+'''
+How long each zone spent in each state during one hour, given the
+state at the start of the hour and the changes during it.  Only time
+with the zone on counts:
+    on      value '1'
+    source  the source number
+    volume  the volume
+Returns {(zone, field, value): seconds} and updates state to the end
+of the hour.
+'''
+def rollup_hour(start, state, changes):
+    end = start + HOUR
+    totals = {}
+    since = {}
+
+    def account(zone, until):
+        z = state.get(zone, {})
+        seconds = until - since.get(zone, start)
+        if seconds <= 0 or z.get('power') != '1':
+            return
+        keys = [('on', '1')]
+        if z.get('source') is not None:
+            keys.append(('source', z['source']))
+        if z.get('volume') is not None:
+            keys.append(('volume', z['volume']))
+        for (field, value) in keys:
+            totals[(zone, field, value)] = totals.get((zone, field, value), 0) + seconds
+
+    for (ts, zone, field, value) in changes:
+        account(zone, ts)
+        since[zone] = ts
+        state.setdefault(zone, {})[field] = value
+    for zone in state:
+        account(zone, end)
+    return totals
+
+
+class History:
+    QUEUE_MAX = 10000   # changes waiting to be written
+    BATCH = 500         # most changes per transaction
+    FLUSH = 2.0         # seconds a change may wait for a batch to fill
+    RAW_DAYS = 14
+    HOURLY_DAYS = 730
+
+    def __init__(self, path):
+        self.path = path
+        self.clock = clock.default()
+        self.queue = queue.Queue(self.QUEUE_MAX)
+        self.dropped = 0
+        self.written = 0
+        self.thread = None
+
+    def start(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.thread = threading.Thread(target=self.__writer, name='history')
+        self.thread.daemon = True
+        self.thread.start()
+
+    # Write what's queued and stop the writer
+    def stop(self, timeout=10):
+        if self.thread is None:
+            return
+        self.queue.put(None)
+        self.thread.join(timeout)
+        self.thread = None
+
+    # A zone value changed.  Never blocks.
+    def record(self, zone, driver, value):
+        field = FIELDS.get(driver)
+        if field is None or self.thread is None:
+            return
+        if field == 'source' and isinstance(value, int):
+            value += 1  # the driver is zero based
+        try:
+            self.queue.put_nowait((self.clock.time(), zone, field, str(value)))
+        except queue.Full:
+            self.dropped += 1
+
+    def connect(self):
+        db = sqlite3.connect(self.path, timeout=10)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        return db
+
+    def __writer(self):
+        try:
+            db = self.connect()
+            db.executescript(SCHEMA)
+        except sqlite3.Error as e:
+            LOGGER.error('Unable to open history {}: {}'.format(self.path, e))
+            self.thread = None
+            return
+
+        next_rollup = 0
+        running = True
+        while running:
+            batch = []
+            try:
+                item = self.queue.get(timeout=self.FLUSH)
+                deadline = time.monotonic() + self.FLUSH
+                while item is not None:
+                    batch.append(item)
+                    if len(batch) >= self.BATCH:
+                        break
+                    item = self.queue.get(timeout=max(0, deadline - time.monotonic()))
+                if item is None:
+                    running = False
+            except queue.Empty:
+                pass
+
+            try:
+                now = self.clock.time()
+                if not running:
+                    # Nothing is known about the zones while we're not
+                    # running, don't count that time as listening.  That
+                    # includes zones only in this last batch.
+                    zones = db.execute('SELECT zone FROM current UNION SELECT zone FROM changes').fetchall()
+                    zones = {zone for (zone,) in zones} | {item[1] for item in batch}
+                    batch.extend((now, zone, 'power', '?') for zone in sorted(zones))
+                if batch:
+                    with db:
+                        db.executemany('INSERT INTO changes (ts, zone, field, value) VALUES (?, ?, ?, ?)', batch)
+                    self.written += len(batch)
+                if now >= next_rollup or not running:
+                    self.rollup(db, now)
+                    next_rollup = (now // HOUR + 1) * HOUR
+            except sqlite3.Error as e:
+                LOGGER.error('History write failed: {}'.format(e))
+        db.close()
+
+    '''
+    Total up every complete hour not done yet, then drop changes and
+    totals that are past their retention.
+    '''
+    def rollup(self, db, now):
+        row = db.execute("SELECT value FROM meta WHERE key = 'rolled'").fetchone()
+        if row is not None:
+            start = int(row[0])
+        else:
+            row = db.execute('SELECT MIN(ts) FROM changes').fetchone()
+            if row[0] is None:
+                return
+            start = int(row[0] // HOUR * HOUR)
+        end = int(now // HOUR * HOUR)
+        if start >= end:
+            return
+
+        state = {}
+        for (zone, field, value) in db.execute('SELECT zone, field, value FROM current'):
+            state.setdefault(zone, {})[field] = value
+
+        with db:
+            for hour in range(start, end, HOUR):
+                changes = db.execute('SELECT ts, zone, field, value FROM changes WHERE ts >= ? AND ts < ? ORDER BY ts, rowid',
+                                     (hour, hour + HOUR)).fetchall()
+                totals = rollup_hour(hour, state, changes)
+                db.executemany('INSERT OR REPLACE INTO hourly (hour, zone, field, value, seconds) VALUES (?, ?, ?, ?, ?)',
+                               [(hour, zone, field, value, seconds) for ((zone, field, value), seconds) in totals.items()])
+            db.executemany('INSERT OR REPLACE INTO current (zone, field, value) VALUES (?, ?, ?)',
+                           [(zone, field, value) for (zone, fields) in state.items() for (field, value) in fields.items()])
+            db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('rolled', ?)", (end,))
+            db.execute('DELETE FROM changes WHERE ts < ?', (min(end, now - self.RAW_DAYS * 86400),))
+            db.execute('DELETE FROM hourly WHERE hour < ?', (now - self.HOURLY_DAYS * 86400,))
+        LOGGER.debug('History rolled up {} hours'.format((end - start) // HOUR))
+
+    def __query(self, sql, args):
+        try:
+            db = sqlite3.connect(self.path, timeout=10)
+        except sqlite3.Error as e:
+            LOGGER.error('Unable to open history {}: {}'.format(self.path, e))
+            return []
+        try:
+            return db.execute(sql, args).fetchall()
+        except sqlite3.OperationalError as e:
+            # i.e. the writer hasn't created the tables yet
+            LOGGER.debug('History query failed: {}'.format(e))
+            return []
+        finally:
+            db.close()
+
+    '''
+    Seconds per value of field ('on', 'source' or 'volume') between since
+    and until (epoch seconds, rounded to hours), for one zone or all.
+    With by_zone the result is {zone: {value: seconds}}, otherwise
+    {value: seconds}.
+    '''
+    def totals(self, field, since=None, until=None, zone=None, by_zone=False):
+        sql = 'SELECT zone, value, SUM(seconds) FROM hourly WHERE field = ?'
+        args = [field]
+        if zone is not None:
+            sql += ' AND zone = ?'
+            args.append(zone)
+        if since is not None:
+            sql += ' AND hour >= ?'
+            args.append(int(since // HOUR * HOUR))
+        if until is not None:
+            sql += ' AND hour < ?'
+            args.append(int(until))
+        sql += ' GROUP BY zone, value'
+
+        result = {}
+        for (z, value, seconds) in self.__query(sql, args):
+            totals = result.setdefault(z, {}) if by_zone else result
+            totals[value] = totals.get(value, 0) + seconds
+        return result
+
+    # Hours each zone was on
+    def hours_on(self, since=None, until=None):
+        return {zone: v.get('1', 0) / HOUR for (zone, v) in self.totals('on', since, until, by_zone=True).items()}
+
+    # Hours listened to each source, all zones together
+    def source_hours(self, since=None, until=None, zone=None):
+        return {source: seconds / HOUR for (source, seconds) in self.totals('source', since, until, zone).items()}
+
+    # Seconds spent at each volume while on
+    def volume_distribution(self, since=None, until=None, zone=None):
+        return self.totals('volume', since, until, zone)
+
+    # Raw changes, newest first
+    def changes(self, zone=None, since=None, until=None, limit=1000):
+        sql = 'SELECT ts, zone, field, value FROM changes WHERE 1'
+        args = []
+        if zone is not None:
+            sql += ' AND zone = ?'
+            args.append(zone)
+        if since is not None:
+            sql += ' AND ts >= ?'
+            args.append(since)
+        if until is not None:
+            sql += ' AND ts < ?'
+            args.append(until)
+        sql += ' ORDER BY ts DESC LIMIT ?'
+        args.append(limit)
+        return self.__query(sql, args)
@@ -16,6 +16,11 @@ from nodes import russound
 from nodes import zone
 from nodes import profile
 import russound_main
+import webserver
+import stateapi
+import events
+import protolog
+import history
 from rnet_message import RNET_MSG_TYPE, ZONE_NAMES, SOURCE_NAMES
 
 LOGGER = udi_interface.LOGGER
@@ -31,11 +36,20 @@ class Controller(object):
         self.poly = polyglot
         self.configured = False
         self.controller_list = {}
+        self.http = None  # webserver.WebServer
+        self.history = None  # history.History
+        self.api = stateapi.StateAPI(self.controllers)
 
         self.TypedParameters = Custom(polyglot, "customtypedparams")
+        self.Data = Custom(polyglot, "customdata")
+        profile.persist(self.Data)
 
         polyglot.subscribe(polyglot.CUSTOMTYPEDPARAMS, self.typeParamsHandler)
         polyglot.subscribe(polyglot.CUSTOMTYPEDDATA, self.typedDataHandler)
+        polyglot.subscribe(polyglot.CUSTOMDATA, self.dataHandler)
+        # after customdata is loaded, so the saved profile hash is known
+        polyglot.subscribe(polyglot.CONFIGDONE, self.start)
+        polyglot.subscribe(polyglot.STOP, self.stop)
 
         self.TypedParameters.load( [
             {
@@ -46,12 +60,12 @@ class Controller(object):
                 'params': [
                     {
                         'name': 'ip_addr',
-                        'title': 'IP Address',
+                        'title': 'IP Address (or serial device)',
                         'isRequired': True,
                     },
                     {
                         'name': 'port',
-                        'title': 'IP Port',
+                        'title': 'IP Port (or baud rate)',
                         'defaultValue': 5000,
                         'isRequired': True,
                     },
@@ -66,6 +80,62 @@ class Controller(object):
                         'title': 'RNET or RIO',
                         'defaultValue': 'RNET',
                         'isRequired': True,
+                    },
+                    {
+                        'name': 'capture',
+                        'title': 'Capture traffic (on or off)',
+                        'defaultValue': 'off',
+                        'isRequired': False,
+                    },
+                    {
+                        'name': 'trace',
+                        'title': 'Trace commands (on or off)',
+                        'defaultValue': 'off',
+                        'isRequired': False,
+                    },
+                    {
+                        'name': 'proxy_port',
+                        'title': 'Proxy port for other programs (0 is off)',
+                        'defaultValue': 0,
+                        'isRequired': False,
+                    },
+                    {
+                        'name': 'proxy_host',
+                        'title': 'Proxy address to listen on (127.0.0.1 is this machine only, 0.0.0.0 is the network)',
+                        'defaultValue': '127.0.0.1',
+                        'isRequired': False,
+                    }
+                ]
+            },
+            {
+                'name': 'Server',
+                'title': 'Node server',
+                'desc': 'Local services provided by the node server',
+                'isList': False,
+                'params': [
+                    {
+                        'name': 'http_port',
+                        'title': 'HTTP port for /metrics, /api/ and /events (0 is off)',
+                        'defaultValue': 0,
+                        'isRequired': False,
+                    },
+                    {
+                        'name': 'http_host',
+                        'title': 'HTTP address to listen on (127.0.0.1 is this machine only, 0.0.0.0 is the network)',
+                        'defaultValue': '127.0.0.1',
+                        'isRequired': False,
+                    },
+                    {
+                        'name': 'history',
+                        'title': 'Record zone history (on or off)',
+                        'defaultValue': 'off',
+                        'isRequired': False,
+                    },
+                    {
+                        'name': 'log_levels',
+                        'title': 'Log levels, i.e. rnet=DEBUG, rio=INFO (rnet, rio, link, zone)',
+                        'defaultValue': '',
+                        'isRequired': False,
                     }
                 ]
             }
@@ -81,10 +151,20 @@ class Controller(object):
         LOGGER.debug('In Typed Parameter Handler -- got')
         LOGGER.debug(params)
 
-    ''' Called when the user saves changes to the config '''
+    # Our own saved data, i.e. which profile Polyglot has installed
+    def dataHandler(self, data):
+        self.Data.load(data)
+
+    '''
+    Called when the user saves changes to the config.  Controllers whose
+    connection settings are the same keep their connection, changed ones
+    reconnect and ones no longer listed are shut down and removed.
+    '''
     def typedDataHandler(self, data):
         self.poly.Notices.clear()
+        previous = self.controller_list
         self.controller_list = {}
+        listed = set()  # includes controllers with settings we can't use
 
         LOGGER.debug('In Typed Data Handler -- got')
         LOGGER.debug(data)
@@ -103,27 +183,41 @@ class Controller(object):
         for ctrlr in data['Controller']:
             LOGGER.debug('Processing controller {}'.format(ctrlr))
             valid = True
-            if ctrlr['nwprotocol'] != 'TCP' and ctrlr['nwprotocol'] != 'UDP':
-                self.poly.Notices['nw'] = 'Network protocol invalid, please use "TCP" or "UDP"'
+            if ctrlr['nwprotocol'] not in ['TCP', 'UDP', 'SERIAL']:
+                self.poly.Notices['nw'] = 'Network protocol invalid, please use "TCP", "UDP" or "SERIAL"'
                 valid = False
             if ctrlr['protocol'] != 'RNET' and ctrlr['protocol'] != 'RIO':
                 self.poly.Notices['rnet'] = 'Russound protocol invalid, please use "RNET" or "RIO"'
                 valid = False
+            elif ctrlr['nwprotocol'] == 'SERIAL' and ctrlr['protocol'] != 'RNET':
+                self.poly.Notices['serial'] = 'The SERIAL network protocol only supports RNET'
+                valid = False
             if ctrlr['ip_addr'] is None:
-                self.Notices['ip'] = "Please configure the IP address"
+                self.poly.Notices['ip'] = "Please configure the IP address"
                 valid = False
             if ctrlr['port'] is None or ctrlr['port'] == '0':
-                self.Notices['port'] = "Please configure the port number"
+                self.poly.Notices['port'] = "Please configure the port number"
                 valid = False
+            if str(ctrlr.get('capture') or 'off').lower() not in ['on', 'off']:
+                self.poly.Notices['capture'] = 'Capture traffic should be "on" or "off"'
+            if str(ctrlr.get('trace') or 'off').lower() not in ['on', 'off']:
+                self.poly.Notices['trace'] = 'Trace commands should be "on" or "off"'
+            if not str(ctrlr.get('proxy_port') or 0).isdigit():
+                self.poly.Notices['proxy'] = 'Proxy port should be a number, 0 turns it off'
+
+            # An entry that's wrong for now doesn't remove its controller
+            try:
+                listed.add(self.controller_address(ctrlr))
+            except (AttributeError, IndexError):
+                pass
 
             if valid:
                 ctrlr['controller'] = cnt
                 ctrlr['host'] = '{}:{}'.format(ctrlr['ip_addr'], ctrlr['port'])
-                address = 'rsmain_{}'.format(ctrlr['ip_addr'].split('.')[3])
+                address = self.controller_address(ctrlr)
 
                 LOGGER.debug('Provisioning controller: {} {}'.format(ctrlr['host'], ctrlr['protocol']))
                 if self.poly.getNode(address) is not None:
-                    # TODO: Update node info??
                     LOGGER.debug('{} needs to be updated'.format(address))
                     node = self.poly.getNode(address)
                     node.provision(ctrlr)
@@ -132,20 +226,99 @@ class Controller(object):
                     node = russound.RSController(self.poly, address, address, 'RussoundCtl_{}'.format(cnt), ctrlr)
 
                 ctrlr['node'] = node
+                node.set_history(self.history)
 
                 self.controller_list[address] = ctrlr
                 self.configured = True
             cnt += 1
 
-        ''' Compare controller list with node list and delete any orphans '''
-        for node in self.poly.nodes():
-            if node.address not in self.controller_list:
-                LOGGER.debug('Found orphaned controller {}'.format(node.address))
+        ''' Shut down controllers that were removed from the list '''
+        for (address, ctrlr) in previous.items():
+            if address in listed:
+                self.controller_list.setdefault(address, ctrlr)
+            else:
+                LOGGER.info('Controller {} was removed'.format(address))
+                ctrlr['node'].shutdown()
+
+        server = data.get('Server') or {}
+        self.configure_history(server)
+        bad = protolog.set_levels(server.get('log_levels'))
+        if bad:
+            self.poly.Notices['log'] = 'Log levels not understood: {}'.format(', '.join(bad))
+        self.configure_http(server)
+
+    # Start or stop recording zone history
+    def configure_history(self, server):
+        enabled = str(server.get('history') or 'off').lower()
+        if enabled not in ['on', 'off']:
+            self.poly.Notices['history'] = 'Record zone history should be "on" or "off"'
+            enabled = 'off'
+
+        if enabled == 'on' and self.history is None:
+            self.history = history.History('state/history.db')
+            self.history.start()
+        elif enabled == 'off' and self.history is not None:
+            self.history.stop()
+            self.history = None
+        for ctrlr in self.controller_list.values():
+            ctrlr['node'].set_history(self.history)
+
+    '''
+    Start, stop or move the local HTTP server.  It's left alone when the
+    port and address haven't changed.
+    '''
+    def configure_http(self, server):
+        try:
+            port = int(server.get('http_port') or 0)
+        except ValueError:
+            self.poly.Notices['http'] = 'HTTP port should be a number, 0 turns it off'
+            port = 0
+        host = str(server.get('http_host') or '127.0.0.1').strip()
+
+        if self.http is not None and (self.http.port, self.http.host) == (port, host):
+            return
+        if self.http is not None:
+            self.http.stop()
+            self.http = None
+        if port == 0:
+            return
+
+        http = webserver.WebServer(port, host)
+        http.route('/metrics', self.metrics)
+        http.route('/api/', self.api.handle)
+        http.route('/events', events.BUS.stream, request=True)
+        http.route('/events.jsonl', lambda request: events.BUS.stream(request, jsonl=True), request=True)
+        try:
+            http.start()
+            self.http = http
+        except OSError as e:
+            LOGGER.error('Unable to start HTTP server on {}:{}: {}'.format(host, port, e))
+            self.poly.Notices['http'] = 'Unable to use HTTP address {} port {}: {}'.format(host, port, e)
+
+    # The controller nodes
+    def controllers(self):
+        return [c['node'] for c in list(self.controller_list.values())]
+
+    # Prometheus text format, one set of samples per controller
+    def metrics(self):
+        sources = [c['node'].metrics_source() for c in list(self.controller_list.values())]
+        return ('text/plain; version=0.0.4; charset=utf-8', russound_main.render_metrics(sources))
+
+    '''
+    Node address for a controller. Network controllers use the last octet
+    of the IP address, serial controllers use the device name, i.e.
+    /dev/ttyUSB0 becomes rsmain_ttyusb0.
+    '''
+    def controller_address(self, ctrlr):
+        if ctrlr['nwprotocol'] == 'SERIAL':
+            device = re.sub('[^a-z0-9]', '', ctrlr['ip_addr'].split('/')[-1].lower())
+            return 'rsmain_{}'.format(device[-7:])
+        return 'rsmain_{}'.format(ctrlr['ip_addr'].split('.')[3])
 
     def start(self):
         LOGGER.info('Starting node server @ {}'.format(datetime.date.today()))
 
-        self.poly.updateProfile()
+        profile.install(self.poly)
         LOGGER.info('Node server started')
 
     # Delete the node server from Polyglot
@@ -154,4 +327,13 @@ class Controller(object):
 
     def stop(self):
         LOGGER.info('Stopping node server')
+        if self.http is not None:
+            self.http.stop()
+        for ctrlr in list(self.controller_list.values()):
+            ctrlr['node'].state.flush()
+            ctrlr['node'].configure_proxy(0)
+        if self.history is not None:
+            self.history.stop()
+        # with a STOP subscriber, disconnecting is up to us
+        self.poly.stop()
 
@@ -7,53 +7,161 @@
 
   Utilitye functions to make changes to profile files.
 
-  nls(key, array)
+  The profile is rendered in memory, only files whose contents change
+  are written (atomically) and Polyglot is only asked to install the
+  profile when it differs from the one it last installed.  Installing
+  a profile makes the admin console reload, so doing it on every
+  discover/restart is something users notice.
+
+  nls(text, key, array)
      - Add NLS entries using key for each item in array
      - removes any existing entries for key
 
-  editor(id, min, max, uom, nls)
+  editor(text, id, min, max, uom, nls)
      - Replace the editor range for id with the passed in args.
 
+  update(poly, sources, count)
+     - Apply the source names and count, write and install if changed.
+
+  install(poly)
+     - Install the profile on disk if Polyglot doesn't have it yet.
+
 """
 
-import collections
+import hashlib
 import os
+import re
+import tempfile
+import threading
 import logging
-import in_place
 
 logger = logging.getLogger()
 
+NLS = 'profile/nls/en_us.txt'
+EDITORS = 'profile/editor/editors.xml'
+NODEDEFS = 'profile/nodedef/nodedefs.xml'
+FILES = (NLS, EDITORS, NODEDEFS)
+
+HASH_KEY = 'profile_hash'  # in customdata, survives restarts
+
+_lock = threading.Lock()
+_store = {}  # where the hash of the installed profile is kept
+
+
+'''
+Use store (the node server's customdata) to remember which profile
+Polyglot has.  Without it that's only known until the next restart.
+'''
+def persist(store):
+    global _store
+    _store = store
+
+
+def read(path):
+    try:
+        with open(path, 'rb') as f:
+            return f.read().decode('utf-8')
+    except OSError:
+        return ''
+
+
+'''
+Replace the file with text, if that changes it.  The new contents go to
+a temporary file in the same directory that is then renamed over the
+old one, so nobody ever sees a half written file.  Returns True if the
+file was written.
+'''
+def write(path, text):
+    data = text.encode('utf-8')
+    if os.path.exists(path) and read(path) == text:
+        return False
+
+    directory = os.path.dirname(path)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    (fd, tmp) = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        if os.path.exists(path):
+            os.chmod(tmp, os.stat(path).st_mode & 0o777)
+        else:
+            os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except:
+        os.unlink(tmp)
+        raise
+    return True
+
+
+def nls(text, key, nls_list):
+    lines = text.splitlines(keepends=True)
+    entries = ['{}-{} = {}\n'.format(key, idx, name.strip()) for (idx, name) in enumerate(nls_list)]
+
+    # new entries go where the old ones were, so the file keeps its order
+    out = []
+    for line in lines:
+        if line.startswith(key + '-'):
+            out.extend(entries)
+            entries = []
+        else:
+            out.append(line)
+    if out and not out[-1].endswith('\n'):
+        out[-1] += '\n'
+    out.extend(entries)
+    return ''.join(out)
+
+
+def editor(text, editor_id, min, max, uom, nls):
+    pattern = re.compile(r'(<editor id="' + re.escape(editor_id) + r'">\s*?\r?\n)([ \t]*)<range[^>]*/>')
+    range_ = '<range uom="{}" min="{}" max="{}" nls="{}" />'.format(uom, min, max, nls)
+    return pattern.sub(lambda m: m.group(1) + m.group(2) + range_, text, count=1)
+
+
+# Hash of the whole profile, in the form Polyglot would get it
+def digest(files):
+    h = hashlib.sha256()
+    for path in FILES:
+        h.update(path.encode('utf-8'))
+        h.update(b'\0')
+        h.update(files[path].encode('utf-8'))
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+def _install(poly, files):
+    current = digest(files)
+    if _store.get(HASH_KEY) == current:
+        logger.debug('Profile unchanged, not installing it')
+        return False
+    logger.info('Installing profile {}'.format(current[:12]))
+    poly.updateProfile()
+    _store[HASH_KEY] = current
+    return True
+
+
+'''
+Set the source names and source count.  Returns True if the profile
+was installed.
+'''
+def update(poly, sources, count):
+    with _lock:
+        files = {path: read(path) for path in FILES}
+        files[NLS] = nls(files[NLS], 'SOURCE', sources)
+        files[EDITORS] = editor(files[EDITORS], 'source', min=0, max=count - 1, uom=25, nls='SOURCE')
+
+        for path in (NLS, EDITORS):
+            try:
+                if write(path, files[path]):
+                    logger.info('Updated {}'.format(path))
+            except OSError as e:
+                logger.error('Unable to write {}: {}'.format(path, e))
+        return _install(poly, files)
 
-def nls(key, nls_list):
-    # first make sure directory exists
-    if not os.path.exists("profile/nls"):
-        try:
-            os.makedirs("profile/nls")
-        except:
-            logger.error('unable to create node NLS directory.')
-
-    with in_place.InPlace('profile/nls/en_us.txt') as file:
-        for line in file:
-            if not line.startswith(key):
-                file.write(line)
-        # append new entries
-        idx = 0
-        for name in nls_list:
-            file.write('{}-{}: {}\n'.format(key, idx, name.strip()))
-            idx += 1
-
-def editor(editor_id, min, max, uom, nls):
-    found = False
-    with in_place.InPlace('profile/editor/editors.xml') as file:
-        for line in file:
-            if found:
-                found = False
-                file.write('\t\t<range uom="{}" min="{}" max="{}" nls="{}" />\n'.format(uom, min, max, nls))
-            else:
-                file.write(line)
-
-            if 'id="' + editor_id in line:
-                found = True
-
-            
 
+def install(poly):
+    with _lock:
+        return _install(poly, {path: read(path) for path in FILES})
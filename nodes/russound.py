@@ -14,15 +14,40 @@ import socket
 import math
 import re
 import russound_main
+import rnet_capture
+import proxy
+import clock
+import zonestate
+import protolog
+import stateapi
+import events
+from protolog import Hex
 from nodes import zone
 from nodes import profile
 from rnet_message import RNET_MSG_TYPE, ZONE_NAMES, SOURCE_NAMES
 
+# Messages that report a zone's state, they confirm traced commands
+ZONE_STATUS = (
+        RNET_MSG_TYPE.ALL_ZONE_INFO, RNET_MSG_TYPE.ZONE_STATE, RNET_MSG_TYPE.ZONE_SOURCE,
+        RNET_MSG_TYPE.ZONE_VOLUME, RNET_MSG_TYPE.ZONE_BASS, RNET_MSG_TYPE.ZONE_TREBLE,
+        RNET_MSG_TYPE.ZONE_BALANCE, RNET_MSG_TYPE.ZONE_LOUDNESS,
+        RNET_MSG_TYPE.ZONE_PARTY_MODE, RNET_MSG_TYPE.ZONE_DO_NOT_DISTURB,
+        )
+
 LOGGER = udi_interface.LOGGER
+RNETLOG = protolog.get('rnet')
+RIOLOG = protolog.get('rio')
 Custom = udi_interface.Custom
 
 class RSController(udi_interface.Node):
     id = 'russound'
+    METRICS_INTERVAL = 60  # seconds between connection quality updates
+    PROFILE_MINUTES = 5    # default profiling time
+    PROFILE_MAX = 30       # minutes, profiling always stops by then
+    ADD_TIMEOUT = 30       # seconds to wait for Polyglot to add zone nodes
+    # Settings the connection is made from, changing any of them means
+    # a new connection.  The others can change on a live connection.
+    LINK_SETTINGS = ('ip_addr', 'port', 'nwprotocol', 'protocol', 'controller')
 
     def __init__(self, polyglot, primary, address, name, details):
         super(RSController, self).__init__(polyglot, primary, address, name)
@@ -30,12 +55,47 @@ class RSController(udi_interface.Node):
         self.address = address
         self.primary = primary
         self.configured = False
+        self.running = True
         self.wait = True
+        self.details = None
         self.rnet = None
         self.sock = None
         self.mesg_thread = None
+        self.capture = None
+        self.proxy = None  # proxy.LinkProxy
+        self.clock = clock.default()
+        self.metrics = russound_main.Metrics()  # kept when re-provisioned
+        self.recorder = russound_main.FlightRecorder()
+        self.state = zonestate.StateStore('state/{}.json'.format(address))
+        self.state.clock = self.clock
+        self.history = None  # history.History, set by the Controller
+        self.profiling = None  # russound_main.ProfileSession
+        self.profile_timer = None
+        self.metrics_time = 0
         self.raw_config = bytearray(0)
         self.source_status = 0x00 # assume all sources are inactive
+        self.revision = stateapi.revision()  # changes with the state served by stateapi
+        self.adding = {}  # address -> zone node waiting for Polyglot to add it
+        self.add_done = threading.Condition()
+        self.reset_config()
+
+        # what does details look like:
+        #    details['nwprotocol']
+        #    details['ip_addr']
+        #    details['port']
+        #    details['host']
+        #    details['protocol']
+        #    details['zones']?
+        self.provision(details)
+
+        self.poly.subscribe(self.poly.START, self.start, address)
+        self.poly.subscribe(self.poly.ADDNODEDONE, self.node_added)
+
+        self.poly.addNode(self)
+
+
+    # Forget the zone/source configuration, it's read again on connect
+    def reset_config(self):
         self.ctrl_config = {
                 'sourceInfo': {
                     'source_count': 0,
@@ -49,25 +109,37 @@ class RSController(udi_interface.Node):
                         }
                     ]
                 }
+        self.revision = stateapi.revision()
 
-        # what does details look like:
-        #    details['nwprotocol']
-        #    details['ip_addr']
-        #    details['port']
-        #    details['host']
-        #    details['protocol']
-        #    details['zones']?
-        self.provision(details)
-
-        self.poly.subscribe(self.poly.START, self.start, address)
+    # True if details would connect differently than the current connection
+    def link_changed(self, details):
+        if self.rnet is None or self.details is None:
+            return True
+        for key in self.LINK_SETTINGS:
+            if str(details.get(key)).upper() != str(self.details.get(key)).upper():
+                return True
+        return False
 
-        self.poly.addNode(self)
+    def provision(self, details):
+        if not self.link_changed(details):
+            # Keep the connection and everything learned over it
+            LOGGER.info('{} connection settings unchanged'.format(self.name))
+            self.configure(details)
+            self.details = dict(details)
+            return
 
+        # Provisioned again (configuration changed), close the old
+        # connection so its message loop exits.  start() sees the new,
+        # not yet connected, one and connects it.
+        if self.rnet is not None:
+            LOGGER.info('{} connection settings changed, reconnecting'.format(self.name))
+            self.rnet.Drop()
 
-    def provision(self, details):
         if details['protocol'].upper() == 'RNET':
             if details['nwprotocol'].upper() == 'UDP':
                 self.rnet = russound_main.RNETConnection(details['ip_addr'], details['port'], True)
+            elif details['nwprotocol'].upper() == 'SERIAL':
+                self.rnet = russound_main.RNETConnection(details['ip_addr'], details['port'], False, serial=True)
             else:
                 self.rnet = russound_main.RNETConnection(details['ip_addr'], details['port'], False)
         elif details['protocol'].upper() == 'RIO':
@@ -78,29 +150,129 @@ class RSController(udi_interface.Node):
         '''
 
         self.rnet.controller = details['controller']
+        self.rnet.clock = self.clock
+        self.rnet.metrics = self.metrics
+        self.rnet.recorder = self.recorder
+        self.rnet.profiling = self.profiling
+        if self.capture is not None:
+            # a new connection may speak another protocol, start a new file
+            self.capture.close()
+            self.capture = None
+        self.configure(details)
+        self.details = dict(details)
+
         LOGGER.info('Provisioning complete')
         self.configured = True
 
+    # Settings that apply to the connection as it is
+    def configure(self, details):
+        self.recorder.enable(str(details.get('trace') or 'off').lower() == 'on')
+
+        # Record the raw traffic so problems can be replayed later
+        capture = str(details.get('capture') or 'off').lower() == 'on'
+        if not capture and self.capture is not None:
+            self.capture.close()
+            self.capture = None
+        elif capture and self.capture is None:
+            path = 'logs/{}.rcap'.format(self.address)
+            try:
+                self.capture = rnet_capture.CaptureWriter(path, self.rnet.protocol)
+                LOGGER.info('Capturing {} traffic to {}'.format(self.name, path))
+            except OSError as e:
+                LOGGER.error('Unable to open capture file {}: {}'.format(path, e))
+        self.rnet.capture = self.capture
+
+        host = str(details.get('proxy_host') or '127.0.0.1').strip()
+        try:
+            self.configure_proxy(int(details.get('proxy_port') or 0), host)
+        except ValueError:
+            self.configure_proxy(0)
+
+    '''
+    Start, stop or move the proxy that lets other programs use our
+    connection to the controller (0 is off), listening on host.  A
+    proxy that keeps its port and host keeps its clients, even over a
+    new connection.
+    '''
+    def configure_proxy(self, port, host='127.0.0.1'):
+        if self.proxy is not None and (self.proxy.port, self.proxy.host) != (port, host):
+            self.proxy.stop()
+            self.proxy = None
+        if port and self.proxy is None:
+            p = proxy.LinkProxy(port, self.name, host)
+            try:
+                p.start()
+                self.proxy = p
+            except OSError as e:
+                LOGGER.error('Unable to start proxy on {}:{}: {}'.format(host, port, e))
+                self.poly.Notices['proxy'] = 'Unable to use proxy address {} port {} for {}: {}'.format(host, port, self.name, e)
+        if self.proxy is not None and self.rnet is not None:
+            self.proxy.attach(self.rnet)
+        elif self.rnet is not None:
+            self.rnet.proxy = None
+
+    '''
+    The controller was removed from the configuration.  Stop start()'s
+    loop, close the connection and remove the controller and its zones
+    from Polyglot.
+    '''
+    def shutdown(self):
+        LOGGER.info('Shutting down {}'.format(self.name))
+        self.running = False
+        self.profile_stop()
+        self.configure_proxy(0)
+        self.state.remove()
+        if self.rnet is not None:
+            self.rnet.Close()
+        if self.capture is not None:
+            self.capture.close()
+            self.capture = None
+            self.rnet.capture = None
+
+        for node in self.poly.nodes():
+            if node.address != self.address and getattr(node, 'primary', None) == self.address:
+                self.poly.delNode(node.address)
+        self.poly.delNode(self.address)
+
     def start(self):
         LOGGER.info('Starting Russound Controller {}'.format(self.name))
 
         while not self.configured:
-            time.sleep(5) 
+            self.clock.sleep(5)
+
+        self.restore_zones()
 
-        while True:
+        while self.running:
             self.reconnect()
             LOGGER.info('{} started'.format(self.name))
-            while self.rnet.connected:
-                LOGGER.debug('{} connection OK'.format(self.name))
-                time.sleep(30)
+
+            # CheckLink sends heartbeats when the link goes quiet and
+            # reports a dead link, even one the socket thinks is fine.
+            while self.running and self.rnet.CheckLink():
+                self.update_metrics()
+                self.clock.sleep(self.rnet.LINK_CHECK)
 
             LOGGER.info('{} stopped'.format(self.name))
+            if not self.running:
+                break
+            self.setDriver("ST", 0)
+            self.setDriver("GV10", 0)
+            self.rnet.Drop()
+            self.clock.sleep(self.rnet.LINK_CHECK)
 
     def reconnect(self):
+        # Make sure the previous message loop is gone before reconnecting
+        if self.mesg_thread is not None:
+            self.mesg_thread.join(5)
+            if self.mesg_thread.is_alive():
+                LOGGER.warning('{} message loop did not exit'.format(self.name))
+            self.mesg_thread = None
+
         self.rnet.Connect()
 
         if self.rnet.connected:
             self.setDriver("ST", 1)
+            self.reset_config()
             # Start a thread that listens for messages from the russound.
             if self.rnet.protocol == 'RNET':
                 self.mesg_thread = threading.Thread(target=self.rnet.MessageLoop, args=(self.RNETProcessCommand,))
@@ -169,8 +341,8 @@ class RSController(udi_interface.Node):
                         self.rnet.get_info(cinfo['controller'], z, 0x0407)
                     elif self.rnet.protocol == 'RIO':
                         self.rnet.get_info(1, 'C['+str(cinfo['controller'])+'].Z['+str(z+1)+']', 'all')
-                    time.sleep(3)
-                time.sleep(2)
+                    self.clock.sleep(3)
+                self.clock.sleep(2)
 
         self.poly.Notices.clear()
 
@@ -182,6 +354,74 @@ class RSController(udi_interface.Node):
     def query(self):
         self.reportDrivers()
 
+    # Connection quality and message rate drivers, once a minute
+    def update_metrics(self):
+        now = self.clock.monotonic()
+        if now - self.metrics_time < self.METRICS_INTERVAL:
+            return
+        self.metrics_time = now
+
+        rates = self.metrics.rates(now)
+        if rates is not None:
+            self.setDriver('GV10', rates[0])
+            self.setDriver('GV11', rates[1])
+
+    # Write the command traces to the log directory
+    def dump_trace(self, cmd=None):
+        path = 'logs/{}_trace_{}.jsonl'.format(self.address, time.strftime('%Y%m%d_%H%M%S'))
+        try:
+            count = self.recorder.dump(path)
+            LOGGER.info('Wrote {} command traces to {}'.format(count, path))
+        except OSError as e:
+            LOGGER.error('Unable to write command traces to {}: {}'.format(path, e))
+
+    '''
+    Profile the reader, writer and Polyglot threads for the number of
+    minutes given (PROFILE_MINUTES if none, never more than
+    PROFILE_MAX).  Results go to the log directory when it stops.
+    '''
+    def profile_start(self, cmd=None):
+        if self.profiling is not None:
+            LOGGER.warning('{} is already being profiled'.format(self.name))
+            return
+        try:
+            minutes = int(float(cmd.get('value') or self.PROFILE_MINUTES)) if cmd else self.PROFILE_MINUTES
+        except ValueError:
+            minutes = self.PROFILE_MINUTES
+        minutes = min(max(minutes, 1), self.PROFILE_MAX)
+
+        prefix = 'logs/{}_profile_{}'.format(self.address, time.strftime('%Y%m%d_%H%M%S'))
+        self.profiling = russound_main.ProfileSession(prefix)
+        if self.rnet is not None:
+            self.rnet.profiling = self.profiling
+        self.profile_timer = self.clock.call_later(minutes * 60, self.profile_stop)
+        LOGGER.info('Profiling {} for up to {} minutes'.format(self.name, minutes))
+
+    def profile_stop(self, cmd=None):
+        session = self.profiling
+        if session is None:
+            return
+        self.profiling = None
+        if self.profile_timer is not None:
+            self.profile_timer.cancel()
+            self.profile_timer = None
+
+        # The connection lets go of the session once its threads have
+        # turned their profilers off.
+        try:
+            for path in session.stop():
+                LOGGER.info('Profile written to {}'.format(path))
+        except OSError as e:
+            LOGGER.error('Unable to write profile {}: {}'.format(session.prefix, e))
+
+    # (labels, metrics) for russound_main.render_metrics(), with the
+    # gauges brought up to date first
+    def metrics_source(self):
+        if self.rnet is not None:
+            self.metrics.set('connected', int(self.rnet.connected))
+            self.metrics.set('incoming_queue_depth', len(self.rnet.incoming))
+        return ([('controller', self.address), ('name', self.name)], self.metrics)
+
     def all_zones_on(self, cmd):
         LOGGER.info('Turn on all zones')
         if self.rnet.protocol == 'RNET':
@@ -203,48 +443,165 @@ class RSController(udi_interface.Node):
     def discover(self, *args, **kwargs):
         LOGGER.debug('in discover() - Setting up {} sources'.format(self.ctrl_config['sourceInfo']['source_count']))
         """
-          TODO:
-              Update the NLS file with the source names.  The NLS entries
-              are  'SOURCE-[num] = self.sources[num]'
-
-              Update the editor file with the proper range for the sources
-              The editor id is "source"
+          Update the NLS file with the source names.  The NLS entries
+          are  'SOURCE-[num] = self.sources[num]' and the editor "source"
+          range.  Nothing is written or installed if they're unchanged.
         """
-        profile.nls("SOURCE", self.ctrl_config['sourceInfo']['sources'])
-        profile.editor('source', min=0, max=self.ctrl_config['sourceInfo']['source_count'] - 1, uom=25, nls="SOURCE")
-        self.poly.updateProfile()
-
+        profile.update(self.poly, self.ctrl_config['sourceInfo']['sources'], self.ctrl_config['sourceInfo']['source_count'])
+
+        (add, keep, remove) = self.reconcile(self.zone_names())
+        LOGGER.info('{} zones: {} to add or rename, {} unchanged, {} to remove'.format(
+            self.name, len(add), len(keep), len(remove)))
+
+        # Zones we already have (reconnect), point them at the new connection
+        for node in keep:
+            node.setRNET(self.rnet)
+            node.recorder = self.recorder
+            node.state = self.state
+            node.history = self.history
+            node.Ready()
+
+        for zaddr in remove:
+            LOGGER.info('Removing zone node {}'.format(zaddr))
+            self.poly.delNode(zaddr)
+            self.state.forget(zaddr)
+
+        if add:
+            self.add_zones(add, True)
+        self.revision = stateapi.revision()
+
+    '''
+    Create zone nodes for [(address, name)] and add them to Polyglot in
+    one go.  Zones with saved values start out with those.  With ready
+    set, each zone is made ready by node_added() when Polyglot says it
+    has it.
+    '''
+    def add_zones(self, add, ready):
+        self.poly.Notices['init'] = 'Creating {} zone nodes for {}'.format(len(add), self.name)
+        nodes = []
+        for (zaddr, name) in add:
+            LOGGER.debug('CREATING ZONE:  {} {} - {} ({})'.format(self.name, self.address, zaddr, name))
+            node = zone.Zone(self.poly, self.address, zaddr, name)
+            node.clock = self.clock
+            node.recorder = self.recorder
+            node.setRNET(self.rnet)
+            saved = self.state.drivers(zaddr)
+            if saved:
+                node.restore(saved)
+            node.state = self.state
+            node.history = self.history
+            nodes.append(node)
+        with self.add_done:
+            self.adding.update((node.address, (node, ready)) for node in nodes)
+
+        # rename=True has Polyglot update the name of a node it already has
+        for node in nodes:
+            self.poly.addNode(node, rename=True)
+
+        # Don't wait forever for ones Polyglot never confirms
+        with self.add_done:
+            self.add_done.wait_for(lambda: not self.adding, self.ADD_TIMEOUT)
+            late = list(self.adding.values())
+            self.adding.clear()
+        for (node, ready) in late:
+            LOGGER.warning('Polyglot did not confirm zone node {}, using it anyway'.format(node.address))
+            if ready:
+                node.Ready()
+        self.poly.Notices.delete('init')
+
+    '''
+    Create the zones saved from the last run, with their last values, so
+    the ISY has them while we connect.  discover() takes them over once
+    the controller has reported its zones.
+    '''
+    def restore_zones(self):
+        saved = self.state.load()
+        add = [(zaddr, z.get('name') or zaddr) for (zaddr, z) in sorted(saved.items())
+               if self.poly.getNode(zaddr) is None]
+        if add:
+            LOGGER.info('{}: restoring {} zones from the last run'.format(self.name, len(add)))
+            self.add_zones(add, False)
+
+    def setDriver(self, driver, value, *args, **kwargs):
+        # the connection quality ones change all the time and aren't served
+        changed = driver in stateapi.CONTROLLER_DRIVERS and self.getDriver(driver) != value
+        super(RSController, self).setDriver(driver, value, *args, **kwargs)
+        if changed:
+            self.revision = stateapi.revision()
+            (field, kind) = stateapi.CONTROLLER_DRIVERS[driver]
+            events.BUS.publish('controller', controller=self.address, field=field, value=kind(value))
+
+    # Source names, in source number order
+    def source_names(self):
+        return list(self.ctrl_config['sourceInfo']['sources'])
+
+    # Our zone nodes, in address order
+    def zone_nodes(self):
+        zones = [node for node in self.poly.nodes() if isinstance(node, zone.Zone) and node.primary == self.address]
+        return sorted(zones, key=lambda node: node.address)
+
+    # Record zone changes in history (None to stop)
+    def set_history(self, history):
+        self.history = history
+        for node in self.poly.nodes():
+            if isinstance(node, zone.Zone) and node.primary == self.address:
+                node.history = history
+
+    # Polyglot has added a node (ADDNODEDONE)
+    def node_added(self, data):
+        address = data.get('address') if isinstance(data, dict) else None
+        with self.add_done:
+            entry = self.adding.pop(address, None)
+            if entry is None:
+                return
+            self.add_done.notify_all()
+        LOGGER.debug('Zone node {} added'.format(address))
+        (node, ready) = entry
+        if ready:
+            node.Ready()
+
+    # address -> name for every zone the controller(s) reported
+    def zone_names(self):
+        zones = {}
         for cinfo in self.ctrl_config['ctrlInfo']:
-
-            LOGGER.debug('in discover() - Setting up controller {} {} zones'.format(cinfo['controller'], cinfo))
             ctrl = cinfo['controller']
             for z in range(0, cinfo['zone_count']):
-                param = 'Zone ' + str(z + 1)
-                zaddr = 'zone_' + str(ctrl) + '_' + str(z + 1)
-                LOGGER.debug('CREATING ZONE:  {} {} - {}'.format(self.name, self.address, zaddr))
-                self.poly.Notices['init'] = 'Creating zone node {}'.format(self.name)
-                node = zone.Zone(self.poly, self.address, zaddr, cinfo['zones'][z])
-                node.setRNET(self.rnet)
-
-                try:
-                    """
-                    if the node exist in the Polyglot database and the name
-                    is changing remove it from the database so we can add it
-                    with the new name.  Polyglot doesn't let us change the
-                    name with addNode()
-                    """
-                    old = self.poly.getNode(zaddr)
-                    if old is not None:
-                        if old.name != cinfo['zones'][z]:
-                            LOGGER.debug('Need to rename {} to {}'.format(old.name, cinfo['zones'][z]))
-                            self.delNode(zaddr)
-                            time.sleep(1)  # give it time to remove from database
-                except:
-                    LOGGER.warning('Failed to delete node {}'.format(zaddr))
-
-                self.poly.addNode(node, rename=True)
-                time.sleep(1)
-                node.Ready()
+                zones['zone_{}_{}'.format(ctrl, z + 1)] = cinfo['zones'][z]
+        return zones
+
+    '''
+    Compare the zones we should have with Polyglot's nodes.  Returns
+     - (address, name) of the zones that are missing or named differently
+     - the zone nodes that are fine as they are
+     - addresses of our zone nodes that the controller no longer has
+
+    Only zones of controllers that reported their configuration are
+    removed, a controller that didn't answer this time keeps its zones.
+    '''
+    def reconcile(self, zones):
+        existing = self.poly.getNodes()
+        reported = set(address.split('_')[1] for address in zones)
+
+        add = []
+        keep = []
+        for (zaddr, name) in zones.items():
+            node = existing.get(zaddr)
+            if isinstance(node, zone.Zone) and node.name == name:
+                keep.append(node)
+            else:
+                if node is not None:
+                    LOGGER.debug('Need to rename {} to {}'.format(node.name, name))
+                add.append((zaddr, name))
+
+        remove = []
+        for (address, node) in existing.items():
+            if not address.startswith('zone_') or address in zones:
+                continue
+            if getattr(node, 'primary', self.address) != self.address:
+                continue
+            if address.split('_')[1] in reported:
+                remove.append(address)
+        return (add, keep, remove)
 
     # Delete the node server from Polyglot
     def delete(self):
@@ -332,8 +689,8 @@ class RSController(udi_interface.Node):
         zone_addr = msg.ZoneString()
 
         if msg.MessageType() == RNET_MSG_TYPE.LOST_CONNECTION:
-            LOGGER.error('Got lost connection message!!  Restart?')
-            self.reconnect()
+            # start() sees the connection drop and reconnects
+            LOGGER.error('Got lost connection message!!')
             return
 
         elif msg.MessageType() == RNET_MSG_TYPE.CONTROLLER_CONFIG:
@@ -343,7 +700,7 @@ class RSController(udi_interface.Node):
               process the blob to get zone names, source names,
               number of zones, number of sources, etc.
             """
-            LOGGER.debug('Got packet {} of {}'.format(msg.PacketNumber(), msg.PacketCount()))
+            RNETLOG.debug('Got packet %d of %d', msg.PacketNumber(), msg.PacketCount())
             if msg.PacketNumber() == 0:  # first packet
                 self.raw_config = bytearray(0)
             
@@ -357,15 +714,15 @@ class RSController(udi_interface.Node):
 
         if zone >= 0x70:
             if zone == 127:
-                LOGGER.debug('Message target zone (0x7F - reserved)')
+                RNETLOG.debug('Message target zone (0x7F - reserved)')
             elif zone == 126:
-                LOGGER.debug('Message target zone (0x7E - controller link)')
+                RNETLOG.debug('Message target zone (0x7E - controller link)')
             elif zone == 125:
-                LOGGER.debug('Message target zone (0x7D - peripheral device)')
+                RNETLOG.debug('Message target zone (0x7D - peripheral device)')
             elif zone == 124:
-                LOGGER.debug('Message target zone (0x7C - trace)')
+                RNETLOG.debug('Message target zone (0x7C - trace)')
             else:
-                LOGGER.debug('Message target not a zone: ' + str(zone))
+                RNETLOG.debug('Message target not a zone: %s', zone)
             return
 
         if ctrl > 6:
@@ -395,6 +752,7 @@ class RSController(udi_interface.Node):
         zone += 1
         ctrl += 1
 
+        zone_node = None
         try:
             zone_node = self.poly.getNode(zone_addr)
             if zone_node == None:
@@ -405,9 +763,15 @@ class RSController(udi_interface.Node):
         except Exception as e:
             LOGGER.error('Failed to get node for zone {} -- {}'.format(zone_addr, e))
 
+        if msg.MessageType() in ZONE_STATUS:
+            if self.recorder.enabled:
+                self.recorder.status(zone_addr, msg.MessageType().name)
+            if zone_node is not None:
+                zone_node.live()
+
         if msg.MessageType() == RNET_MSG_TYPE.ZONE_STATE:
             # It looks like the zone state is in the TS field. 
-            LOGGER.debug(' -> Zone %d state = 0x%x' % (msg.TargetZone(), int(msg.MessageData())))
+            RNETLOG.debug(' -> Zone %d state = 0x%x', msg.TargetZone(), int(msg.MessageData()))
             #zone_addr = 'zone_' + str(msg.TargetZone() + 1)
             try:
                 zone_node.set_power(int(msg.MessageData()))
@@ -415,30 +779,30 @@ class RSController(udi_interface.Node):
                 LOGGER.error('Failed to call set_power() for zone {} -- {}'.format(zone_addr, e))
             #self.poly.getNode(zone_addr).set_power(int(msg.MessageData()))
         elif msg.MessageType() == RNET_MSG_TYPE.ZONE_SOURCE:
-            LOGGER.debug(' -> Zone %d source = 0x%x' % (zone, int(msg.MessageData())))
+            RNETLOG.debug(' -> Zone %d source = 0x%x', zone, int(msg.MessageData()))
             self.poly.getNode(zone_addr).set_source(int(msg.MessageData())+1)
         elif msg.MessageType() == RNET_MSG_TYPE.ZONE_VOLUME:
             # See what we get here.  Then try to update the actual node
             # for the zone
-            LOGGER.debug(' -> Zone %d volume = 0x%x' % (zone, msg.MessageData()))
+            RNETLOG.debug(' -> Zone %d volume = 0x%x', zone, msg.MessageData())
             self.poly.getNode(zone_addr).set_volume(int(msg.MessageData()))
         elif msg.MessageType() == RNET_MSG_TYPE.ZONE_BASS:
-            LOGGER.debug(' -> Zone %d bass = 0x%x' % (zone, msg.MessageData()))
+            RNETLOG.debug(' -> Zone %d bass = 0x%x', zone, msg.MessageData())
             self.poly.getNode(zone_addr).set_bass(int(msg.MessageData()))
         elif msg.MessageType() == RNET_MSG_TYPE.ZONE_TREBLE:
-            LOGGER.debug(' -> Zone %d treble = 0x%x' % (zone, msg.MessageData()))
+            RNETLOG.debug(' -> Zone %d treble = 0x%x', zone, msg.MessageData())
             self.poly.getNode(zone_addr).set_treble(int(msg.MessageData()))
         elif msg.MessageType() == RNET_MSG_TYPE.ZONE_BALANCE:
-            LOGGER.debug(' -> Zone %d balance = 0x%x' % (zone, msg.MessageData()))
+            RNETLOG.debug(' -> Zone %d balance = 0x%x', zone, msg.MessageData())
             self.poly.getNode(zone_addr).set_balance(int(msg.MessageData()))
         elif msg.MessageType() == RNET_MSG_TYPE.ZONE_LOUDNESS:
-            LOGGER.debug(' -> Zone %d loudness = 0x%x' % (zone, msg.MessageData()))
+            RNETLOG.debug(' -> Zone %d loudness = 0x%x', zone, msg.MessageData())
             self.poly.getNode(zone_addr).set_loudness(int(msg.MessageData()))
         elif msg.MessageType() == RNET_MSG_TYPE.ZONE_PARTY_MODE:
-            LOGGER.debug(' -> Zone %d party mode = 0x%x' % (zone, msg.MessageData()))
+            RNETLOG.debug(' -> Zone %d party mode = 0x%x', zone, msg.MessageData())
             self.poly.getNode(zone_addr).set_party_mode(int(msg.MessageData()))
         elif msg.MessageType() == RNET_MSG_TYPE.ZONE_DO_NOT_DISTURB:
-            LOGGER.debug(' -> Zone %d do not disturb = 0x%x' % (zone, msg.MessageData()))
+            RNETLOG.debug(' -> Zone %d do not disturb = 0x%x', zone, msg.MessageData())
             self.poly.getNode(zone_addr).set_dnd(int(msg.MessageData()))
         elif msg.MessageType() == RNET_MSG_TYPE.UPDATE_SOURCE_SELECTION:
             # We can use this to check for sources going on/off (or really
@@ -451,7 +815,7 @@ class RSController(udi_interface.Node):
             # sources to worry about.  Now that we support multiple
             # controllers and each can have multiple sources, this
             # doesn't really work anymore.
-            LOGGER.debug(' -> Update Zone source 0x%x 0x%x' % (msg.MessageData()[0], msg.MessageData()[1]))
+            RNETLOG.debug(' -> Update Zone source 0x%x 0x%x', msg.MessageData()[0], msg.MessageData()[1])
 
             # ns is the current state of all sources
             # ss is the sources that have changed states
@@ -570,17 +934,11 @@ class RSController(udi_interface.Node):
         # which means we need a node driver that holds the last keypress
         # value.
         elif msg.MessageType() == RNET_MSG_TYPE.ALL_ZONE_INFO:
-            LOGGER.info('All zone info for ' + zone_addr)
-            LOGGER.debug('   ' + ' '.join('{:02x}'.format(x) for x in msg.MessageData()))
-            LOGGER.info('   power state = ' + str(msg.MessageData()[0]))
-            LOGGER.info('   source      = ' + str(msg.MessageData()[1] + 1))
-            LOGGER.info('   volume      = ' + str(msg.MessageData()[2]))
-            LOGGER.info('   bass        = ' + str(msg.MessageData()[3]))
-            LOGGER.info('   treble      = ' + str(msg.MessageData()[4]))
-            LOGGER.info('   loudness    = ' + str(msg.MessageData()[5]))
-            LOGGER.info('   balance     = ' + str(msg.MessageData()[6]))
-            LOGGER.info('   party       = ' + str(msg.MessageData()[7]))
-            LOGGER.info('   dnd         = ' + str(msg.MessageData()[8]))
+            # One line, this comes in for every zone on each poll
+            d = msg.MessageData()
+            RNETLOG.debug('All zone info for %s [%s]: power=%d source=%d volume=%d bass=%d treble=%d '
+                          'loudness=%d balance=%d party=%d dnd=%d', zone_addr, Hex(d),
+                          d[0], d[1] + 1, d[2], d[3], d[4], d[5], d[6], d[7], d[8])
 
             self.poly.getNode(zone_addr).set_power(int(msg.MessageData()[0]))
             self.poly.getNode(zone_addr).set_source(int(msg.MessageData()[1])+1)
@@ -645,14 +1003,14 @@ class RSController(udi_interface.Node):
             if self.rnet.protocol == 'RNET':
                 self.rnet.get_info(ctrl, zone, 0x401)
         elif msg.MessageType() == RNET_MSG_TYPE.KEYPAD_NEXT:
-            LOGGER.debug(' -> Keypad next')
+            RNETLOG.debug(' -> Keypad next')
         elif msg.MessageType() == RNET_MSG_TYPE.HANDSHAKE:
-            LOGGER.debug(' -> Send Acknowledged')
+            RNETLOG.debug(' -> Send Acknowledged')
         elif msg.MessageType() == RNET_MSG_TYPE.UNKNOWN_SET:
             # don't think we really care about these
-            LOGGER.debug('US -> ' + ' '.join('{:02x}'.format(x) for x in msg.MessageRaw()))
+            RNETLOG.debug('US -> %s', Hex(msg.MessageRaw()))
         else:
-            LOGGER.debug(' -> TODO: message id ' + str(msg.MessageType().name) + ' not yet implemented.')
+            RNETLOG.debug(' -> TODO: message id %s not yet implemented.', msg.MessageType().name)
 
     def RIOProcessCommand(self, msg):
         # S successful response
@@ -664,11 +1022,11 @@ class RSController(udi_interface.Node):
         #    EX: S C[1].Z[1].name --> get zone 1 name  controller range 1-6, zone range 1-6?
         if msg != 'S':  #Ignore a 'S' message with optional data
             if msg[2:4] != 'S[':  # system or source message???
-                LOGGER.debug('From Russound: ' + msg)
+                RIOLOG.debug('From Russound: %s', msg)
             if msg[0] == 'N' or msg[0] == 'S':
                 if msg[2] == 'C' and msg[6] == '.' and msg[8] != '[': # controller info C[c].xxxx
                     curValue = msg[msg.find('=')+2:-1]   # value comes after the '=' size
-                    LOGGER.debug('controller info: {}, value = {}'.format(msg, curValue))
+                    RIOLOG.debug('controller info: %s, value = %s', msg, curValue)
                     self.rnet.IncomingQueue(curValue)
                 if msg[2] == 'C' and msg[10] == ']' and msg[7] == 'Z':  # controller/zone C[c][z]
                     curZone = 'zone_' + msg[4] + '_' + msg[9]  # msg[4] = controller #, msg[9] = zone #
@@ -677,7 +1035,11 @@ class RSController(udi_interface.Node):
                     curValue = msg[msg.find('=')+2:-1]   # value comes after the '=' size
 
                     self.rnet.IncomingQueue(curValue)
-                    LOGGER.debug('zone = {}, command = {}, value = {}'.format(curZone, curCommand, curValue))
+                    RIOLOG.debug('zone = %s, command = %s, value = %s', curZone, curCommand, curValue)
+                    if self.recorder.enabled:
+                        self.recorder.status(curZone, curCommand)
+                    if curCommand != 'name' and self.poly.getNode(curZone) is not None:
+                        self.poly.getNode(curZone).live()
 
                     #Change ON/OFF to 1/0
                     if curValue == 'OFF' : 
@@ -733,11 +1095,11 @@ class RSController(udi_interface.Node):
                     elif curCommand == 'doNotDisturb' : #do not disturb (off/on/slave)
                         self.poly.getNode(curZone).set_dnd(curValue)
                     elif curCommand == 'enabled' : # True/False
-                        LOGGER.debug('zone {} is enabled? {}'.format(curZone, curValue))
+                        RIOLOG.debug('zone %s is enabled? %s', curZone, curValue)
                     elif curCommand == 'sleepTimeDefault' : # 15 minutes
-                        LOGGER.debug('zone {} default sleep time {} minutes'.format(curZone, curValue))
+                        RIOLOG.debug('zone %s default sleep time %s minutes', curZone, curValue)
                     elif curCommand == 'sleepTimeRemaining' : # 0 to 60 minutes
-                        LOGGER.debug('zone {} remaining sleep time {} minutes'.format(curZone, curValue))
+                        RIOLOG.debug('zone %s remaining sleep time %s minutes', curZone, curValue)
                     '''
                     elif curCommand == 'favorite' : # [f].valid  in use (true/false)
                     elif curCommand == 'favorite' : # [f].name  name of favorite
@@ -754,7 +1116,7 @@ class RSController(udi_interface.Node):
                     curCommand = msg[msg.find('.')+1: msg.find('=')]  # msg[7] start of command, 
                     curValue = msg[msg.find('=')+2:-1]   # value comes after the '=' size
                     self.rnet.IncomingQueue(curValue)
-                    LOGGER.debug('source = {}, command = {}, value = {}'.format(curSource, curCommand, curValue))
+                    RIOLOG.debug('source = %s, command = %s, value = %s', curSource, curCommand, curValue)
 
                     if curCommand == 'name' and msg[0] == 'S':  # name of source
                         if curValue == '':
@@ -763,7 +1125,7 @@ class RSController(udi_interface.Node):
                             self.ctrl_config['sourceInfo']['sources'].append(curValue)
                             self.ctrl_config['sourceInfo']['source_count'] += 1
                     elif curCommand == 'type': # type of source
-                        LOGGER.debug('source {} is {}'.format(curSource, curValue))
+                        RIOLOG.debug('source %s is %s', curSource, curValue)
                     '''
                     elif curCommand == 'channel':
                     elif curCommand == 'coverArtURL':
@@ -797,6 +1159,9 @@ class RSController(udi_interface.Node):
             'DISCOVER': discover,
             'DFON': all_zones_on,
             'DFOF': all_zones_off,
+            'DUMPTRACE': dump_trace,
+            'PROFILE_START': profile_start,
+            'PROFILE_STOP': profile_stop,
             }
 
     # For this node server, all of the info is available in the single
@@ -805,5 +1170,7 @@ class RSController(udi_interface.Node):
             {'driver': 'ST', 'value': 0, 'uom': 2,   'name': 'Connection Status'},    # Russound connection status
             {'driver': 'DON', 'value': 0, 'uom': 25,   'name': 'Last Source Activated'},    # Russound connection status
             {'driver': 'DOF', 'value': 0, 'uom': 25,   'name': 'Last Source Deactivated'},    # Russound connection status
+            {'driver': 'GV10', 'value': 0, 'uom': 51,  'name': 'Connection Quality'},    # percent, see Metrics.rates()
+            {'driver': 'GV11', 'value': 0, 'uom': 56,  'name': 'Messages per Minute'},   # to and from the controller
             ]
 
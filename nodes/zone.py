@@ -2,16 +2,47 @@
 # 
 
 import udi_interface
+import collections
 import json
-import time
+import threading
 import datetime
 import russound
+import russound_main
+import clock
+import protolog
+import stateapi
+import events
 
 LOGGER = udi_interface.LOGGER
+ZONELOG = protolog.get('zone')
+
+# RNET request that reads back each value a command can set
+READ_BACK = {
+        'GV0': 0x402, 'SVOL': 0x401, 'GV2': 0x501, 'GV3': 0x500, 'GV4': 0x503,
+        'GV5': 0x502, 'GV6': 0x506, 'GV7': 0x507, 'GV8': 0x505,
+        }
+
+
+'''
+A value set by a command before the controller confirmed it.  version
+is the command's, stale is how many answers to read-backs asked for
+before the command are still to come (they have the old value) and
+previous is the value to go back to if it's never confirmed.
+'''
+class Pending:
+    __slots__ = ('value', 'version', 'stale', 'previous')
+
+    def __init__(self, value, version, stale, previous):
+        self.value = value
+        self.version = version
+        self.stale = stale
+        self.previous = previous
 
 class Zone(udi_interface.Node):
     id = 'zone'
     power_state = False
+    PENDING_TIMEOUT = 5  # seconds a command's value waits to be confirmed
+    ANSWER_TIMEOUT = 5   # seconds a read-back is waited on
     """
     What makes up a zone? 
         Power
@@ -36,6 +67,7 @@ class Zone(udi_interface.Node):
             {'driver': 'GV8', 'value': 0, 'uom': 25,  'name': 'Mute'},       # mute
             {'driver': 'GV9', 'value': 0, 'uom': 25,  'name': 'Page'},       # page
             {'driver': 'GV10', 'value': 0, 'uom': 25, 'name': 'Shared Source'},    # shared source
+            {'driver': 'GV11', 'value': 0, 'uom': 25, 'name': 'Values'},    # 0 restored, 1 live
             ]
 
     def __init__(self, polyglot, primary, address, name):
@@ -43,6 +75,16 @@ class Zone(udi_interface.Node):
         self.address = address
         self.rnet = None
         self.ready = False
+        self.clock = clock.default()
+        self.recorder = russound_main.FlightRecorder()  # the controller's, once discovered
+        self.state = None  # zonestate.StateStore, the controller's
+        self.history = None  # history.History, if it's on
+        self.provisional = True  # values aren't from the controller yet
+        self.revision = stateapi.revision()  # changes with the values
+        self.lock = threading.Lock()
+        self.pending = {}   # driver -> Pending
+        self.versions = {}  # driver -> version of the last command that set it
+        self.asked = {}     # driver -> deque of times read-backs were sent
         polyglot.subscribe(polyglot.POLL, self.poll)
 
 
@@ -77,67 +119,204 @@ class Zone(udi_interface.Node):
     def setRNET(self, rnet):
         self.rnet = rnet
 
+    def setDriver(self, driver, value, *args, **kwargs):
+        changed = self.getDriver(driver) != value
+        super(Zone, self).setDriver(driver, value, *args, **kwargs)
+        if changed:
+            self.revision = stateapi.revision()
+            if self.history is not None:
+                self.history.record(self.address, driver, value)
+            item = stateapi.zone_field(driver, value)
+            if item is not None:
+                events.BUS.publish('zone', controller=self.primary, zone=self.address, field=item[0], value=item[1],
+                                   pending=driver in self.pending)
+        if self.recorder.enabled:
+            self.recorder.driver(self.address, driver, value)
+        if self.state is not None and driver != 'GV11':
+            self.state.update(self.address, self.name, driver, value)
+
+    '''
+    Start out with the values saved last time.  Called before the node
+    is added, so Polyglot gets them with the node.
+    '''
+    def restore(self, values):
+        for d in self.drivers:
+            if d['driver'] in values and d['driver'] != 'GV11':
+                d['value'] = values[d['driver']]
+        self.power_state = bool(values.get('ST'))
+
+    # The controller has reported this zone, values are no longer restored
+    def live(self):
+        if self.provisional:
+            self.provisional = False
+            self.setDriver('GV11', 1, True, True, 25)
+            # history may have been stopped since it last heard from us
+            if self.history is not None:
+                for d in self.drivers:
+                    self.history.record(self.address, d['driver'], d['value'])
+
     def Ready(self):
         self.ready = True
 
+    '''
+    A command set driver to value.  Show it right away, as pending,
+    until the controller confirms it.  It goes back to the last
+    confirmed value if that doesn't happen within PENDING_TIMEOUT.
+    '''
+    def propose(self, driver, value, uom):
+        with self.lock:
+            version = self.versions.get(driver, 0) + 1
+            self.versions[driver] = version
+            p = self.pending.get(driver)
+            previous = p.previous if p is not None else self.getDriver(driver)
+            self.pending[driver] = Pending(value, version, self.__unanswered(driver), previous)
+            self.setDriver(driver, value, True, True, uom)
+            self.revision = stateapi.revision()
+        self.clock.call_later(self.PENDING_TIMEOUT, self.expire, driver, version)
+
+    '''
+    The controller reported driver's value.  While a command's value is
+    pending, answers to read-backs sent before the command are ignored,
+    anything else settles it.
+    '''
+    def reported(self, driver, value, uom, force=False):
+        with self.lock:
+            self.__answered(driver)
+            p = self.pending.get(driver)
+            if p is not None:
+                if value != p.value and p.stale > 0:
+                    p.stale -= 1
+                    ZONELOG.debug('%s: %s=%s is from before command %d, ignored', self.address, driver, value, p.version)
+                    return
+                del self.pending[driver]
+            self.setDriver(driver, value, True, force, uom)
+        if p is not None and value == p.value:
+            self.settled(driver, value)
+
+    # The command that set driver (version) was never confirmed
+    def expire(self, driver, version):
+        with self.lock:
+            p = self.pending.get(driver)
+            if p is None or p.version != version:
+                return
+            del self.pending[driver]
+            LOGGER.warning('{}: {} = {} not confirmed, back to {}'.format(self.address, driver, p.value, p.previous))
+            self.setDriver(driver, p.previous, True, True)
+        if p.previous == p.value:
+            self.settled(driver, p.value)
+        self.read_back(driver)
+
+    # A pending value became a confirmed one without changing
+    def settled(self, driver, value):
+        self.revision = stateapi.revision()
+        item = stateapi.zone_field(driver, value)
+        if item is not None:
+            events.BUS.publish('zone', controller=self.primary, zone=self.address, field=item[0], value=item[1],
+                               pending=False)
+
+    # Ask the controller for driver's value, after delay seconds
+    def read_back(self, driver, delay=0):
+        if self.rnet is None or self.rnet.protocol != 'RNET' or driver not in READ_BACK:
+            return
+        if delay:
+            self.clock.call_later(delay, self.read_back, driver)
+            return
+        [blank, ctrl, zone] = self.address.split('_')
+        with self.lock:
+            self.asked.setdefault(driver, collections.deque()).append(self.clock.monotonic())
+        self.rnet.get_info(int(ctrl), int(zone) - 1, READ_BACK[driver])
+
+    # Read-backs of driver still to be answered.  Must hold lock.
+    def __unanswered(self, driver):
+        asked = self.asked.get(driver)
+        if not asked:
+            return 0
+        # ones that have waited this long were lost
+        while asked and self.clock.monotonic() - asked[0] > self.ANSWER_TIMEOUT:
+            asked.popleft()
+        return len(asked)
+
+    def __answered(self, driver):
+        if self.__unanswered(driver):
+            self.asked[driver].popleft()
+
     '''
     Called when the zone's keypad is used.  Send the keypress to the ISY
     '''
     def keypress(self, key):
-        LOGGER.debug('Sending ' + key + ' to ISY')
+        ZONELOG.debug('Sending %s to ISY', key)
+        if key in events.KEYS:
+            events.BUS.publish('keypad', controller=self.primary, zone=self.address, key=events.KEYS[key])
         # is this something the controller class has but the node class
         # doesn't? How can a node send a command?
         self.reportCmd(key, 0)
 
     def set_power(self, power):
-        self.setDriver('ST', power, True, True, 25)
+        self.reported('ST', power, 25, True)
         if power == 0:
             self.power_state = False
         else:
             self.power_state = True
 
+    # The set_ functions are for values reported by the controller
     def set_source(self, source):
-        self.setDriver('GV0', source-1, True, True, 25)
+        self.reported('GV0', source-1, 25, True)
 
     def set_volume(self, vol, force=False):
-        self.setDriver('SVOL', vol, True, force, 12)
+        self.reported('SVOL', vol, 12, force)
 
     def set_treble(self, vol, force=False):
         # display is -10 to +10
-        self.setDriver('GV2', vol - 10, True, force, 56)
+        self.reported('GV2', vol - 10, 56, force)
 
     def set_bass(self, vol, force=False):
         # display is -10 to +10
-        self.setDriver('GV3', vol - 10, True, force, 56)
+        self.reported('GV3', vol - 10, 56, force)
 
     def set_balance(self, vol, force=False):
-        self.setDriver('GV4', vol - 10, True, force, 56)
+        self.reported('GV4', vol - 10, 56, force)
 
     def set_loudness(self, toggle, force=False):
-        self.setDriver('GV5', toggle, True, force, 25)
+        self.reported('GV5', toggle, 25, force)
 
     def set_dnd(self, toggle, force=False):
-        self.setDriver('GV6', toggle, True, force, 25)
+        self.reported('GV6', toggle, 25, force)
 
     def set_mute(self, toggle):
-        self.setDriver('GV8', toggle, True, True, 25)
+        self.reported('GV8', toggle, 25, True)
 
     def set_page(self, toggle):
-        self.setDriver('GV9', toggle, True, True, 25)
+        self.reported('GV9', toggle, 25, True)
 
     def set_shared_source(self, toggle):
-        self.setDriver('GV10', toggle, True, True, 25)
+        self.reported('GV10', toggle, 25, True)
 
     def set_party_mode(self, toggle, force=False):
-        self.setDriver('GV7', toggle, True, force, 25)
+        self.reported('GV7', toggle, 25, force)
 
     def get_power(self):
         return self.power_state
 
     def process_cmd(self, cmd=None):
         # {'address': 'zone_1_2', 'cmd': 'VOLUME', 'value': '28', 'uom': '56', 'query': {}}
-
-        LOGGER.debug('ISY sent: ' + str(cmd))
+        if self.rnet.profiling is not None:
+            self.rnet.Profile('polyglot')
+        if not self.recorder.enabled:
+            return self.send_cmd(cmd)
+
+        # Trace the command through to the controller's answer
+        self.recorder.begin(self.address, cmd)
+        try:
+            self.send_cmd(cmd)
+        finally:
+            self.recorder.detach()
+
+    def send_cmd(self, cmd):
+        ZONELOG.debug('ISY sent: %s', cmd)
+        # Reading values back is scheduled on the clock instead of
+        # sleeping here, so the command returns right away.  For RNET the
+        # new value is shown at once, pending until the read-back
+        # confirms it (see propose()).
         if self.rnet.protocol == 'RNET':
             [blank, ctrl, zone] = cmd['address'].split('_')
             ctrl = int(ctrl)
@@ -149,59 +328,49 @@ class Zone(udi_interface.Node):
         if cmd['cmd'] == 'VOLUME':
             self.rnet.volume(ctrl, zone, int(cmd['value']))
             if self.rnet.protocol == 'RNET':
-                self.set_volume(int(cmd['value']), True)
+                self.propose('SVOL', int(cmd['value']), 12)
+                self.read_back('SVOL', 1)
         elif cmd['cmd'] == 'BASS':
             self.rnet.set_param(ctrl, zone, 0, int(cmd['value'])+10)
             if self.rnet.protocol == 'RNET':
-                self.set_bass(int(cmd['value'])+10, True)
-                time.sleep(1)
-                self.rnet.get_info(ctrl, zone, 0x500)
+                self.propose('GV3', int(cmd['value']), 56)
+                self.read_back('GV3', 1)
         elif cmd['cmd'] == 'TREBLE':
             self.rnet.set_param(ctrl, zone, 1, int(cmd['value'])+10)
             if self.rnet.protocol == 'RNET':
-                self.set_treble(int(cmd['value'])+10, True)
-                time.sleep(1)
-                self.rnet.get_info(ctrl, zone, 0x501)
+                self.propose('GV2', int(cmd['value']), 56)
+                self.read_back('GV2', 1)
         elif cmd['cmd'] == 'LOUDNESS':
             self.rnet.set_param(ctrl, zone, 2, int(cmd['value']))
             if self.rnet.protocol == 'RNET':
                 # The RNET controller will send an handshake acknowledge
-                # but nothing else.
-                # Once we send the the command, we either need to send
-                # a request to get the current value (and/or) call
-                # setDriver to update the status.
-                self.set_loudness(int(cmd['value']), True)
-                time.sleep(2)
-                self.rnet.get_info(ctrl, zone, 0x502)  # Get current loudness value
+                # but nothing else, so ask for the value.
+                self.propose('GV5', int(cmd['value']), 25)
+                self.read_back('GV5', 2)
         elif cmd['cmd'] == 'BALANCE':
             self.rnet.set_param(ctrl, zone, 3, int(cmd['value'])+10)
             if self.rnet.protocol == 'RNET':
-                self.set_balance(int(cmd['value'])+10, True)
-                time.sleep(1)
-                self.rnet.get_info(ctrl, zone, 0x503)
+                self.propose('GV4', int(cmd['value']), 56)
+                self.read_back('GV4', 1)
         elif cmd['cmd'] == 'MUTE':
             self.rnet.set_param(ctrl, zone, 5, int(cmd['value']))
             if self.rnet.protocol == 'RNET':
-                self.set_mute(int(cmd['value']))
-                time.sleep(1)
-                self.rnet.get_info(ctrl, zone, 0x505)
+                self.propose('GV8', int(cmd['value']), 25)
+                self.read_back('GV8', 1)
         elif cmd['cmd'] == 'DND':
             self.rnet.set_param(ctrl, zone, 6, int(cmd['value']))
             if self.rnet.protocol == 'RNET':
-                self.set_dnd(int(cmd['value']), True)
-                time.sleep(1)
-                self.rnet.get_info(ctrl, zone, 0x506)
+                self.propose('GV6', int(cmd['value']), 25)
+                self.read_back('GV6', 1)
         elif cmd['cmd'] == 'PARTY':
             self.rnet.set_param(ctrl, zone, 7, int(cmd['value']))
             if self.rnet.protocol == 'RNET':
-                self.set_party_mode(int(cmd['value']), True)
-                time.sleep(1)
-                self.rnet.get_info(ctrl, zone, 0x507)
+                self.propose('GV7', int(cmd['value']), 25)
+                self.read_back('GV7', 1)
         elif cmd['cmd'] == 'SOURCE':
             self.rnet.set_source(ctrl, zone, int(cmd['value']))
             if self.rnet.protocol == 'RNET':
-                time.sleep(1)
-                self.rnet.get_info(ctrl, zone, 0x402)
+                self.read_back('GV0', 1)
         elif cmd['cmd'] == 'DFON':
             self.rnet.set_state(ctrl, zone, 1)
         elif cmd['cmd'] == 'DFOF':
@@ -219,7 +388,7 @@ class Zone(udi_interface.Node):
             else:
                 self.rnet.set_param(ctrl, zone, 9, 0)
         elif cmd['cmd'] == 'GV14': # source toggle
-            LOGGER.error('toggle to next source, current source = ')
+            ZONELOG.debug('toggle to next source')
             self.rnet.send_event(ctrl, zone, 0x6b)
         elif cmd['cmd'] == 'GV15': # reverse
             self.rnet.send_event(ctrl, zone, 0x67)
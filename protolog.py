@@ -0,0 +1,125 @@
+#
+# Logging for the protocol code.
+#
+#  Message handling runs for everything the controller sends, so logging
+#  there has to cost next to nothing when it's turned off.
+#
+#    - Each subsystem has its own logger under the node server's logger,
+#      its level can be changed at any time with set_levels().  Levels
+#      that aren't set follow the node server's log level.
+#    - Messages pass %-style arguments, nothing is formatted unless the
+#      record is emitted.  Hex() defers hex dumps the same way.
+#    - limited() lets repetitive messages (frame dumps) through a few
+#      times per interval and says how many were left out.
+#
+#  Only the standard logging module is used, so the protocol modules
+#  (and the offline tools that import them) don't need udi_interface.
+
+import logging
+import threading
+import time
+
+# The node server's logger, the same one udi_interface.LOGGER is
+LOGGER = logging.getLogger('udi_interface')
+
+SUBSYSTEMS = {
+        'rnet': 'RNET framing, messages and commands',
+        'rio': 'RIO commands and replies',
+        'link': 'connections, heartbeats and transports',
+        'zone': 'zone node commands',
+        }
+
+
+def get(subsystem):
+    return LOGGER.getChild(subsystem)
+
+
+'''
+Hex dump of data, made only if the log record is actually written.
+'''
+class Hex:
+    __slots__ = ('data', 'sep')
+
+    def __init__(self, data, sep=' '):
+        self.data = data
+        self.sep = sep
+
+    def __str__(self):
+        if self.sep:
+            return bytes(self.data).hex(self.sep)
+        return bytes(self.data).hex()
+
+
+'''
+Lets burst messages for each key through every interval seconds.
+allow() returns None when the message should be dropped, otherwise
+how many were dropped since the last one that got through.
+'''
+class Limiter:
+    def __init__(self, burst=20, interval=10.0):
+        self.burst = burst
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.windows = {}  # key -> [start, allowed, dropped]
+
+    def allow(self, key):
+        now = time.monotonic()
+        with self.lock:
+            w = self.windows.get(key)
+            if w is None or now - w[0] >= self.interval:
+                dropped = w[2] if w is not None else 0
+                self.windows[key] = [now, 1, 0]
+                return dropped
+            if w[1] < self.burst:
+                w[1] += 1
+                return 0
+            w[2] += 1
+            return None
+
+
+FRAMES = Limiter()
+
+
+def limited(logger, level, key, msg, *args, limiter=FRAMES):
+    if not logger.isEnabledFor(level):
+        return
+    dropped = limiter.allow(key)
+    if dropped is None:
+        return
+    if dropped:
+        msg += ' (%d more not logged)'
+        args += (dropped,)
+    logger.log(level, msg, *args)
+
+
+'''
+Set subsystem log levels from "rnet=DEBUG, rio=INFO".  A subsystem
+that isn't listed goes back to following the node server's level.
+Returns a list of the entries that couldn't be used.
+'''
+def set_levels(spec):
+    levels = {}
+    bad = []
+    for item in (spec or '').replace(';', ',').split(','):
+        item = item.strip()
+        if item == '':
+            continue
+        (name, _, level) = item.partition('=')
+        name = name.strip().lower()
+        level = level.strip().upper()
+        if name not in SUBSYSTEMS:
+            bad.append(item)
+            continue
+        if level.isdigit():
+            levels[name] = int(level)
+        elif isinstance(logging.getLevelName(level), int):
+            levels[name] = logging.getLevelName(level)
+        else:
+            bad.append(item)
+
+    for name in SUBSYSTEMS:
+        level = levels.get(name, logging.NOTSET)
+        if get(name).level != level:
+            get(name).setLevel(level)
+            LOGGER.info('{} log level set to {}'.format(name, logging.getLevelName(level) if level else 'default'))
+    return bad
@@ -0,0 +1,280 @@
+#
+# Share the controller connection with other programs.
+#
+#  Serial-over-IP bridges take one TCP client, and that's the node
+#  server.  With a proxy port configured, other programs (commissioning
+#  tools, another automation system) connect to the node server instead
+#  and talk to the controller through its connection.
+#
+#    - What they send is only forwarded as complete messages: RNET
+#      frames with a good checksum, RIO lines.  Anything else is thrown
+#      away, so a confused client can't corrupt the node server's own
+#      traffic.  Messages go out through Connection.Write(), in turn with
+#      the node server's and paced like them.
+#    - Everything the controller sends is passed on to every client, as
+#      it arrives.  The node server processes it as usual, so it keeps
+#      track of changes made through the proxy.
+#    - Each client has its own send buffer.  One that doesn't keep up is
+#      disconnected rather than holding up the controller connection.
+#    - RIO answers every command in order.  Answers to a client's commands
+#      update the zones but are never taken as the answer to one of the
+#      node server's own (i.e. while it reads the configuration).
+#    - There's no authentication.  The proxy only listens on 127.0.0.1
+#      unless another address is configured.
+
+from udi_interface import LOGGER
+import collections
+import socket
+import threading
+import time
+import russound_main
+import protolog
+
+LINKLOG = protolog.get('link')
+
+RIO_LINE_MAX = 1024
+
+
+'''
+An RNET message as it goes on the wire.  frame is what RNETDecoder
+returns: start byte through checksum with inverted bytes restored.
+Bytes with the high bit set are sent inverted, after an 0xf1.
+'''
+def rnet_wire(frame):
+    wire = bytearray(b'\xf0')
+    for b in frame[1:-1]:
+        if b & 0x80:
+            wire.append(0xf1)
+            wire.append(0xff & ~b)
+        else:
+            wire.append(b)
+    wire.append(frame[-1])
+    wire.append(0xf7)
+    return bytes(wire)
+
+
+class RNETFramer:
+    def __init__(self):
+        self.decoder = russound_main.RNETDecoder()
+
+    # Complete, valid messages in data, and how many were thrown away
+    def feed(self, data):
+        corrupt = self.decoder.corrupt
+        frames = [rnet_wire(f) for f in self.decoder.feed(data)]
+        return (frames, self.decoder.corrupt - corrupt)
+
+
+class RIOFramer:
+    def __init__(self):
+        self.partial = b''
+
+    def feed(self, data):
+        lines = (self.partial + data).replace(b'\n', b'\r').split(b'\r')
+        self.partial = lines.pop()
+        bad = 0
+        if len(self.partial) > RIO_LINE_MAX:
+            self.partial = b''
+            bad += 1
+        frames = []
+        for line in lines:
+            line = line.strip()
+            if line == b'':
+                continue
+            if len(line) > RIO_LINE_MAX or not all(0x20 <= b < 0x7f for b in line):
+                bad += 1
+                continue
+            frames.append(line + b'\r')
+        return (frames, bad)
+
+
+class ProxyClient:
+    SEND_MAX = 256 * 1024  # bytes waiting to go to the client
+
+    def __init__(self, proxy, sock, address):
+        self.proxy = proxy
+        self.sock = sock
+        self.address = '{}:{}'.format(*address[:2])
+        self.out = collections.deque()
+        self.queued = 0
+        self.cond = threading.Condition()
+        self.closed = False
+
+    def start(self):
+        for (target, name) in ((self.__reader, 'reader'), (self.__writer, 'writer')):
+            t = threading.Thread(target=target, name='proxy-{}-{}'.format(self.address, name))
+            t.daemon = True
+            t.start()
+
+    # Queue data from the controller, never blocks
+    def put(self, data):
+        with self.cond:
+            if self.closed:
+                return
+            if self.queued + len(data) > self.SEND_MAX:
+                LOGGER.warning('Proxy client {} is not keeping up, disconnecting it'.format(self.address))
+                self.proxy.metrics.inc('proxy_messages_total', 'slow_client')
+                self.closed = True
+            else:
+                self.out.append(data)
+                self.queued += len(data)
+            self.cond.notify()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def __writer(self):
+        try:
+            while True:
+                with self.cond:
+                    while not self.out and not self.closed:
+                        self.cond.wait()
+                    if self.closed:
+                        break
+                    data = b''.join(self.out)
+                    self.out.clear()
+                    self.queued = 0
+                self.sock.sendall(data)
+        except OSError as e:
+            LINKLOG.debug('Proxy client %s: %s', self.address, e)
+        self.close()
+
+    def __reader(self):
+        framer = self.proxy.framer()
+        try:
+            while not self.closed:
+                data = self.sock.recv(4096)
+                if data == b'':
+                    break
+                (frames, bad) = framer.feed(data)
+                if bad:
+                    self.proxy.metrics.inc('proxy_messages_total', 'invalid', bad)
+                for frame in frames:
+                    self.proxy.forward(self, frame)
+        except OSError as e:
+            LINKLOG.debug('Proxy client %s: %s', self.address, e)
+        self.close()
+        self.proxy.disconnected(self)
+        self.sock.close()
+
+
+'''
+Listens on port for clients of the controller connection.  attach()
+points it at the controller's current connection, which calls
+broadcast() with everything it reads.  start() raises OSError if the
+port can't be opened.
+'''
+class LinkProxy:
+    CLIENTS_MAX = 8
+    BUSY_WAIT = 0.01  # seconds between checks while the connection is busy
+
+    def __init__(self, port, name, host='127.0.0.1'):
+        self.port = int(port)
+        self.name = name
+        self.host = host
+        self.connection = None
+        self.metrics = russound_main.Metrics()
+        self.clients = set()
+        self.lock = threading.Lock()
+        self.listener = None
+
+    def attach(self, connection):
+        self.connection = connection
+        self.metrics = connection.metrics
+        connection.proxy = self
+
+    def framer(self):
+        if self.connection is not None and self.connection.protocol == 'RIO':
+            return RIOFramer()
+        return RNETFramer()
+
+    def start(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind((self.host, self.port))
+            sock.listen(self.CLIENTS_MAX)
+        except OSError:
+            sock.close()
+            raise
+        self.listener = sock
+        t = threading.Thread(target=self.__accept, name='proxy-{}'.format(self.port))
+        t.daemon = True
+        t.start()
+        LOGGER.info('{} proxy listening on {}:{}'.format(self.name, self.host or '*', self.port))
+
+    def stop(self):
+        if self.listener is not None:
+            try:
+                self.listener.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.listener.close()
+            self.listener = None
+        with self.lock:
+            clients = list(self.clients)
+            self.clients.clear()
+        for client in clients:
+            client.close()
+        self.metrics.set('proxy_clients', 0)
+        LOGGER.info('{} proxy on port {} stopped'.format(self.name, self.port))
+
+    def __accept(self):
+        listener = self.listener
+        while self.listener is listener:
+            try:
+                (sock, address) = listener.accept()
+            except OSError:
+                break
+            with self.lock:
+                if len(self.clients) >= self.CLIENTS_MAX:
+                    LOGGER.warning('{} proxy: too many clients, refusing {}'.format(self.name, address[0]))
+                    sock.close()
+                    continue
+                russound_main.tune_tcp_socket(sock)
+                client = ProxyClient(self, sock, address)
+                self.clients.add(client)
+                count = len(self.clients)
+            self.metrics.set('proxy_clients', count)
+            LOGGER.info('{} proxy: client {} connected'.format(self.name, client.address))
+            client.start()
+
+    def disconnected(self, client):
+        with self.lock:
+            self.clients.discard(client)
+            count = len(self.clients)
+        self.metrics.set('proxy_clients', count)
+        LOGGER.info('{} proxy: client {} disconnected'.format(self.name, client.address))
+
+    # A complete message from a client, send it to the controller.  Waits
+    # while the controller is behind, so a client sending faster than it
+    # answers is slowed down rather than having its messages dropped.
+    def forward(self, client, frame):
+        connection = self.connection
+        while connection is not None and connection.connected and connection.Busy() and not client.closed:
+            time.sleep(self.BUSY_WAIT)
+        if connection is None or not connection.connected:
+            self.metrics.inc('proxy_messages_total', 'not_connected')
+            return
+        LINKLOG.debug('Proxy client %s: %s', client.address, protolog.Hex(frame))
+        try:
+            connection.Write(frame, proxied=True)
+            self.metrics.inc('proxy_messages_total', 'forwarded')
+        except OSError as e:
+            LOGGER.warning('{} proxy: unable to forward from {}: {}'.format(self.name, client.address, e))
+            self.metrics.inc('proxy_messages_total', 'not_connected')
+
+    # Data from the controller, called on the connection's reader thread
+    def broadcast(self, data):
+        if not self.clients:
+            return
+        with self.lock:
+            clients = list(self.clients)
+        data = bytes(data)
+        for client in clients:
+            client.put(data)
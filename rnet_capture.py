@@ -0,0 +1,285 @@
+#
+# Russound traffic capture and replay.
+#
+#  Record the raw bytes going to and coming from a controller
+#  Read captures back and replay them through the message handlers
+#
+# A capture file starts with a 16 byte header
+#
+#   magic    4 bytes  b'RCAP'
+#   version  1 byte
+#   protocol 1 byte   0 = RNET, 1 = RIO
+#   reserved 2 bytes
+#   started  8 bytes  wall clock time the file was opened (double)
+#
+# followed by records
+#
+#   time      8 bytes  wall clock time in nanoseconds
+#   direction 1 byte   0 = from the device, 1 = to the device
+#   length    4 bytes
+#   data      length bytes, exactly as read from or written to the transport
+#
+# All values are little endian.  A record that was only partly written
+# (power loss, crash) is ignored by the reader.
+
+import os
+import mmap
+import time
+import struct
+import threading
+
+MAGIC = b'RCAP'
+VERSION = 1
+HEADER = struct.Struct('<4sBBHd')
+RECORD = struct.Struct('<qBI')
+
+RECV = 0
+SENT = 1
+
+PROTOCOLS = ['RNET', 'RIO']
+
+
+'''
+Write a capture, rotating to a new file once it reaches max_bytes.  Old
+files are kept as name.1, name.2, ... up to backups, the same way the
+logging RotatingFileHandler does it.  Safe to call from several threads.
+'''
+class CaptureWriter:
+    def __init__(self, path, protocol, max_bytes=10*1024*1024, backups=5):
+        self.path = path
+        self.protocol = PROTOCOLS.index(protocol.upper())
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.lock = threading.Lock()
+        self.records = 0
+        self.file = None
+        self.size = 0
+        self.__open()
+
+    def __open(self):
+        directory = os.path.dirname(self.path)
+        if directory != '':
+            os.makedirs(directory, exist_ok=True)
+        self.file = open(self.path, 'wb')
+        self.file.write(HEADER.pack(MAGIC, VERSION, self.protocol, 0, time.time()))
+        self.file.flush()
+        self.size = HEADER.size
+
+    def __rotate(self):
+        self.file.close()
+        for i in range(self.backups - 1, 0, -1):
+            src = '{}.{}'.format(self.path, i)
+            if os.path.exists(src):
+                os.replace(src, '{}.{}'.format(self.path, i + 1))
+        if self.backups > 0:
+            os.replace(self.path, self.path + '.1')
+        self.__open()
+
+    # One write per record so a crash leaves at most one partial record
+    def record(self, direction, data):
+        rec = RECORD.pack(time.time_ns(), direction, len(data)) + bytes(data)
+        with self.lock:
+            if self.file is None:
+                return
+            if self.size + len(rec) > self.max_bytes and self.size > HEADER.size:
+                self.__rotate()
+            self.file.write(rec)
+            self.file.flush()
+            self.size += len(rec)
+            self.records += 1
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+'''
+Read a capture through mmap so large files can be walked without
+reading them into memory.  Record data is returned as memoryview slices
+of the mapping, copy them (bytes()) if they need to outlive the reader.
+'''
+class CaptureReader:
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        size = os.fstat(self.file.fileno()).st_size
+        if size < HEADER.size:
+            self.file.close()
+            raise ValueError('{} is not a capture file'.format(path))
+
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, protocol, _, started) = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or version != VERSION or protocol >= len(PROTOCOLS):
+            self.close()
+            raise ValueError('{} is not a capture file'.format(path))
+        self.protocol = PROTOCOLS[protocol]
+        self.started = started
+        self.view = memoryview(self.map)
+
+    # Generator returning (time in ns, direction, data)
+    def records(self, direction=None):
+        view = self.view
+        end = len(view)
+        idx = HEADER.size
+        unpack = RECORD.unpack_from
+        rsize = RECORD.size
+        while idx + rsize <= end:
+            (ts, d, length) = unpack(view, idx)
+            idx += rsize
+            if idx + length > end:
+                break  # partial record
+            if direction is None or d == direction:
+                yield (ts, d, view[idx:idx + length])
+            idx += length
+
+    # Split the data back into messages: RNET frames (as produced by
+    # RNETDecoder) or RIO lines.  Returns (time in ns, direction, message)
+    def messages(self, direction=None):
+        if self.protocol == 'RNET':
+            from russound_main import RNETDecoder
+            decoders = [RNETDecoder(), RNETDecoder()]
+            for (ts, d, data) in self.records(direction):
+                for frame in decoders[d].feed(data):
+                    yield (ts, d, frame)
+        else:
+            partial = [b'', b'']
+            for (ts, d, data) in self.records(direction):
+                lines = (partial[d] + bytes(data)).split(b'\n')
+                partial[d] = lines.pop()
+                for line in lines:
+                    line = line.rstrip(b'\r')
+                    if line != b'':
+                        yield (ts, d, line.decode(errors='replace'))
+
+    def stats(self):
+        counts = [0, 0]
+        octets = [0, 0]
+        first = last = None
+        for (ts, d, data) in self.records():
+            counts[d] += 1
+            octets[d] += len(data)
+            if first is None:
+                first = ts
+            last = ts
+        return {
+                'protocol': self.protocol,
+                'records_in': counts[RECV], 'records_out': counts[SENT],
+                'bytes_in': octets[RECV], 'bytes_out': octets[SENT],
+                'seconds': 0 if first is None else (last - first) / 1e9,
+                }
+
+    def close(self):
+        if hasattr(self, 'view'):
+            self.view.release()
+        if hasattr(self, 'map'):
+            self.map.close()
+        self.file.close()
+
+
+'''
+A Transport that plays back what the device sent in a capture.  recv()
+returns the received records, spaced out in time as they were captured
+scaled by speed.  A speed of 0 plays the capture as fast as possible.
+Anything sent is counted and thrown away.
+'''
+class ReplayTransport:
+    push = False
+    baud = 0
+
+    def __init__(self, path, speed=1.0):
+        self.path = path
+        self.speed = speed
+        self.receiver = None
+        self.reader = None
+        self.records = None
+        self.finished = None   # called once the capture has been played
+        self.sent = 0
+        self.played = 0
+        self.closed = False
+
+    def open(self):
+        self.reader = CaptureReader(self.path)
+        self.records = self.reader.records(RECV)
+        self.closed = False
+        self.start = None
+
+    def recv(self, size):
+        if self.closed:
+            return b''
+        try:
+            (ts, d, data) = next(self.records)
+        except StopIteration:
+            if self.finished is not None:
+                self.finished()
+            return b''
+
+        if self.speed > 0:
+            now = time.monotonic()
+            if self.start is None:
+                self.start = (now, ts)
+            due = self.start[0] + (ts - self.start[1]) / 1e9 / self.speed
+            if due > now:
+                time.sleep(due - now)
+        self.played += 1
+        return bytes(data)
+
+    def send(self, data):
+        self.sent += 1
+
+    def close(self):
+        self.closed = True
+
+    def __str__(self):
+        return 'replay of {}'.format(self.path)
+
+
+'''
+Feed a capture back through a message handler, for example
+RSController.RNETProcessCommand or RIOProcessCommand, using the same
+connection code that handled the live traffic.  Returns the number of
+records played and how long it took.
+'''
+def replay(path, processCommand, speed=1.0):
+    import russound_main
+
+    reader = CaptureReader(path)
+    protocol = reader.protocol
+    reader.close()
+
+    transport = ReplayTransport(path, speed)
+    if protocol == 'RNET':
+        conn = russound_main.RNETConnection(path, 0, False, transport=transport)
+    else:
+        conn = russound_main.RIOConnection(path, 0, False, transport=transport)
+    transport.finished = conn.Drop
+
+    started = time.monotonic()
+    conn.Connect()
+    conn.MessageLoop(processCommand)
+    elapsed = time.monotonic() - started
+    transport.reader.close()
+    return (transport.played, elapsed)
+
+
+if __name__ == '__main__':
+    import sys
+
+    if len(sys.argv) < 3 or sys.argv[1] not in ('dump', 'stats'):
+        print('usage: {} dump|stats capture_file'.format(sys.argv[0]))
+        sys.exit(1)
+
+    reader = CaptureReader(sys.argv[2])
+    if sys.argv[1] == 'stats':
+        print(reader.stats())
+    else:
+        for (ts, d, msg) in reader.messages():
+            stamp = time.strftime('%H:%M:%S', time.localtime(ts // 1000000000))
+            stamp += '.{:06d}'.format((ts % 1000000000) // 1000)
+            if isinstance(msg, str):
+                text = msg
+            else:
+                text = ' '.join('{:02x}'.format(x) for x in msg)
+            print('{} {} {}'.format(stamp, '<' if d == RECV else '>', text))
+    reader.close()
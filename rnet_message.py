@@ -5,8 +5,9 @@ message syntax.
 
 import logging
 from enum import Enum
+import protolog
 
-LOGGER = logging.getLogger()
+LOGGER = protolog.get('rnet')
 
 #  RNET_MSG_TYPE is really message ID
 class RNET_MSG_TYPE(Enum):
@@ -202,7 +203,7 @@ class RNetMessage():
             # FIXME: We were using EventTS for state.  that seems wrong
             self.data = message[1:16]
             self.data = event[1] # ?????  what's in Event[2] then?
-            LOGGER.error('Event: ZONE_STATE: data = {}, ts= {}'.format(event[2], event[1]))
+            LOGGER.debug('Event: ZONE_STATE: data = %s, ts= %s', event[2], event[1])
         elif event[0] == 0xDD: # all zone on/of
             self.message_id = RNET_MSG_TYPE.ALL_ZONE_STATE
             self.data = message[1:16]
@@ -226,7 +227,7 @@ class RNetMessage():
             self.message_id = RNET_MSG_TYPE.KEYPAD_SETUP
         elif event[0] == 0x65:
             self.message_id = RNET_MSG_TYPE.UNKNOWN_EVENT
-            LOGGER.error('UNKNOWN event ID = {} timestamp = {} data= {}'.format(event[0], event[1], event[2]))
+            LOGGER.debug('UNKNOWN event ID = %s timestamp = %s data= %s', event[0], event[1], event[2])
             self.data = event[2]
         elif event[0] == 0x67:
             self.message_id = RNET_MSG_TYPE.KEYPAD_PREVIOUS
@@ -261,7 +262,7 @@ class RNetMessage():
             self.message_id = RNET_MSG_TYPE.KEYPAD_VOL_DOWN
         else:
             self.message_id = RNET_MSG_TYPE.UNKNOWN_EVENT
-            LOGGER.error('UNKNOWN event ID = {} timestamp = {} data= {}'.format(event[0], event[1], event[2]))
+            LOGGER.debug('UNKNOWN event ID = %s timestamp = %s data= %s', event[0], event[1], event[2])
 
 
     def parse_set_data(self, message):
@@ -293,7 +294,7 @@ class RNetMessage():
         elif self.message_id == RNET_MSG_TYPE.ZONE_SOURCE:
             self.data = message[20]
         elif self.message_id == RNET_MSG_TYPE.ZONE_VOLUME:
-            LOGGER.error('SetData: zone volume: {}'.format(message))
+            LOGGER.debug('SetData: zone volume: %s', protolog.Hex(message))
             self.data = message[20]
         elif self.message_id == RNET_MSG_TYPE.ZONE_BASS:
             self.data = message[21]
@@ -323,7 +324,7 @@ class RNetMessage():
             #    # again do nothing
             self.message_id = RNET_MSG_TYPE.DISPLAY_FEEDBACK
         elif self.message_id == RNET_MSG_TYPE.EVENT:
-            LOGGER.error('Standard event')
+            LOGGER.debug('Standard event')
             self.data = message[20]
         elif self.message_id == RNET_MSG_TYPE.CONTROLLER_CONFIG:
             (pkc_cnt, pkc_num, dlen, data) = self.decode_packet(message, s_idx)
@@ -357,13 +358,12 @@ class RNetMessage():
             # value2 is source number
             self.message_id = RNET_MSG_TYPE.DISPLAY_ZONE_SOURCE
             self.data = value1
-            try:
-                LOGGER.error('Render: source[{}] = {}'.format(self.data, SOURCE_NAMES[value1]))
-            except:
-                LOGGER.error('Render: source name (see source table?) {}'.format(self.data))
+            if LOGGER.isEnabledFor(logging.DEBUG):
+                name = SOURCE_NAMES[value1] if value1 < len(SOURCE_NAMES) else '(see source table?)'
+                LOGGER.debug('Render: source[%s] = %s', self.data, name)
 
         elif rtype == 9: # key name from keytable
-            LOGGER.error('Keypad keypress: (see keyNames table) {}'.format(value1))
+            LOGGER.debug('Keypad keypress: (see keyNames table) %s', value1)
             self.message_id = RNET_MSG_TYPE.UNKNOWN_DISPLAY
         elif rtype == 16: # volume
             self.message_id = RNET_MSG_TYPE.DISPLAY_ZONE_VOLUME
@@ -380,9 +380,9 @@ class RNetMessage():
         elif rtype == 24: # from string table _StringTable
             self.message_id = RNET_MSG_TYPE.DISPLAY_FEEDBACK
             self.data = value1 + (value2 << 8)
-            LOGGER.error('Render: string table id = {}'.format(self.data))
+            LOGGER.debug('Render: string table id = %s', self.data)
         else:
-            LOGGER.error('Render: type = {}, data = {}'.format(rtype, value1))
+            LOGGER.debug('Render: type = %s, data = %s', rtype, value1)
             self.message_id = RNET_MSG_TYPE.UNKNOWN_DISPLAY
 
 
@@ -5,51 +5,1005 @@
 #  Wait for messages from the Russound device
 
 from udi_interface import LOGGER
+import os
+import cProfile
+import json
+import marshal
+import pstats
+import re
 import time
+import tracemalloc
+import collections
+import select
 import socket
+import termios
+import tty
 import threading
 import rnet_message
+import rnet_capture
+import clock
+import logging
+import protolog
+from protolog import Hex
+
+RNETLOG = protolog.get('rnet')
+RIOLOG = protolog.get('rio')
+LINKLOG = protolog.get('link')
+
+## Turn on TCP keepalive and disable Nagle on a controller socket so
+## small command frames go out immediately and dead peers get noticed
+## by the kernel even when we are not sending anything.
+def tune_tcp_socket(sock):
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    # Linux specific, probe after 60 seconds idle, every 10 seconds, 3 times
+    for opt, value in (('TCP_KEEPIDLE', 60), ('TCP_KEEPINTVL', 10), ('TCP_KEEPCNT', 3)):
+        if hasattr(socket, opt):
+            sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, opt), value)
+
+'''
+Transports move raw bytes between a Connection and the device.  The
+protocol code (RNET framing, RIO lines) only ever uses this interface,
+so anything that can open, send, receive and close can be plugged in
+underneath a Connection.
+
+  open()       - connect, raises OSError (or ValueError) on failure
+  recv(size)   - block for data, returns b'' once closed
+  send(data)   - write all of data
+  close()      - close and wake up anyone blocked in recv()
+
+Transports where push is True deliver incoming data themselves by
+calling receiver(data) from their own thread instead of through recv().
+'''
+class Transport:
+    push = False
+    baud = 0  # non-zero if writes need to be paced at this rate
+
+    def __init__(self):
+        self.receiver = None
+
+    def open(self):
+        raise NotImplementedError
+
+    def recv(self, size):
+        raise NotImplementedError
+
+    def send(self, data):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __str__(self):
+        return self.__class__.__name__
+
+
+class TCPTransport(Transport):
+    CONNECT_TIMEOUT = 10     # seconds to wait for a TCP connect
+
+    def __init__(self, ip, port):
+        super().__init__()
+        self.ip = ip
+        self.port = int(port)
+        self.sock = None
+
+    def open(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(self.CONNECT_TIMEOUT)
+            sock.connect((self.ip, self.port))
+            sock.settimeout(None)
+            tune_tcp_socket(sock)
+        except OSError:
+            sock.close()
+            raise
+        self.sock = sock
+
+    def recv(self, size):
+        sock = self.sock
+        if sock is None:
+            return b''
+        return sock.recv(size)
+
+    def send(self, data):
+        self.sock.sendall(data)
+
+    def close(self):
+        sock = self.sock
+        self.sock = None
+        if sock is not None:
+            # shutdown wakes up the message loop thread blocked in recv()
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
+
+    def __str__(self):
+        return 'TCP {}:{}'.format(self.ip, self.port)
+
+
+'''
+One UDP socket per local port, shared by every controller configured to
+use that port.  Datagrams are handed to the transport registered for the
+sender's address, anything from an unknown peer is dropped.  A single
+reader thread serves all of the controllers on the port.
+'''
+class UDPEndpoint:
+    _endpoints = {}
+    _lock = threading.Lock()
+
+    def __init__(self, port):
+        self.port = port
+        self.peers = {}
+        self.dropped = 0
+        self.closed = False
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('0.0.0.0', port))
+        self.thread = threading.Thread(target=self.__loop, name='udp-{}'.format(port))
+        self.thread.daemon = True
+        self.thread.start()
+
+    @classmethod
+    def acquire(cls, port, ip, peer):
+        with cls._lock:
+            endpoint = cls._endpoints.get(port)
+            if endpoint is None:
+                endpoint = UDPEndpoint(port)
+                cls._endpoints[port] = endpoint
+            if ip in endpoint.peers and endpoint.peers[ip] is not peer:
+                raise ValueError('{} is already using UDP port {}'.format(ip, port))
+            endpoint.peers[ip] = peer
+            return endpoint
+
+    @classmethod
+    def release(cls, port, ip, peer):
+        with cls._lock:
+            endpoint = cls._endpoints.get(port)
+            if endpoint is None or endpoint.peers.get(ip) is not peer:
+                return
+            del endpoint.peers[ip]
+            if len(endpoint.peers) == 0:
+                del cls._endpoints[port]
+                endpoint.close()
+
+    # Closing the socket doesn't wake up recvfrom(), poke it with an empty
+    # datagram and let the reader thread close it on the way out.
+    def close(self):
+        self.closed = True
+        try:
+            self.sock.sendto(b'', ('127.0.0.1', self.port))
+        except OSError:
+            self.sock.close()
+
+    def sendto(self, data, address):
+        self.sock.sendto(data, address)
+
+    def __loop(self):
+        while True:
+            try:
+                (data, address) = self.sock.recvfrom(4096)
+            except OSError:
+                break
+
+            if self.closed:
+                # no more peers on this port
+                break
+
+            peer = self.peers.get(address[0])
+            if peer is None or peer.receiver is None:
+                self.dropped += 1
+                continue
+
+            try:
+                peer.receiver(data)
+            except Exception as e:
+                LOGGER.error('UDP {}: failed to process data - {}'.format(address[0], e))
+
+        self.sock.close()
+        LINKLOG.debug('UDP port %s closed', self.port)
+
+
+class UDPTransport(Transport):
+    push = True
+
+    def __init__(self, ip, port):
+        super().__init__()
+        self.ip = ip
+        self.port = int(port)
+        self.endpoint = None
+
+    def open(self):
+        self.endpoint = UDPEndpoint.acquire(self.port, self.ip, self)
+
+    def send(self, data):
+        self.endpoint.sendto(data, (self.ip, self.port))
+
+    def close(self):
+        if self.endpoint is not None:
+            UDPEndpoint.release(self.port, self.ip, self)
+            self.endpoint = None
+
+    def __str__(self):
+        return 'UDP {}:{}'.format(self.ip, self.port)
+
+
+'''
+A local serial port (USB serial adaptor plugged into the RNET port).
+The device is put in raw 8N1 mode at the requested baud rate.
+'''
+class SerialTransport(Transport):
+    def __init__(self, device, baud):
+        super().__init__()
+        self.device = device
+        self.baud = int(baud)
+        self.fd = -1
+        self.wake_r = -1
+        self.wake_w = -1
+
+    def open(self):
+        speed = getattr(termios, 'B{}'.format(self.baud), None)
+        if speed is None:
+            raise ValueError('Unsupported baud rate {}'.format(self.baud))
+
+        fd = os.open(self.device, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+        try:
+            tty.setraw(fd)
+            attrs = termios.tcgetattr(fd)
+            attrs[2] &= ~(termios.CSTOPB | termios.PARENB | termios.CRTSCTS)
+            attrs[2] |= termios.CLOCAL | termios.CREAD
+            attrs[4] = speed  # input speed
+            attrs[5] = speed  # output speed
+            termios.tcsetattr(fd, termios.TCSANOW, attrs)
+            termios.tcflush(fd, termios.TCIOFLUSH)
+        except termios.error as e:
+            os.close(fd)
+            raise OSError(str(e))
+
+        self.fd = fd
+        # used to wake up a reader blocked in recv() when we shut down
+        (self.wake_r, self.wake_w) = os.pipe()
+
+    def recv(self, size):
+        while True:
+            try:
+                (readable, _, _) = select.select([self.fd, self.wake_r], [], [])
+                if self.wake_r in readable:
+                    return b''
+                return os.read(self.fd, size)
+            except BlockingIOError:
+                continue
+            except (OSError, ValueError):
+                # closed underneath us
+                return b''
+
+    def send(self, data):
+        view = memoryview(data)
+        while len(view) > 0:
+            select.select([], [self.fd], [])
+            try:
+                sent = os.write(self.fd, view)
+            except BlockingIOError:
+                continue
+            view = view[sent:]
+
+    def close(self):
+        if self.fd < 0:
+            return
+        os.write(self.wake_w, b'x')
+        for fd in (self.fd, self.wake_r, self.wake_w):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+        self.fd = -1
+
+    def __str__(self):
+        return 'serial {} at {} baud'.format(self.device, self.baud)
+
+
+'''
+In memory transport.  LoopbackTransport.pair() returns two connected
+ends, whatever is sent on one is received on the other.  Used to run
+the protocol code against a simulated device with no sockets at all.
+'''
+class LoopbackTransport(Transport):
+    def __init__(self):
+        super().__init__()
+        self.peer = None
+        self.pending = bytearray()
+        self.cond = threading.Condition()
+        self.closed = True
+
+    @classmethod
+    def pair(cls):
+        a = cls()
+        b = cls()
+        a.peer = b
+        b.peer = a
+        a.closed = False
+        b.closed = False
+        return (a, b)
+
+    def open(self):
+        if self.peer is None:
+            raise OSError('loopback transport is not paired')
+        with self.cond:
+            self.closed = False
+
+    def __deliver(self, data):
+        with self.cond:
+            self.pending.extend(data)
+            self.cond.notify_all()
+
+    def recv(self, size):
+        with self.cond:
+            while len(self.pending) == 0 and not self.closed:
+                self.cond.wait()
+            data = bytes(self.pending[:size])
+            del self.pending[:size]
+            return data
+
+    def send(self, data):
+        if self.closed or self.peer.closed:
+            raise BrokenPipeError('loopback peer closed')
+        self.peer.__deliver(data)
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.pending = bytearray()
+            self.cond.notify_all()
+        # the other end sees end of file
+        with self.peer.cond:
+            self.peer.closed = True
+            self.peer.cond.notify_all()
+
+
+'''
+Counters, gauges and latency histograms for one controller.  Names and
+units follow the Prometheus conventions and render_metrics() writes them
+out in its text format.  Samples are kept in plain dictionaries keyed by
+(name, label value) under a single lock, the hot paths only ever add to
+a number.
+
+Command to acknowledgement latency is measured by queueing the send
+time of each command that will be answered (expect) and taking the
+oldest one off when an answer arrives (answered).  Commands that go
+unanswered for longer than ACK_TIMEOUT count as timeouts.
+'''
+class Metrics:
+    PREFIX = 'russound_'
+    BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+    ACK_TIMEOUT = 10    # seconds before an unanswered command is a timeout
+    PENDING_MAX = 32    # unanswered commands remembered per queue
+
+    # name: (type, label, help)
+    METRICS = {
+            'frames_in_total': ('counter', 'type', 'Messages received from the controller'),
+            'frames_out_total': ('counter', 'type', 'Messages sent to the controller'),
+            'bytes_in_total': ('counter', None, 'Bytes received from the controller'),
+            'bytes_out_total': ('counter', None, 'Bytes sent to the controller'),
+            'parse_errors_total': ('counter', None, 'Messages thrown away as corrupt'),
+            'process_errors_total': ('counter', None, 'Messages that failed to process'),
+            'connects_total': ('counter', 'result', 'Connection attempts'),
+            'timeouts_total': ('counter', 'kind', 'Responses that never arrived'),
+            'connected': ('gauge', None, '1 while connected to the controller'),
+            'write_queue_depth': ('gauge', None, 'Writes waiting to go out'),
+            'incoming_queue_depth': ('gauge', None, 'Responses waiting to be read'),
+            'ack_latency_seconds': ('histogram', 'command', 'Time from sending a command to its answer'),
+            'proxy_clients': ('gauge', None, 'Programs connected to the proxy port'),
+            'proxy_messages_total': ('counter', 'result', 'Messages from proxy clients'),
+            }
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}      # (name, label) -> value
+        self.histograms = {}  # (name, label) -> [bucket counts..., sum, count]
+        self.pending = {}     # queue -> deque of (send time, command)
+        self.window = None
+
+    def inc(self, name, label=None, value=1):
+        key = (name, label)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, value, label=None):
+        with self.lock:
+            self.values[(name, label)] = value
+
+    def observe(self, name, value, label=None):
+        with self.lock:
+            self.__observe((name, label), value)
+
+    # must be called with lock held
+    def __observe(self, key, value):
+        h = self.histograms.get(key)
+        if h is None:
+            h = [0] * (len(self.BUCKETS) + 2)
+            self.histograms[key] = h
+        for (i, le) in enumerate(self.BUCKETS):
+            if value <= le:
+                h[i] += 1
+                break
+        h[-2] += value
+        h[-1] += 1
+
+    def total(self, name):
+        with self.lock:
+            return sum(v for ((n, _), v) in self.values.items() if n == name)
+
+    # A command was sent that queue will answer
+    def expect(self, queue, command, trace=None):
+        with self.lock:
+            q = self.pending.get(queue)
+            if q is None:
+                q = collections.deque(maxlen=self.PENDING_MAX)
+                self.pending[queue] = q
+            if len(q) == q.maxlen:
+                self.__timeout('ack')
+            q.append((time.monotonic(), command, trace))
+
+    # An answer arrived, match it with the oldest command waiting on
+    # queue.  Returns that command's trace.
+    def answered(self, queue):
+        now = time.monotonic()
+        with self.lock:
+            q = self.pending.get(queue)
+            while q:
+                (sent, command, trace) = q.popleft()
+                if now - sent > self.ACK_TIMEOUT:
+                    self.__timeout('ack')
+                    continue
+                self.__observe(('ack_latency_seconds', command), now - sent)
+                return trace
+        return None
+
+    def __timeout(self, kind):
+        key = ('timeouts_total', kind)
+        self.values[key] = self.values.get(key, 0) + 1
+
+    '''
+    Connection quality (percent) and messages per minute since the last
+    call, None the first time.  Quality is the share of messages that
+    arrived intact times the share of commands that were answered.
+    '''
+    def rates(self, now):
+        with self.lock:
+            totals = {}
+            for ((name, _), v) in self.values.items():
+                totals[name] = totals.get(name, 0) + v
+            answered = sum(h[-1] for ((name, _), h) in self.histograms.items())
+
+        current = (now, totals.get('frames_in_total', 0), totals.get('frames_out_total', 0),
+                   totals.get('parse_errors_total', 0) + totals.get('process_errors_total', 0),
+                   answered, totals.get('timeouts_total', 0))
+        last = self.window
+        self.window = current
+        if last is None or now <= last[0]:
+            return None
+
+        (elapsed, rx, tx, bad, ok, missed) = [c - l for (c, l) in zip(current, last)]
+        quality = 1.0
+        if rx + bad > 0:
+            quality *= (rx - min(bad, rx)) / (rx + bad)
+        if ok + missed > 0:
+            quality *= ok / (ok + missed)
+        return (int(round(quality * 100)), int(round((rx + tx) * 60 / elapsed)))
+
+    def snapshot(self):
+        with self.lock:
+            return (dict(self.values), {k: list(h) for (k, h) in self.histograms.items()})
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                          for (k, v) in labels) + '}'
+
+'''
+Render metrics in the Prometheus text format.  sources is a list of
+(labels, Metrics) where labels is a list of (name, value) pairs added
+to every sample, i.e. [('controller', 'rsmain_38')].
+'''
+def render_metrics(sources):
+    snapshots = [(list(labels), m.snapshot()) for (labels, m) in sources]
+    lines = []
+    for (name, (kind, label, text)) in Metrics.METRICS.items():
+        full = Metrics.PREFIX + name
+        lines.append('# HELP {} {}'.format(full, text))
+        lines.append('# TYPE {} {}'.format(full, kind))
+        for (labels, (values, histograms)) in snapshots:
+            if kind == 'histogram':
+                for ((n, lv), h) in sorted(histograms.items(), key=lambda i: str(i[0][1])):
+                    if n != name:
+                        continue
+                    base = labels + ([(label, lv)] if lv is not None else [])
+                    count = 0
+                    for (i, le) in enumerate(Metrics.BUCKETS):
+                        count += h[i]
+                        lines.append('{}_bucket{} {}'.format(full, _labels(base + [('le', le)]), count))
+                    lines.append('{}_bucket{} {}'.format(full, _labels(base + [('le', '+Inf')]), h[-1]))
+                    lines.append('{}_sum{} {}'.format(full, _labels(base), round(h[-2], 6)))
+                    lines.append('{}_count{} {}'.format(full, _labels(base), h[-1]))
+            else:
+                for ((n, lv), v) in sorted(values.items(), key=lambda i: str(i[0][1])):
+                    if n != name:
+                        continue
+                    base = labels + ([(label, lv)] if lv is not None else [])
+                    lines.append('{}{} {}'.format(full, _labels(base), v))
+    return '\n'.join(lines) + '\n'
+
+
+'''
+One ISY command, from arrival at the zone node to the controller
+confirming it.  stages is a list of (stage, monotonic time, detail):
+
+  arrival   the zone node got the command
+  enqueue   a message for it was handed to the connection
+  wire      the message was written to the device
+  ack       the controller answered (RNET handshake, RIO S or E)
+  status    a status message for the zone arrived
+  driver    a zone driver was set
+
+A command can write several messages and set several drivers, each
+one is a stage.
+'''
+class CommandTrace:
+    __slots__ = ('id', 'zone', 'cmd', 'value', 'time', 'stages', 'confirmed')
+
+    def __init__(self, id, zone, cmd, value):
+        self.id = id
+        self.zone = zone
+        self.cmd = cmd
+        self.value = value
+        self.time = time.time()
+        self.stages = [('arrival', time.monotonic(), None)]
+        self.confirmed = False
+
+    def mark(self, stage, detail=None):
+        self.stages.append((stage, time.monotonic(), detail))
+
+    # Stage times are milliseconds after arrival
+    def to_dict(self):
+        stages = list(self.stages)
+        start = stages[0][1]
+        return {'id': self.id, 'zone': self.zone, 'cmd': self.cmd, 'value': self.value,
+                'time': self.time, 'monotonic': start,
+                'stages': [[s, round((t - start) * 1000, 3), d] for (s, t, d) in stages]}
+
+
+'''
+Flight recorder for zone commands.  The last SIZE command traces are
+kept in memory, dump() writes them out as JSON lines.
+
+While a zone node is handling a command the trace is attached to that
+thread, so the connection can mark the messages written for it and
+drivers set right away (RNET sets them before the controller answers).
+
+After that a trace stays open until a status message for that command
+arrives, i.e. a volume for VOLUME, and the matching driver is set
+while handling it.  Commands that never get a status (keypad events)
+are dropped from the open list once a zone has OPEN_MAX newer ones.
+
+Off by default, everything checks enabled first so there is next to no
+cost until it's turned on.
+'''
+class FlightRecorder:
+    SIZE = 256
+    OPEN_MAX = 8
+
+    # Status (RNET message type or RIO key) -> commands it confirms.
+    # Anything not listed confirms any command.
+    STATUS = {
+            'ZONE_STATE': ('DFON', 'DFOF'), 'status': ('DFON', 'DFOF'),
+            'ZONE_SOURCE': ('SOURCE', 'GV14'), 'currentSource': ('SOURCE', 'GV14'),
+            'ZONE_VOLUME': ('VOLUME', 'GV12', 'GV13'), 'volume': ('VOLUME', 'GV12', 'GV13'),
+            'ZONE_BASS': ('BASS',), 'bass': ('BASS',),
+            'ZONE_TREBLE': ('TREBLE',), 'treble': ('TREBLE',),
+            'ZONE_BALANCE': ('BALANCE',), 'balance': ('BALANCE',),
+            'ZONE_LOUDNESS': ('LOUDNESS',), 'loudness': ('LOUDNESS',),
+            'ZONE_DO_NOT_DISTURB': ('DND',), 'doNotDisturb': ('DND',),
+            'ZONE_PARTY_MODE': ('PARTY',), 'partyMode': ('PARTY',),
+            'mute': ('MUTE',),
+            }
+
+    # Zone driver -> commands it is the result of
+    DRIVERS = {
+            'ST': ('DFON', 'DFOF'), 'GV0': ('SOURCE', 'GV14'),
+            'SVOL': ('VOLUME', 'GV12', 'GV13'), 'GV2': ('TREBLE',), 'GV3': ('BASS',),
+            'GV4': ('BALANCE',), 'GV5': ('LOUDNESS',), 'GV6': ('DND',), 'GV7': ('PARTY',),
+            'GV8': ('MUTE',),
+            }
+
+    def __init__(self, size=SIZE):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.traces = collections.deque(maxlen=size)
+        self.open = {}  # zone address -> traces waiting for their status
+        self.local = threading.local()
+        self.count = 0
+
+    def enable(self, on):
+        with self.lock:
+            self.enabled = on
+            if not on:
+                self.open = {}
+
+    def begin(self, zone, command):
+        with self.lock:
+            self.count += 1
+            trace = CommandTrace(self.count, zone, command.get('cmd'), command.get('value'))
+            self.traces.append(trace)
+            waiting = self.open.setdefault(zone, collections.deque(maxlen=self.OPEN_MAX))
+            waiting.append(trace)
+        self.local.trace = trace
+        return trace
+
+    def detach(self):
+        self.local.trace = None
+
+    # The trace for the command this thread is handling, if any
+    def current(self):
+        return getattr(self.local, 'trace', None)
+
+    # A status message for zone arrived, it confirms the oldest open
+    # command it is an answer to.  Drivers this thread sets for the zone
+    # next belong to that command.
+    def status(self, zone, detail):
+        commands = self.STATUS.get(detail)
+        with self.lock:
+            for trace in self.open.get(zone, ()):
+                if not trace.confirmed and (commands is None or trace.cmd in commands):
+                    trace.confirmed = True
+                    trace.mark('status', detail)
+                    break
+        self.local.status = zone
+
+    def driver(self, zone, driver, value):
+        trace = self.current()
+        if trace is not None and trace.zone == zone:
+            # set while handling the command
+            trace.mark('driver', '{}={}'.format(driver, value))
+            return
+        if getattr(self.local, 'status', None) != zone:
+            return
+
+        commands = self.DRIVERS.get(driver, ())
+        with self.lock:
+            waiting = self.open.get(zone, ())
+            for trace in waiting:
+                if trace.confirmed and trace.cmd in commands:
+                    trace.mark('driver', '{}={}'.format(driver, value))
+                    waiting.remove(trace)
+                    break
+
+    def dump(self, path):
+        with self.lock:
+            traces = [t.to_dict() for t in self.traces]
+        with open(path, 'w') as f:
+            for t in traces:
+                f.write(json.dumps(t) + '\n')
+        return len(traces)
+
+
+'''
+CPU and memory profile of the node server, started and stopped from
+the controller node.
+
+cProfile only sees the thread that turned it on.  So each thread of
+interest (the message loop reading from the controller, threads writing
+to it, the Polyglot thread running zone commands) turns on its own
+profiler the next time it passes attach().  A thread can only turn its
+own profiler off, stop() collects everyone's numbers right away and
+leaves the other threads to turn theirs off at their next attach().
+
+Memory is traced with tracemalloc for the whole process, stop() writes
+out the difference between the snapshots taken at start and stop.
+
+Output goes to <prefix>.pstats (all threads), <prefix>_<thread>.pstats
+and <prefix>_memory.txt.
+'''
+class ProfileSession:
+    MEMORY_TOP = 50   # allocation sites in the memory report
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.profiles = {}  # thread ident -> [name, cProfile.Profile or None, enabled]
+        self.active = True
+        self.started = time.monotonic()
+        self.tracing = tracemalloc.is_tracing()
+        if not self.tracing:
+            tracemalloc.start()
+        self.snapshot = tracemalloc.take_snapshot()
+
+    '''
+    Called by threads as they go about their work.  Returns False once
+    the session is over and this thread has nothing left to do for it.
+    '''
+    def attach(self, role):
+        ident = threading.get_ident()
+        with self.lock:
+            entry = self.profiles.get(ident)
+            if self.active:
+                if entry is None:
+                    profile = cProfile.Profile()
+                    try:
+                        profile.enable()
+                    except ValueError:
+                        # Python 3.12+ allows one profiler at a time, and
+                        # that one sees every thread.
+                        profile = None
+                    name = '{}-{}'.format(role, threading.current_thread().name)
+                    self.profiles[ident] = [name, profile, profile is not None]
+                return True
+
+            if entry is not None and entry[2]:
+                entry[1].disable()
+                entry[2] = False
+            return any(e[2] for e in self.profiles.values())
+
+    # Returns the files written
+    def stop(self):
+        ident = threading.get_ident()
+        with self.lock:
+            if not self.active:
+                return []
+            self.active = False
+            entry = self.profiles.get(ident)
+            if entry is not None and entry[2]:
+                entry[1].disable()
+                entry[2] = False
+            entries = [(e[0], e[1]) for e in self.profiles.values() if e[1] is not None]
+
+        # Memory first, before collecting the profiles allocates anything
+        snapshot = tracemalloc.take_snapshot()
+        if not self.tracing:
+            tracemalloc.stop()
+        ignore = [tracemalloc.Filter(False, m.__file__) for m in (tracemalloc, cProfile, pstats)]
+        ignore.append(tracemalloc.Filter(False, '<frozen importlib._bootstrap>'))
+        diff = snapshot.filter_traces(ignore).compare_to(self.snapshot.filter_traces(ignore), 'lineno')
+        path = self.prefix + '_memory.txt'
+        with open(path, 'w') as f:
+            f.write('Memory allocated over {:.1f} seconds, largest change first\n'.format(time.monotonic() - self.started))
+            for stat in diff[:self.MEMORY_TOP]:
+                f.write('{}\n'.format(stat))
+        files = [path]
+
+        combined = None
+        for (name, profile) in entries:
+            path = '{}_{}.pstats'.format(self.prefix, re.sub('[^A-Za-z0-9_.-]', '_', name))
+            # what dump_stats() does, without disabling the profiler
+            # from the wrong thread
+            profile.snapshot_stats()
+            with open(path, 'wb') as f:
+                marshal.dump(profile.stats, f)
+            files.append(path)
+            if combined is None:
+                combined = pstats.Stats(path)
+            else:
+                combined.add(path)
+        if combined is not None:
+            combined.dump_stats(self.prefix + '.pstats')
+            files.append(self.prefix + '.pstats')
+
+        return files
+
 
 class Connection:
     LOGGER = None
-    def __init__(self, ipaddress, port):
+    LINK_CHECK = 5           # how often the link should be checked
+    HEARTBEAT_INTERVAL = 30  # seconds of silence before sending a heartbeat
+    HEARTBEAT_TIMEOUT = 5    # seconds to wait for a heartbeat reply
+    HEARTBEAT_MISSES = 3     # unanswered heartbeats before link is dead
+    INCOMING_MAX = 32        # responses kept for getResponse()
+
+    def __init__(self, ipaddress, port, transport=None):
         self.ip = ipaddress
         self.port = int(port)
         self.connected = False
-        self.sock = None
+        self.closed = False
+        self.transport = transport
         self.controller = 1
-        self.incoming = []
+        self.clock = clock.default()
+        # Unsolicited values (RIO notifications) get queued too, so keep
+        # this bounded or it grows for as long as we're connected.
+        self.incoming = collections.deque(maxlen=self.INCOMING_MAX)
+        self.last_rx = self.clock.monotonic()
+        self.heartbeat_sent = 0
+        self.heartbeat_misses = 0
+        self.byte_time = 0  # seconds per byte when writes need pacing
+        self.next_write = 0
+        self.write_lock = threading.Lock()
+        self.capture = None  # rnet_capture.CaptureWriter
+        self.proxy = None  # proxy.LinkProxy
+        # For protocols that answer every command, in order: whether each
+        # command waiting for its answer came from a proxy client
+        self.replies = None
+        self.metrics = Metrics()
+        self.recorder = FlightRecorder()
+        self.profiling = None  # ProfileSession
 
     def IncomingQueue(self, data):
         self.incoming.append(data)
 
+    # True when messages from proxy clients should wait
+    def Busy(self):
+        return False
+
     def isConnected(self):
         return self.connected
 
+    # Let a running profile session start (or finish) in this thread
+    def Profile(self, role):
+        session = self.profiling
+        if session is not None and not session.attach(role):
+            self.profiling = None
+
     def Connect(self):
         self.connected = False
+        if self.closed:
+            return
+
+        try:
+            self.transport.open()
+            self.setBaudRate(self.transport.baud)
+            LOGGER.info('Successfully connected to Russound {} via {}.'.format(self.protocol, self.transport))
+            self.connected = True
+        except (OSError, ValueError) as msg:
+            LOGGER.error('Error trying to connect to russound controller.')
+            LOGGER.error(msg)
+
+        self.metrics.inc('connects_total', 'ok' if self.connected else 'failed')
+        self.metrics.set('connected', int(self.connected))
+        self.linkReset()
+
+    # Closing the transport wakes up the message loop so it can exit
+    def Drop(self):
+        self.connected = False
+        self.metrics.set('connected', 0)
+        self.transport.close()
+
+    # Drop the connection for good, nothing reconnects it after this
+    def Close(self):
+        self.closed = True
+        self.Drop()
 
     def Send(self, data):
-        LOGGER.debug('Connection: send:: {}'.format(data))
+        LINKLOG.debug('Connection: send:: %s', data)
+
+    # All writes to the device go through here, proxied is set for
+    # messages from a proxy client
+    def Write(self, data, proxied=False):
+        if self.profiling is not None:
+            self.Profile('writer')
+        metrics = self.metrics
+        trace = self.recorder.current() if self.recorder.enabled else None
+        if trace is not None:
+            trace.mark('enqueue', len(data))
+        metrics.inc('write_queue_depth')
+        try:
+            with self.write_lock:
+                self.pace(len(data))
+                # before it's sent, the answer can be back before send() returns
+                if self.replies is not None:
+                    self.replies.append(proxied)
+                self.transport.send(data)
+                if self.capture is not None:
+                    self.capture.record(rnet_capture.SENT, data)
+        finally:
+            metrics.inc('write_queue_depth', value=-1)
+        if trace is not None:
+            trace.mark('wire')
+        metrics.inc('bytes_out_total', value=len(data))
+        self.Sent(data, trace)
+
+    # Count a message that went out, and note it if it will be answered
+    def Sent(self, data, trace=None):
+        self.metrics.inc('frames_out_total')
+
+    # Record everything read from the device in to the capture file
+    # and pass it on to the proxy clients
+    def Captured(self, data):
+        if self.capture is not None:
+            self.capture.record(rnet_capture.RECV, data)
+        if self.proxy is not None:
+            self.proxy.broadcast(data)
 
     def getResponse(self):
         # CAV takes about 24 seconds, CAM takes about 44 seconds
         # to load the config.
         timeout = 600  # 60 seconds.
         while timeout > 0 and len(self.incoming) == 0:
-            time.sleep(.1)
+            self.clock.sleep(.1)
             timeout -= 1
 
         if timeout == 0:
-            LOGGER.debug('getResponse: timed out'.format(timeout))
+            LINKLOG.debug('getResponse: timed out')
+            self.metrics.inc('timeouts_total', 'response')
             return -1
 
-        LOGGER.debug('getResponse:: queue = {}'.format(self.incoming))
+        LINKLOG.debug('getResponse:: queue = %s', self.incoming)
         resp = self.incoming.pop()
+        # anything older is unsolicited, nobody is waiting for it
+        self.incoming.clear()
         return resp
 
     def MessageLoop(self, processCommand):
-        LOGGER.debug('Connection: Initialize message loop to {}'.format(processCommand))
+        LINKLOG.debug('Connection: Initialize message loop to %s', processCommand)
+
+    # Set the pacing for a serial link, 10 bit times per byte (start, 8
+    # data, stop).  A baud rate of 0 turns pacing off.
+    def setBaudRate(self, baud):
+        if baud > 0:
+            self.byte_time = 10.0 / baud
+        else:
+            self.byte_time = 0
+
+    # Wait until the previous write has had time to go out on the wire.
+    # Must be called with write_lock held.
+    def pace(self, length):
+        if self.byte_time == 0:
+            return
+        now = time.monotonic()
+        if self.next_write > now:
+            time.sleep(self.next_write - now)
+            now = self.next_write
+        self.next_write = now + length * self.byte_time
+
+    # Called by the message loops whenever anything arrives from the device
+    def LinkActivity(self):
+        self.last_rx = self.clock.monotonic()
+
+    # Send something cheap that the device will answer.
+    def Heartbeat(self):
+        pass
+
+    # Counters used to judge the quality of the link
+    def LinkStats(self):
+        return {'heartbeat_misses': self.heartbeat_misses}
+
+    def linkReset(self):
+        self.last_rx = self.clock.monotonic()
+        self.heartbeat_sent = 0
+        self.heartbeat_misses = 0
+
+    '''
+    Application level dead link detection.  A half-open TCP connection
+    looks perfectly healthy until we try to use it, so when the link has
+    been idle for HEARTBEAT_INTERVAL seconds send a heartbeat and count
+    the ones that go unanswered.  Returns False once the link is dead.
+    '''
+    def CheckLink(self):
+        if not self.connected:
+            return False
+
+        now = self.clock.monotonic()
+        if self.last_rx >= self.heartbeat_sent:
+            # Heard from the device since the last heartbeat
+            self.heartbeat_misses = 0
+            if now - self.last_rx < self.HEARTBEAT_INTERVAL:
+                return True
+        elif now - self.heartbeat_sent < self.HEARTBEAT_TIMEOUT:
+            # heartbeat outstanding, give it time to be answered
+            return True
+        else:
+            self.heartbeat_misses += 1
+            self.metrics.inc('timeouts_total', 'heartbeat')
+            LOGGER.warning('{}: heartbeat {} of {} unanswered'.format(self.ip, self.heartbeat_misses, self.HEARTBEAT_MISSES))
+
+        if self.heartbeat_misses >= self.HEARTBEAT_MISSES:
+            LOGGER.error('{}: no response from device, link is dead'.format(self.ip))
+            self.connected = False
+            return False
+
+        LINKLOG.debug('%s: link idle, sending heartbeat', self.ip)
+        self.heartbeat_sent = now
+        self.Heartbeat()
+        return self.connected
 
     '''
     def get_info(self, zone, info_type):
@@ -61,176 +1015,249 @@ class Connection:
     def request_config(self, controller):
     '''
 
-class RNETConnection(Connection):
-    LOGGER = None
-    def __init__(self, ipaddress, port, udp):
-        super().__init__(ipaddress, port)
-        self.udp = udp
-        self.protocol = 'RNET'
-
-    ## Connect to the Russound via UDP broadcasts
-    def __russound_connect_udp(self, port):
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1) # share it
-        try:
-            self.sock.bind(('0.0.0.0', int(port)))
-            LOGGER.info('Successfully connected to Russound rnet via UDP.')
-            self.connected = True
-        except socket.error as msg:
-            LOGGER.error('Error trying to connect to russound controller.')
-            LOGGER.error(msg)
-            self.sock = None
+'''
+Split a stream of RNET bytes into messages.  Messages start with 0xf0
+and end with 0xf7, a 0xf1 means the next byte has been inverted.  The
+state is kept between calls so a message can be split across any
+number of reads or datagrams.
+
+A message is only passed on if its escape sequences are valid and its
+checksum matches.  The checksum is calculated the same way
+RNETConnection.checksum does when sending, over the bytes as they
+appear on the wire.  Anything else is thrown away and we start over at
+the next start byte.  The counters let us keep an eye on link quality.
+'''
+class RNETDecoder:
+    MAX_FRAME = 1024
+    MIN_FRAME = 9     # start byte, 6 ID bytes, message type, checksum
+
+    def __init__(self):
+        self.frames = 0      # good messages
+        self.corrupt = 0     # messages thrown away
+        self.resyncs = 0     # times we had to hunt for a start byte
+        self.reset()
+
+    def reset(self):
+        self.buf = bytearray()
+        self.active = False
+        self.invert = False
+        self.discarding = False
+        self.wire_sum = 0
+        self.wire_count = 0
+        self.last = 0
+        self.last_inverted = False
+
+    def stats(self):
+        return {'frames': self.frames, 'corrupt': self.corrupt, 'resyncs': self.resyncs}
+
+    def __start(self):
+        if self.discarding:
+            self.resyncs += 1
+            self.discarding = False
+        self.buf = bytearray(b'\xf0')
+        self.active = True
+        self.invert = False
+        self.wire_sum = 0xf0
+        self.wire_count = 1
+        self.last = 0xf0
+        self.last_inverted = False
+
+    def __discard(self, reason, *args):
+        protolog.limited(RNETLOG, logging.DEBUG, 'discard', 'RNET message discarded: ' + reason, *args)
+        self.corrupt += 1
+        self.active = False
+        self.invert = False
+        self.discarding = True
+
+    def __end(self):
+        # The checksum is the last byte before the end byte and is never
+        # inverted.  It covers everything before it.
+        if self.invert or self.last_inverted:
+            self.__discard('inverted checksum')
+            return None
+        if len(self.buf) < self.MIN_FRAME:
+            self.__discard('too short')
+            return None
+        cksum = ((self.wire_sum - self.last) + (self.wire_count - 1)) & 0x7f
+        if cksum != self.last:
+            self.__discard('checksum %02x != %02x', self.last, cksum)
+            return None
+
+        self.frames += 1
+        self.active = False
+        return self.buf
+
+    # Returns a list of decoded messages (start byte through checksum)
+    def feed(self, data):
+        frames = []
+        for b in data:
+            if b == 0xf0:
+                if self.active:
+                    # start byte in the middle of a message
+                    self.__discard('unexpected start byte')
+                self.__start()
+            elif not self.active:  # looking for start byte
+                self.discarding = True
+            elif b == 0xf7:  # end byte
+                frame = self.__end()
+                if frame is not None:
+                    frames.append(frame)
+            elif self.invert and (b == 0xf1 or b & 0x80):
+                # only 7 bit values can follow the invert byte
+                self.__discard('bad invert sequence')
+            elif b & 0x80 and b != 0xf1:
+                # bytes over 0x7f are always sent inverted
+                self.__discard('unescaped byte %02x', b)
+            else:
+                self.wire_sum += b
+                self.wire_count += 1
+                self.last = b
+                self.last_inverted = self.invert
+                if b == 0xf1:  # invert byte
+                    self.invert = True
+                elif self.invert:
+                    self.invert = False
+                    self.buf.append(0xff & ~b)
+                else:
+                    self.buf.append(b)
 
-        return self.sock
+                if len(self.buf) > self.MAX_FRAME:
+                    self.__discard('too long')
+        return frames
 
 
-    ## Connect to the Russound via IP address (serial/IP adaptor)
-    def __russound_connect_tcp(self, ip, port):
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        try:
-            self.sock.connect((ip, int(port)))
-            LOGGER.info('Successfully connected to Russound rnet via TCP.')
-            self.connected = True
-        except socket.error as msg:
-            LOGGER.error('Error trying to connect to russound controller.')
-            LOGGER.error(msg)
-            self.sock = None
-        
-        return self.sock
+# RNET message types as they appear on the wire (byte 7)
+RNET_WIRE_TYPES = {0: 'set_data', 1: 'request_data', 2: 'handshake', 5: 'event'}
 
-    def Connect(self):
-        self.connected = False
 
-        if self.udp:
-            self.__russound_connect_udp(self.port)
-        else:
-            self.__russound_connect_tcp(self.ip, self.port)
+class RNETConnection(Connection):
+    LOGGER = None
+    # For a serial connection, ipaddress is the device (/dev/ttyUSB0) and
+    # port is the baud rate.
+    def __init__(self, ipaddress, port, udp, serial=False, transport=None):
+        if transport is None:
+            if serial:
+                transport = SerialTransport(ipaddress, port)
+            elif udp:
+                transport = UDPTransport(ipaddress, port)
+            else:
+                transport = TCPTransport(ipaddress, port)
+        super().__init__(ipaddress, port, transport)
+        self.udp = udp
+        self.serial = serial
+        self.protocol = 'RNET'
+        self.decoder = RNETDecoder()
+        self.processCommand = None
 
+    def Connect(self):
+        self.decoder.reset()  # counters are kept across reconnects
+        super().Connect()
 
-    def Drop(self):
-        self.sock.close()
-        self.sock = None
+    # Zone state of the first zone is small and always answered
+    def Heartbeat(self):
+        self.get_info(self.controller, 0, 0x0406)
 
-        self.connected = False
+    def LinkStats(self):
+        stats = super().LinkStats()
+        stats.update(self.decoder.stats())
+        return stats
 
     def Send(self, data):
         try:
-            if self.udp:
-                self.sock.sendto(data, (self.ip, self.port))
-            else:
-                self.sock.send(data)
+            self.Write(data)
         except Exception as e:
             LOGGER.error('Socket failure:  Unable to send data to device - {}'.format(str(e)))
             self.connected = False
 
+    # Set data is answered with a handshake, a request with set data
+    def Sent(self, data, trace=None):
+        kind = RNET_WIRE_TYPES.get(data[7], 'other') if len(data) > 7 else 'other'
+        self.metrics.inc('frames_out_total', kind)
+        if kind == 'set_data':
+            self.metrics.expect('handshake', kind, trace)
+        elif kind == 'request_data':
+            self.metrics.expect('reply', kind, trace)
+
+    # Raw bytes from the device, may hold any part of one or more messages
+    def DataReceived(self, data):
+        if self.profiling is not None:
+            self.Profile('reader')
+        self.LinkActivity()
+        self.Captured(data)
+        metrics = self.metrics
+        metrics.inc('bytes_in_total', value=len(data))
+
+        corrupt = self.decoder.corrupt
+        frames = self.decoder.feed(data)
+        if self.decoder.corrupt != corrupt:
+            metrics.inc('parse_errors_total', value=self.decoder.corrupt - corrupt)
+
+        for dbuf in frames:
+            if RNETLOG.isEnabledFor(logging.DEBUG):
+                protolog.limited(RNETLOG, logging.DEBUG, dbuf[7], 'recv: %s', Hex(dbuf))
+            if dbuf[7] == 2:
+                trace = metrics.answered('handshake')
+            elif dbuf[7] == 0:
+                trace = metrics.answered('reply')
+            else:
+                trace = None
+            if trace is not None:
+                trace.mark('ack', RNET_WIRE_TYPES.get(dbuf[7]))
 
-    # Main loop waits for messages from Russound and then processes them
-    def __russound_loop_tcp(self, processCommand):
-        buf = bytearray(100)
-        st = 0
-        invert = False
+            if self.processCommand is None:
+                metrics.inc('frames_in_total', RNET_WIRE_TYPES.get(dbuf[7], 'other'))
+                continue
 
+            try:
+                msg = rnet_message.RNetMessage(dbuf)
+                metrics.inc('frames_in_total', msg.MessageType().name)
+                self.processCommand(msg)
+            except Exception as e:
+                metrics.inc('process_errors_total')
+                LOGGER.error('Failed to process message: {}'.format(e))
+
+            # if message is a set data, send an ack back
+            if dbuf[7] == 0:
+                self.acknowledge(1)
+
+    # Main loop waits for messages from Russound and then processes them.
+    # Used for stream transports (TCP, serial, loopback).
+    def __russound_loop_stream(self, processCommand):
         while self.connected:
             try:
-                data = self.sock.recv(4096)
+                data = self.transport.recv(4096)
                 #LOGGER.debug(data)
+                if data == b'':
+                    raise ConnectionResetError('connection closed by device')
 
-                for b in data:
-                    if st == 0:  # looking for start byte
-                        if b == 0xf0:
-                            buf[st] = b
-                            st += 1
-                    else: # looking for end byte
-                        if b == 0xf7:
-                            buf[st] = b
-
-                            # copy the bytes to an array sized for message
-                            dbuf = bytearray(st+1)
-                            dbuf = buf[0:st]
-                            LOGGER.debug('recv: ' + ' '.join('{:02x}'.format(x) for x in dbuf))
-                            msg = rnet_message.RNetMessage(dbuf)
-                            processCommand(msg)
-
-                            # if message is a set data, send an ack back
-                            if dbuf[7] == 0:  
-                                self.acknowledge(1)
-                            st = 0
-                            invert = False
-                        elif b == 0xf1:  # invert byte
-                            invert = True
-                        else:
-                            if invert:
-                                invert = False
-                                buf[st] = 0xff & ~b
-                            else:
-                                buf[st] = b
-                            st += 1
-                        
+                self.DataReceived(data)
             except BlockingIOError:
                 LOGGER.info('waiting on data')
                 pass
-            except ConnectionResetError as msg:
-                LOGGER.error('Connection error: ' + str(msg))
-                self.connected = False
-                # Need to send a special message back that indicates 
-                # the lost connection
-                buf[0] = 0xff
-                buf[6] = 0xff
-                buf[7] = 0xff
-                processCommand(rnet_message.RNetMessage(buf))
-                self.socket.close()
             except Exception as e:
-                LOGGER.error('Connection error: ' + str(msg))
+                if not self.connected:
+                    # We dropped the connection ourselves
+                    break
+                LOGGER.error('Connection error: ' + str(e))
                 self.connected = False
-                # Need to send a special message back that indicates 
+                # Need to send a special message back that indicates
                 # the lost connection
+                buf = bytearray(8)
                 buf[0] = 0xff
                 buf[6] = 0xff
                 buf[7] = 0xff
                 processCommand(rnet_message.RNetMessage(buf))
-                self.socket.close()
-
-    # Main loop waits for messages from Russound and then processes them
-    #   messages start with 0xf0 and end with 0xf7
-    def __russound_loop_udp(self, processCommand):
-        buf = bytearray(50)
-        st = 0
-
-        while self.connected:
-            try:
-                udp = self.sock.recvfrom(4096)
-                #LOGGER.debug(udp)
-
-                data = udp[0]
-                for b in data:
-                    if st == 0:  # looking for start byte
-                        if b == 0xf0:
-                            buf[st] = b
-                            st += 1
-                    else: # looking for end byte
-                        if b == 0xf7:
-                            buf[st] = b
-                            st = 0
-                            LOGGER.debug('recv: ' + ' '.join('{:02x}'.format(x) for x in data))
-                            msg = rnet_message.RNetMessage(buf)
-                            processCommand(msg)
-                        else:
-                            buf[st] = b
-                            st += 1
-                        
-            except BlockingIOError:
-                LOGGER.info('waiting on data')
-                pass
-            except ConnectionResetError as msg:
-                LOGGER.error('Connection error: ' + msg)
-                self.connected = False
-                self.sock.close()
 
+    '''
+    When the transport delivers data itself (UDP) there is nothing to
+    wait on here.  Just register the handler and return.
+    '''
     def MessageLoop(self, processCommand):
-        if self.udp:
-            self.__russound_loop_udp(processCommand)
+        self.processCommand = processCommand
+        if self.transport.push:
+            self.transport.receiver = self.DataReceived
         else:
-            self.__russound_loop_tcp(processCommand)
+            self.__russound_loop_stream(processCommand)
 
     def setIDs(self, data, start, control_id, zone_id, keypad_id):
         data[start]     = control_id
@@ -311,7 +1338,7 @@ class RNETConnection(Connection):
             data[15] = self.checksum(data, 15)
             data[16] = 0xf7
 
-        LOGGER.debug('sending get_info: ' + ''.join('{:02x}'.format(x) for x in data))
+        RNETLOG.debug('sending get_info: %s', Hex(data, ''))
         self.Send(data)
 
     # params 0x00 = bass, 0x01 = treble, 0x02 = loudness, 0x03 = balance,
@@ -323,7 +1350,7 @@ class RNETConnection(Connection):
     def set_param(self, controller, zone, param, level):
         data = bytearray(24)
 
-        LOGGER.debug('set_param zone={} controller={} param={} level={}'.format(zone, controller, param, level))
+        RNETLOG.debug('set_param zone=%s controller=%s param=%s level=%s', zone, controller, param, level)
         data[0] = 0xf0
         self.setIDs(data, 1, (controller - 1), 0, 0x7f)
         self.setIDs(data, 4, (controller - 1), zone, 0x70)
@@ -336,7 +1363,7 @@ class RNETConnection(Connection):
         data[22] = self.checksum(data, 22)
         data[23] = 0xf7
 
-        LOGGER.debug('sending set_param: ' + ' '.join('{:02x}'.format(x) for x in data))
+        RNETLOG.debug('sending set_param: %s', Hex(data))
         self.Send(data)
 
     """
@@ -365,7 +1392,7 @@ class RNETConnection(Connection):
 
         data = bytearray(21)
 
-        LOGGER.error('send_event: {} {} {}'.format(controller, zone, value))
+        RNETLOG.debug('send_event: %s %s %s', controller, zone, value)
         data[0] = 0xf0
         self.setIDs(data, 1, (controller - 1), 0, 0x7f)          # Tartet ID's
         self.setIDs(data, 4, 0, zone, 0x71)       # Source ID's
@@ -387,7 +1414,7 @@ class RNETConnection(Connection):
         # CAV all on F0 7E 00 7F 00 00 70 05 02 02 00 00 F1 22 00 00 01 00 00 01 0F F7
         data = bytearray(22)
 
-        LOGGER.error('send_zones_on')
+        RNETLOG.debug('send_zones_on')
         data[0] = 0xf0
         self.setIDs(data, 1, 0x7e, 0, 0x7f)       # Tartet ID's
         self.setIDs(data, 4, 0, 0x00, 0x70)       # Source ID's
@@ -400,14 +1427,14 @@ class RNETConnection(Connection):
         self.setData(data, 19, [0x01])            # priority
         data[20] = self.checksum(data, 20)
         data[21] = 0xf7
-        LOGGER.error('Sending: {}'.format(data))
+        RNETLOG.debug('Sending: %s', Hex(data))
         self.Send(data)
 
     def send_all_zones_off(self):
         # All Off F0 7E 00 7F 00 00 71 05 02 02 00 00 F1 22 00 00 00 00 00 01 0F F7
         data = bytearray(22)
 
-        LOGGER.error('send_zones_off')
+        RNETLOG.debug('send_zones_off')
         data[0] = 0xf0
         self.setIDs(data, 1, 0x7e, 0, 0x7f)       # Tartet ID's
         self.setIDs(data, 4, 0, 0x00, 0x71)       # Source ID's
@@ -420,7 +1447,7 @@ class RNETConnection(Connection):
         self.setData(data, 19, [0x01])            # priority
         data[20] = self.checksum(data, 20)
         data[21] = 0xf7
-        LOGGER.error('Sending: {}'.format(data))
+        RNETLOG.debug('Sending: %s', Hex(data))
         self.Send(data)
 
     def send_volume_down(self, controller, zone):
@@ -438,13 +1465,13 @@ class RNETConnection(Connection):
         self.setData(data, 19, [0x01])            # priority
         data[20] = self.checksum(data, 20)
         data[21] = 0xf7
-        LOGGER.error('Volume down Sending: {}'.format(data))
+        RNETLOG.debug('Volume down Sending: %s', Hex(data))
         self.Send(data)
 
     def send_volume_up(self, controller, zone):
         data = bytearray(21)
 
-        LOGGER.error('send_volume_up: {}'.format(zone))
+        RNETLOG.debug('send_volume_up: %s', zone)
         data[0] = 0xf0
         self.setIDs(data, 1, (controller - 1), 0, 0x7f)       # Tartet ID's
         self.setIDs(data, 4, 0, zone, 0x70)       # Source ID's
@@ -457,7 +1484,7 @@ class RNETConnection(Connection):
         self.setData(data, 18, [0x01])            # priority
         data[19] = self.checksum(data, 19)
         data[20] = 0xf7
-        LOGGER.error('Volume up Sending: {}'.format(data))
+        RNETLOG.debug('Volume up Sending: %s', Hex(data))
         self.Send(data)
 
     # Use event message type
@@ -475,7 +1502,7 @@ class RNETConnection(Connection):
         data[20] = self.checksum(data, 20)
         data[21] = 0xf7
 
-        LOGGER.debug('sending set_source: ' + ' '.join('{:02x}'.format(x) for x in data))
+        RNETLOG.debug('sending set_source: %s', Hex(data))
         self.Send(data)
 
     # Use event message type
@@ -495,7 +1522,7 @@ class RNETConnection(Connection):
         data[20] = self.checksum(data, 20)
         data[21] = 0xf7
 
-        LOGGER.debug('sending set_state: ' + ' '.join('{:02x}'.format(x) for x in data))
+        RNETLOG.debug('sending set_state: %s', Hex(data))
         self.Send(data)
 
     # Use event message type
@@ -521,7 +1548,7 @@ class RNETConnection(Connection):
         data[20] = self.checksum(data, 20)
         data[21] = 0xf7
 
-        LOGGER.debug('sending volume: ' + ''.join('{:02x}'.format(x) for x in data))
+        RNETLOG.debug('sending volume: %s', Hex(data, ''))
         self.Send(data)
 
     # Request the configuration information from the controller
@@ -537,7 +1564,7 @@ class RNETConnection(Connection):
         data[21] = self.checksum(data, 21)
         data[22] = 0xf7
 
-        LOGGER.debug('sending request config: ' + ''.join('{:02x}'.format(x) for x in data))
+        RNETLOG.debug('sending request config: %s', Hex(data, ''))
         self.Send(data)
 
     # Send an ack back to the controller.
@@ -550,7 +1577,7 @@ class RNETConnection(Connection):
         data[8] = 2 # type of message we're acknowldgeding
         data[9] = self.checksum(data, 9)
         data[10] = 0xf7
-        LOGGER.debug('sending request config: ' + ''.join('{:02x}'.format(x) for x in data))
+        RNETLOG.debug('sending request config: %s', Hex(data, ''))
         self.Send(data)
 
     # for debugging -- send a message to all keypads
@@ -580,69 +1607,117 @@ class RNETConnection(Connection):
         data[34] = self.checksum(data, 34)
         data[35] = 0xf7
 
-        LOGGER.debug('sending message: ' + ' '.join('{:02x}'.format(x) for x in data))
+        RNETLOG.debug('sending message: %s', Hex(data))
         self.Send(data)
 
 
+# The key of a RIO line, i.e. volume for N C[1].Z[2].volume="25"
+def rio_key(line):
+    name = line.split('=', 1)[0]
+    if len(name) < 3 or name[0] == 'E':
+        return name[:1]
+    name = name[2:]
+    return name[name.rfind('.') + 1:].strip()
+
+
 class RIOConnection(Connection):
-    def __init__(self, ipaddress, port, udp):
-        super().__init__(ipaddress, port)
+    REPLIES_MAX = 64  # unanswered proxy client commands before they wait
+
+    def __init__(self, ipaddress, port, udp, transport=None):
+        if transport is None:
+            transport = TCPTransport(ipaddress, port)
+        super().__init__(ipaddress, port, transport)
         self.protocol = 'RIO'
-        self.sock = None
+        self.replies = collections.deque()
+        self.proxy_reply = False  # the line being processed answers a proxy client
 
-    ## Connect to the Russound via IP address 
     def Connect(self):
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        try:
-            self.sock.connect((self.ip, int(self.port)))
-            self.connected = True
-        except socket.error as msg:
-            LOGGER.error('Error trying to connect to russound controller.')
-            LOGGER.error(msg)
-            self.sock = None
-        
-        return self.sock
+        self.replies.clear()
+        super().Connect()
+
+    # Too many commands are waiting for their answer to take more from
+    # proxy clients.  Every one has to be remembered until it's answered.
+    def Busy(self):
+        return len(self.replies) >= self.REPLIES_MAX
+
+    '''
+    Answers to a proxy client's commands are processed like any other,
+    the zone values in them are good, but nobody here asked for them so
+    they must not be taken by getResponse() as the answer to ours.
+    '''
+    def IncomingQueue(self, data):
+        if not self.proxy_reply:
+            super().IncomingQueue(data)
+
+    def Heartbeat(self):
+        self.Send('GET VERSION')
+
+    # Every command gets an S or E reply, in order
+    def Sent(self, data, trace=None):
+        command = data.split(b' ', 1)[0].strip().decode(errors='replace')
+        self.metrics.inc('frames_out_total', command)
+        self.metrics.expect('reply', command, trace)
 
     def Send(self, data):
         try:
-            if self.sock:
-                LOGGER.debug('RIO: Sending {}'.format(data.encode()))
+            if self.connected:
+                RIOLOG.debug('RIO: Sending %r', data)
                 if not data.endswith('\r'):
                     data += '\r'
-                self.sock.sendall(data.encode())
+                self.Write(data.encode())
             else:
                 LOGGER.debug('Error trying to connect to russound controller.')
                 self.Connect()
-        except socket.error:
+        except OSError:
             LOGGER.debug('Error trying to connect to russound controller.')
             self.Connect()
 
-    # Main loop waits for messages from Russound and then processes them
+    # Main loop waits for messages from Russound and then processes them.
+    # Responses are lines ending in \r\n, keep any partial line until
+    # the rest of it arrives.
     def MessageLoop(self, processCommand):
+        partial = b''
         while self.connected:
             try:
-                data = self.sock.recv(4096)
+                data = self.transport.recv(4096)
                 if data == b'':
-                    LOGGER.debug('Connection Closed by Russound!')
+                    if self.connected:
+                        LOGGER.debug('Connection Closed by Russound!')
                     self.connected = False
                     break
 
-                riocmd = data.splitlines()
+                if self.profiling is not None:
+                    self.Profile('reader')
+                self.LinkActivity()
+                self.Captured(data)
+                self.metrics.inc('bytes_in_total', value=len(data))
+                riocmd = (partial + data).split(b'\n')
+                partial = riocmd.pop()
                 for x in riocmd:
+                    x = x.rstrip(b'\r')
+                    if x == b'':
+                        continue
                     try:
-                        processCommand(x.decode())
+                        x = x.decode()
+                        self.metrics.inc('frames_in_total', rio_key(x))
+                        self.proxy_reply = False
+                        if x[0] in 'SE':
+                            trace = self.metrics.answered('reply')
+                            if trace is not None:
+                                trace.mark('ack', x[0])
+                            self.proxy_reply = bool(self.replies) and self.replies.popleft()
+                        processCommand(x)
                     except Exception as e:
+                        self.metrics.inc('process_errors_total')
                         LOGGER.error('Data received error!  {}'.format(e))
             except BlockingIOError:
                 LOGGER.info('waiting on data')
                 pass
-            except ConnectionResetError as msg:
-                LOGGER.error('Connection error: ' + str(msg))
+            except OSError as msg:
+                if self.connected:
+                    LOGGER.error('Connection error: ' + str(msg))
                 self.connected = False
 
-        self.sock.close()
-        self.sock = None
-
 
     # Send a request to the controller to send various types of information
     # about a specific zone.
@@ -695,7 +1770,7 @@ class RIOConnection(Connection):
     # params 0 = bass, 1 = treble, 2 = loudness, 3 = balance,
     #        4 = turn on vol, 5 = mute, 6 = do no disturb, 7 = party mode
     def set_param(self, ctrl, rioZone, param, level):
-        LOGGER.debug('sending Zone:' + rioZone + ' level:' + str(level) )
+        RIOLOG.debug('sending Zone:%s level:%s', rioZone, level)
         if param == 0:
             data = 'SET ' + rioZone + '.bass="' + str(level-10) + '"\r'
         if param == 1:
@@ -773,7 +1848,7 @@ class RIOConnection(Connection):
         # TODO: Can we loop through controllers here and skip any that don't return type?
         # Get device type
         max_sources = 0
-        LOGGER.error('In request_config({})'.format(ctrl))
+        RIOLOG.debug('In request_config(%s)', ctrl)
         for ctrl in range(1,6):
             data = 'GET C[{}].type'.format(ctrl)
             self.Send(data)
@@ -781,7 +1856,7 @@ class RIOConnection(Connection):
             if ctrl_type.startswith('E'): # error
                 LOGGER.info('No controller found at address {}'.format(ctrl))
             else:
-                LOGGER.error('Controller type = {}'.format(ctrl_type))
+                LOGGER.info('Controller type = {}'.format(ctrl_type))
                 if ctrl_type.startswith('MBX'):
                     max_zones = 1
                     max_sources += 1
@@ -803,14 +1878,14 @@ class RIOConnection(Connection):
                     rioZone = 'C[{}].Z[{}]'.format(ctrl, z)
                     self.get_info(1, rioZone, 'name')
                     zname = self.getResponse()
-                    LOGGER.debug('GOT info for {} = {}'.format(rioZone, zname))
+                    RIOLOG.debug('GOT info for %s = %s', rioZone, zname)
 
         # max source is either 6, 8, or 1 depending on device.
         for s in range(1, max_sources+1):
             rioZone = 'S[{}]'.format(s)
             self.get_info(1, rioZone, 'name')
             sname = self.getResponse()
-            LOGGER.debug('GOT info for {} = {}'.format(rioZone, sname))
+            RIOLOG.debug('GOT info for %s = %s', rioZone, sname)
 
 
 
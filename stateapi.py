@@ -0,0 +1,175 @@
+#
+# Read-only HTTP/JSON view of the controller, zone and source state.
+#
+#  Everything is served from what the node server already knows (the
+#  controller and zone nodes), nothing is ever asked of the controller,
+#  so any number of clients can poll without adding RNET/RIO traffic.
+#
+#    - Every change to a node's values takes a new number from a single
+#      revision counter.  A resource's ETag is the highest revision of
+#      what it's made of, so it changes exactly when the content does.
+#    - Clients that send If-None-Match with the current ETag get a 304
+#      (webserver.py does that), others get the JSON, which is only
+#      rendered once per revision.
+#
+#  Paths, under /api/:
+#    state                                  all controllers
+#    controllers/<address>                  one controller, its sources and zones
+#    controllers/<address>/sources          its sources
+#    controllers/<address>/zones/<address>  one zone
+
+import itertools
+import json
+import os
+import threading
+
+# Part of every ETag, so ones from before a restart never match
+BOOT = os.urandom(4).hex()
+
+_revisions = itertools.count(1)
+
+
+# The next revision, for something that just changed
+def revision():
+    return next(_revisions)
+
+
+def etag(rev):
+    return '"{}-{}"'.format(BOOT, rev)
+
+
+# Zone drivers and what they're called in the JSON
+ZONE_FIELDS = (
+        ('ST', 'power', bool),
+        ('GV0', 'source', int),
+        ('SVOL', 'volume', int),
+        ('GV2', 'treble', int),
+        ('GV3', 'bass', int),
+        ('GV4', 'balance', int),
+        ('GV5', 'loudness', bool),
+        ('GV6', 'dnd', bool),
+        ('GV7', 'party', bool),
+        ('GV8', 'mute', bool),
+        ('GV9', 'page', bool),
+        ('GV10', 'shared_source', bool),
+        ('GV11', 'live', bool),
+        )
+ZONE_DRIVERS = {driver: (field, kind) for (driver, field, kind) in ZONE_FIELDS}
+
+
+'''
+(field, value) for a zone driver value as it's shown in the JSON, None
+for a driver that isn't.
+'''
+def zone_field(driver, value):
+    if driver not in ZONE_DRIVERS or value is None:
+        return None
+    (field, kind) = ZONE_DRIVERS[driver]
+    value = kind(value)
+    # sources are numbered from 1, like on the keypads
+    if field == 'source':
+        value += 1
+    return (field, value)
+
+
+def zone_state(node, sources):
+    z = {'address': node.address, 'name': node.name, 'source_name': None}
+    for (driver, field, kind) in ZONE_FIELDS:
+        item = zone_field(driver, node.getDriver(driver))
+        z[field] = item[1] if item is not None else None
+    z['live'] = not node.provisional
+    # values set by a command that the controller hasn't confirmed yet
+    z['pending'] = sorted(ZONE_DRIVERS[d][0] for d in list(node.pending) if d in ZONE_DRIVERS)
+    if z['source'] is not None and 0 < z['source'] <= len(sources):
+        z['source_name'] = sources[z['source'] - 1]
+    return z
+
+
+# Controller drivers that are part of its state
+CONTROLLER_DRIVERS = {
+        'ST': ('connected', bool),
+        'DON': ('last_source_on', int),
+        'DOF': ('last_source_off', int),
+        }
+
+
+def controller_state(node, zones):
+    sources = node.source_names()
+    details = node.details or {}
+    c = {
+            'address': node.address,
+            'name': node.name,
+            'protocol': details.get('protocol'),
+            'host': details.get('host'),
+            'sources': [{'number': n + 1, 'name': name} for (n, name) in enumerate(sources)],
+            'zones': [zone_state(z, sources) for z in zones],
+            }
+    for (driver, (field, kind)) in CONTROLLER_DRIVERS.items():
+        value = node.getDriver(driver)
+        c[field] = kind(value) if value is not None else None
+    return c
+
+
+'''
+controllers is a function returning the controller (RSController) nodes.
+handle() is the webserver route for /api/.
+'''
+class StateAPI:
+    CONTENT_TYPE = 'application/json'
+
+    def __init__(self, controllers):
+        self.controllers = controllers
+        self.lock = threading.Lock()
+        self.cache = {}  # path -> (etag, body)
+        self.listed = ((), 0)  # controller addresses, revision they were seen at
+
+    def handle(self, path):
+        parts = [p for p in path.split('/') if p]
+        nodes = {c.address: c for c in self.controllers()}
+
+        if parts == ['state']:
+            controllers = [(c, c.zone_nodes()) for (_, c) in sorted(nodes.items())]
+            # a controller going away has to change the ETag too
+            with self.lock:
+                if self.listed[0] != tuple(sorted(nodes)):
+                    self.listed = (tuple(sorted(nodes)), revision())
+                listed = self.listed[1]
+            rev = max([listed] + [c.revision for c in nodes.values()] +
+                      [z.revision for (_, zones) in controllers for z in zones])
+            return self.cached(path, rev, lambda: {
+                'controllers': [controller_state(c, zones) for (c, zones) in controllers]})
+
+        if len(parts) < 2 or parts[0] != 'controllers' or parts[1] not in nodes:
+            return None
+        node = nodes[parts[1]]
+
+        if len(parts) == 2:
+            zones = node.zone_nodes()
+            rev = max([node.revision] + [z.revision for z in zones])
+            return self.cached(path, rev, lambda: controller_state(node, zones))
+
+        if parts[2:] == ['sources']:
+            return self.cached(path, node.revision, lambda: [
+                {'number': n + 1, 'name': name} for (n, name) in enumerate(node.source_names())])
+
+        if len(parts) == 4 and parts[2] == 'zones':
+            for z in node.zone_nodes():
+                if z.address == parts[3]:
+                    # the source names are the controller's
+                    return self.cached(path, max(z.revision, node.revision),
+                                       lambda: zone_state(z, node.source_names()))
+        return None
+
+    '''
+    (content type, body, etag) for path at revision rev, rendering the
+    body with render() only if it isn't cached for that revision.
+    '''
+    def cached(self, path, rev, render):
+        tag = etag(rev)
+        with self.lock:
+            hit = self.cache.get(path)
+        if hit is None or hit[0] != tag:
+            hit = (tag, json.dumps(render(), sort_keys=True, separators=(',', ':')))
+            with self.lock:
+                self.cache[path] = hit
+        return (self.CONTENT_TYPE, hit[1], hit[0])
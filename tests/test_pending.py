@@ -0,0 +1,107 @@
+#
+# Zone values waiting on the controller to confirm them.
+#
+#  python3 -m unittest discover tests
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from tools import stubs
+stubs.use_if_missing()
+import udi_interface
+import clock
+from nodes import zone
+
+
+# Remembers what the zone asked the controller
+class FakeRNET:
+    protocol = 'RNET'
+    profiling = None
+
+    def __init__(self):
+        self.asked = []
+
+    def set_param(self, *args):
+        pass
+
+    def volume(self, *args):
+        pass
+
+    def get_info(self, ctrl, zone, info):
+        self.asked.append(info)
+
+
+class PendingTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = clock.VirtualClock()
+        self.saved = clock.default()
+        clock.set_default(self.clock)
+        self.poly = udi_interface.Interface([zone.Zone])
+        self.zone = zone.Zone(self.poly, 'rsmain_1', 'zone_1_1', 'Zone 1')
+        self.rnet = FakeRNET()
+        self.zone.setRNET(self.rnet)
+        self.poly.addNode(self.zone)
+
+    def tearDown(self):
+        clock.set_default(self.saved)
+
+    def cmd(self, cmd, value):
+        self.zone.process_cmd({'address': 'zone_1_1', 'cmd': cmd, 'value': str(value)})
+
+    def test_read_back_confirms(self):
+        self.cmd('VOLUME', 30)
+        self.assertIn('SVOL', self.zone.pending)
+        self.clock.advance(1)
+        self.assertEqual(len(self.rnet.asked), 1)
+        self.zone.set_volume(30)
+        self.assertEqual(self.zone.getDriver('SVOL'), 30)
+        self.assertNotIn('SVOL', self.zone.pending)
+
+    # The answer to the first read-back arrives after the second command
+    def test_stale_read_back_ignored(self):
+        self.cmd('BASS', 3)
+        self.clock.advance(1)
+        self.cmd('BASS', 5)
+        self.zone.set_bass(3 + 10)
+        self.assertEqual(self.zone.getDriver('GV3'), 5)
+        self.assertIn('GV3', self.zone.pending)
+        self.clock.advance(1)
+        self.zone.set_bass(5 + 10)
+        self.assertEqual(self.zone.getDriver('GV3'), 5)
+        self.assertNotIn('GV3', self.zone.pending)
+
+    # A read-back asked after the command is what the controller has
+    def test_clamped_value_committed(self):
+        self.cmd('VOLUME', 60)
+        self.clock.advance(1)
+        self.zone.set_volume(50)
+        self.assertEqual(self.zone.getDriver('SVOL'), 50)
+        self.assertNotIn('SVOL', self.zone.pending)
+        self.clock.advance(zone.Zone.PENDING_TIMEOUT * 2)
+        self.assertEqual(self.zone.getDriver('SVOL'), 50)
+
+    def test_expired_value_rolled_back(self):
+        self.zone.set_treble(10 + 2)
+        self.cmd('TREBLE', 4)
+        self.assertEqual(self.zone.getDriver('GV2'), 4)
+        self.clock.advance(zone.Zone.PENDING_TIMEOUT + 1)
+        self.assertEqual(self.zone.getDriver('GV2'), 2)
+        self.assertNotIn('GV2', self.zone.pending)
+
+    # Only the newest command's deadline rolls it back
+    def test_older_deadline_ignored(self):
+        self.zone.set_treble(10 + 2)
+        self.cmd('TREBLE', 4)
+        self.clock.advance(zone.Zone.PENDING_TIMEOUT - 1)
+        self.cmd('TREBLE', 6)
+        self.clock.advance(2)
+        self.assertEqual(self.zone.getDriver('GV2'), 6)
+        self.assertIn('GV2', self.zone.pending)
+        self.clock.advance(zone.Zone.PENDING_TIMEOUT)
+        self.assertEqual(self.zone.getDriver('GV2'), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+#
+# Sharing the controller connection through the proxy port.
+#
+#  python3 -m unittest discover tests
+
+import os
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from tools import stubs
+stubs.use_if_missing()
+import proxy
+import russound_main
+
+
+class RIORepliesTest(unittest.TestCase):
+    def setUp(self):
+        (ours, self.device) = russound_main.LoopbackTransport.pair()
+        self.device.open()
+        self.conn = russound_main.RIOConnection('test', 0, False, transport=ours)
+        self.conn.Connect()
+        # what RSController.RIOProcessCommand does with a reply
+        t = threading.Thread(target=self.conn.MessageLoop, args=(self.conn.IncomingQueue,))
+        t.daemon = True
+        t.start()
+
+    def tearDown(self):
+        self.conn.Close()
+
+    def answer(self, data):
+        self.device.send(data)
+        deadline = time.monotonic() + 5
+        while self.conn.replies and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    # A proxy client's answer arriving last isn't taken as ours
+    def test_proxy_reply_not_a_response(self):
+        self.conn.Send('GET C[1].type')
+        self.conn.Write(b'GET C[1].Z[1].volume\r', proxied=True)
+        self.answer(b'S C[1].type="MCA-C5"\r\nS C[1].Z[1].volume="20"\r\n')
+        self.assertEqual(self.conn.getResponse(), 'S C[1].type="MCA-C5"')
+
+    def test_own_replies_kept(self):
+        self.conn.Write(b'GET C[1].Z[1].volume\r', proxied=True)
+        self.conn.Send('GET C[1].type')
+        self.answer(b'S C[1].Z[1].volume="20"\r\nS C[1].type="MCA-C5"\r\n')
+        self.assertEqual(list(self.conn.incoming), ['S C[1].type="MCA-C5"'])
+
+    def test_busy_until_answered(self):
+        for _ in range(self.conn.REPLIES_MAX):
+            self.conn.Write(b'GET VERSION\r', proxied=True)
+        self.assertTrue(self.conn.Busy())
+        self.answer(b'S VERSION="1.0"\r\n' * self.conn.REPLIES_MAX)
+        self.assertFalse(self.conn.Busy())
+
+
+class LinkProxyTest(unittest.TestCase):
+    def test_listens_on_localhost(self):
+        p = proxy.LinkProxy(0, 'test')
+        p.start()
+        try:
+            self.assertEqual(p.listener.getsockname()[0], '127.0.0.1')
+        finally:
+            p.stop()
+
+
+if __name__ == '__main__':
+    unittest.main()
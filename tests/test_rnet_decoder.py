@@ -0,0 +1,130 @@
+#
+# RNET message framing, checksums and escapes.
+#
+#  python3 -m unittest discover tests
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from tools import stubs
+stubs.use_if_missing()
+import russound_main
+
+
+'''
+An RNET message on the wire.  body is everything between the start
+byte and the checksum, as sent (escapes included).  The checksum is
+RNETConnection.checksum's: the sum of the bytes before it plus how
+many there are.
+'''
+def wire(body):
+    data = b'\xf0' + bytes(body)
+    return data + bytes([(sum(data) + len(data)) & 0x7f, 0xf7])
+
+
+# A request from zone 3, with an escaped byte (0xf1 0x7a is 0x85)
+BODY = [0x00, 0x00, 0x7f, 0x00, 0x03, 0x70, 0x01, 0x04, 0x02, 0x00, 0xf1, 0x7a, 0x07]
+DECODED = bytes([0xf0, 0x00, 0x00, 0x7f, 0x00, 0x03, 0x70, 0x01, 0x04, 0x02, 0x00, 0x85, 0x07])
+
+
+class RNETDecoderTest(unittest.TestCase):
+    def setUp(self):
+        self.decoder = russound_main.RNETDecoder()
+
+    def assertStats(self, frames, corrupt, resyncs):
+        self.assertEqual(self.decoder.stats(), {'frames': frames, 'corrupt': corrupt, 'resyncs': resyncs})
+
+    def test_good_frame(self):
+        frame = wire(BODY)
+        frames = self.decoder.feed(frame)
+        self.assertEqual(frames, [DECODED + frame[-2:-1]])
+        self.assertStats(1, 0, 0)
+
+    def test_frame_split_across_reads(self):
+        frames = []
+        for b in wire(BODY) * 2:
+            frames += self.decoder.feed(bytes([b]))
+        self.assertEqual(len(frames), 2)
+        self.assertStats(2, 0, 0)
+
+    def test_bad_checksum_skipped(self):
+        bad = bytearray(wire(BODY))
+        bad[-2] ^= 0x01
+        frames = self.decoder.feed(bytes(bad) + wire(BODY))
+        self.assertEqual(len(frames), 1)
+        self.assertEqual(frames[0][:-1], DECODED)
+        self.assertStats(1, 1, 1)
+
+    def test_corrupt_byte_skipped(self):
+        bad = bytearray(wire(BODY))
+        bad[5] = 0x04  # zone 3 became zone 4 on the way
+        self.assertEqual(self.decoder.feed(bytes(bad)), [])
+        self.assertStats(0, 1, 0)
+
+    def test_unescaped_byte_skipped(self):
+        body = list(BODY)
+        body[10:12] = [0x85]  # not inverted
+        self.assertEqual(self.decoder.feed(wire(body)), [])
+        self.assertStats(0, 1, 0)
+        self.assertEqual(len(self.decoder.feed(wire(BODY))), 1)
+        self.assertStats(1, 1, 1)
+
+    def test_bad_invert_sequence_skipped(self):
+        body = list(BODY)
+        body[11] = 0xf1  # an escape can't escape an escape
+        self.assertEqual(self.decoder.feed(wire(body)), [])
+        self.assertStats(0, 1, 0)
+
+    def test_inverted_checksum_skipped(self):
+        data = b'\xf0' + bytes(BODY)
+        cksum = (sum(data) + len(data)) & 0x7f
+        frame = data + bytes([0xf1, 0xff & ~cksum, 0xf7])
+        self.assertEqual(self.decoder.feed(frame), [])
+        self.assertEqual(self.decoder.corrupt, 1)
+
+    def test_too_short_skipped(self):
+        self.assertEqual(self.decoder.feed(wire([0x00, 0x01])), [])
+        self.assertStats(0, 1, 0)
+
+    def test_start_byte_in_message(self):
+        # a message cut short by the next one, the second still decodes
+        frame = wire(BODY)
+        frames = self.decoder.feed(frame[:6] + frame)
+        self.assertEqual(len(frames), 1)
+        self.assertStats(1, 1, 1)
+
+    def test_resync_after_garbage(self):
+        frames = self.decoder.feed(b'\x12\x34\xf7\x00' + wire(BODY))
+        self.assertEqual(len(frames), 1)
+        self.assertStats(1, 0, 1)
+
+    def test_too_long_skipped(self):
+        body = [0x01] * (russound_main.RNETDecoder.MAX_FRAME + 1)
+        self.assertEqual(self.decoder.feed(wire(body) + wire(BODY)), [DECODED + wire(BODY)[-2:-1]])
+        self.assertStats(1, 1, 1)
+
+
+class RNETConnectionDecodeTest(unittest.TestCase):
+    # Only good messages reach the handler, the rest are counted
+    def test_corrupt_frames_counted(self):
+        (ours, theirs) = russound_main.LoopbackTransport.pair()
+        conn = russound_main.RNETConnection('test', 0, False, transport=ours)
+        conn.Connect()
+        handled = []
+        conn.processCommand = handled.append
+
+        bad = bytearray(wire(BODY))
+        bad[-2] ^= 0x01
+        conn.DataReceived(bytes(bad) + wire(BODY))
+        self.assertEqual(len(handled), 1)
+        self.assertEqual(handled[0].SourceZone(), 3)
+        self.assertEqual(conn.metrics.total('parse_errors_total'), 1)
+        self.assertEqual(conn.LinkStats()['corrupt'], 1)
+        self.assertEqual(conn.LinkStats()['resyncs'], 1)
+        conn.Close()
+
+
+if __name__ == '__main__':
+    unittest.main()
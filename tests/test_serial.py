@@ -0,0 +1,115 @@
+#
+# SERIAL network protocol, against a Linux pseudo-terminal pair.
+#
+#  python3 -m unittest discover tests
+
+import os
+import pty
+import queue
+import sys
+import threading
+import time
+import tty
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from tools import stubs
+stubs.use_if_missing()
+import russound_main
+from rnet_message import RNET_MSG_TYPE
+from tools.simulator import Simulator
+
+
+# Read exactly size bytes with read(size)
+def read_exactly(read, size, timeout=5):
+    data = b''
+    deadline = time.monotonic() + timeout
+    while len(data) < size and time.monotonic() < deadline:
+        data += read(size - len(data))
+    return data
+
+
+class SerialTransportTest(unittest.TestCase):
+    def setUp(self):
+        (self.master, self.slave) = pty.openpty()
+        tty.setraw(self.master)
+        self.device = os.ttyname(self.slave)
+        self.transport = russound_main.SerialTransport(self.device, 19200)
+
+    def tearDown(self):
+        self.transport.close()
+        for fd in (self.master, self.slave):
+            os.close(fd)
+
+    def test_round_trip(self):
+        self.transport.open()
+        # bytes with the high bit set, the line discipline must leave them
+        frame = bytes([0xf0, 0x00, 0x00, 0x7f, 0xf1, 0x0d, 0x0a, 0x11, 0x13, 0xf7])
+        os.write(self.master, frame)
+        self.assertEqual(read_exactly(self.transport.recv, len(frame)), frame)
+        self.transport.send(frame)
+        self.assertEqual(read_exactly(lambda n: os.read(self.master, n), len(frame)), frame)
+
+    def test_close_wakes_reader(self):
+        self.transport.open()
+        result = []
+        reader = threading.Thread(target=lambda: result.append(self.transport.recv(64)))
+        reader.start()
+        time.sleep(0.1)
+        self.transport.close()
+        reader.join(5)
+        self.assertFalse(reader.is_alive())
+        self.assertEqual(result, [b''])
+
+    def test_unsupported_baud(self):
+        transport = russound_main.SerialTransport(self.device, 12345)
+        with self.assertRaises(ValueError):
+            transport.open()
+
+
+class SerialConnectionTest(unittest.TestCase):
+    BAUD = 19200
+
+    def setUp(self):
+        self.sim = Simulator('RNET')
+        self.conn = russound_main.RNETConnection(self.sim.serve_pty(), self.BAUD, False, serial=True)
+        self.conn.Connect()
+        self.messages = queue.Queue()
+        t = threading.Thread(target=self.conn.MessageLoop, args=(self.messages.put,))
+        t.daemon = True
+        t.start()
+
+    def tearDown(self):
+        self.conn.Close()
+        self.sim.close()
+
+    def test_request_answered(self):
+        self.assertTrue(self.conn.connected)
+        self.sim.model.update(1, 2, 'volume', 23)
+        self.conn.get_info(1, 2, 0x0401)
+        msg = self.messages.get(timeout=5)
+        self.assertEqual(msg.MessageType(), RNET_MSG_TYPE.ZONE_VOLUME)
+        self.assertEqual(msg.TargetZone(), 2)
+        self.assertEqual(msg.MessageData(), 23)
+
+    def test_writes_paced_at_baud_rate(self):
+        self.assertAlmostEqual(self.conn.byte_time, 10.0 / self.BAUD)
+        count = 20
+        start = time.monotonic()
+        for _ in range(count):
+            self.conn.get_info(1, 0, 0x0401)
+        elapsed = time.monotonic() - start
+        # each write waits for the one before it to go out on the wire
+        self.assertGreaterEqual(elapsed, (count - 1) * 17 * 10.0 / self.BAUD)
+        for _ in range(count):
+            self.assertEqual(self.messages.get(timeout=5).MessageType(), RNET_MSG_TYPE.ZONE_VOLUME)
+
+    def test_no_pacing_without_baud_rate(self):
+        self.conn.setBaudRate(0)
+        self.assertEqual(self.conn.byte_time, 0)
+        self.conn.get_info(1, 0, 0x0401)
+        self.assertEqual(self.conn.next_write, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,342 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmarks for the protocol hot paths.
+
+Copyright (C) 2020,2021,2022 Robert Paauwe
+
+Runs offline, no controller or Polyglot needed.  The udi_interface
+stand-in in tools/stubs is used when the real package isn't installed.
+For each benchmark it reports
+
+  ops/s        best of several timed runs
+  peak B/op    bytes allocated while doing a single operation (tracemalloc)
+  kept B/op    bytes still allocated afterwards, averaged over many
+               operations.  Anything above 0 here is growing memory.
+
+Results can be saved as a JSON baseline and later runs compared against
+it.  A benchmark that is slower than the baseline by more than the
+threshold is flagged and the exit status is 1.
+
+Usage:
+    python3 -m tools.bench                      # run everything
+    python3 -m tools.bench -k rnet_message      # only names containing this
+    python3 -m tools.bench --save base.json     # store a baseline
+    python3 -m tools.bench --compare base.json --threshold 0.10
+"""
+
+import argparse
+import gc
+import json
+import logging
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from tools import stubs
+stubs.use_if_missing()
+import russound_main
+import rnet_message
+from nodes import russound
+from tools.simulator import Model, RNETSession
+
+TARGET_TIME = 0.2   # seconds per timed run
+REPEAT = 5
+
+
+# Accepts anything a Connection writes and throws it away
+class NullTransport(russound_main.Transport):
+    def open(self):
+        pass
+
+    def recv(self, size):
+        return b''
+
+    def send(self, data):
+        pass
+
+
+# Stands in for the Polyglot interface and zone nodes, every call is a no-op
+class Sink:
+    def __getattr__(self, name):
+        return self
+
+    def __call__(self, *args, **kwargs):
+        return self
+
+
+def rnet_connection():
+    conn = russound_main.RNETConnection('bench', 0, False, transport=NullTransport())
+    conn.Connect()
+    return conn
+
+
+def rio_connection():
+    conn = russound_main.RIOConnection('bench', 0, False, transport=NullTransport())
+    conn.Connect()
+    return conn
+
+
+# An RSController without a Polyglot behind it, enough for the
+# message handlers and decode_config.
+def controller(conn):
+    node = russound.RSController.__new__(russound.RSController)
+    node.poly = Sink()
+    node.rnet = conn
+    node.name = 'bench'
+    node.address = 'bench'
+    node.wait = False
+    node.raw_config = bytearray(0)
+    node.source_status = 0
+    node.recorder = russound_main.FlightRecorder()
+    node.ctrl_config = {'sourceInfo': {'source_count': 0, 'sources': []}, 'ctrlInfo': []}
+    return node
+
+
+'''
+Sample messages, as the device sends them.  The simulator builds them
+so they match what the node server sees from a real controller.
+'''
+def sample_frames():
+    frames = {}
+    sent = []
+    session = RNETSession(Model(1, 6, 6), sent.append, packet_size=64)
+
+    def capture(name, fn):
+        del sent[:]
+        fn()
+        frames[name] = bytes(sent[0])
+
+    capture('all_zone_info', lambda: session.send_zone_info(1, 2, [0x07]))
+    capture('zone_volume', lambda: session.send_zone_info(1, 2, [0x01]))
+    capture('zone_source', lambda: session.send_zone_info(1, 2, [0x02]))
+    capture('zone_bass', lambda: session.send_zone_info(1, 2, [0x00, 0x00]))
+    capture('controller_config', lambda: session.send_config_packet(1, [0, 0, 0x7b], [], session.model.config_blob(1), 1, 160))
+    capture('keypad_event', lambda: session.keypad(1, 2, 'next'))
+    capture('handshake', lambda: session.send_handshake(bytearray(frames['zone_volume'])))
+    return frames
+
+
+# Unescaped message as the decoder hands it to RNetMessage
+def decoded(frame):
+    return russound_main.RNETDecoder().feed(frame)[0]
+
+
+def bench_rnet_decoder():
+    frames = sample_frames()
+    stream = b''.join(frames.values()) * 20
+    count = len(frames) * 20
+    decoder = russound_main.RNETDecoder()
+
+    def run():
+        decoder.feed(stream)
+    return ('rnet_decoder_feed', run, count)
+
+
+def bench_rnet_message():
+    benches = []
+    for (name, frame) in sample_frames().items():
+        msg = decoded(frame)
+        benches.append(('rnet_message_' + name, lambda msg=msg: rnet_message.RNetMessage(msg), 1))
+    return benches
+
+
+def bench_decode_paths():
+    msg = rnet_message.RNetMessage(decoded(sample_frames()['zone_volume']))
+    paths = [bytearray(p) for p in ([2, 0, 1, 1], [2, 0, 1, 0, 3], [3, 0, 2], [1, 1], [0, 0], [4, 0])]
+
+    def run():
+        for p in paths:
+            msg.decode_paths(p)
+    return ('decode_paths', run, len(paths))
+
+
+def bench_builders():
+    conn = rnet_connection()
+    return [
+        ('build_get_info', lambda: conn.get_info(1, 2, 0x0407), 1),
+        ('build_get_info_5', lambda: conn.get_info(1, 2, 0x0500), 1),
+        ('build_set_param', lambda: conn.set_param(1, 2, 0x00, 12), 1),
+        ('build_volume', lambda: conn.volume(1, 2, 30), 1),
+        ('build_set_source', lambda: conn.set_source(1, 2, 3), 1),
+        ]
+
+
+def bench_checksum():
+    conn = rnet_connection()
+    data = bytearray(sample_frames()['all_zone_info'][:-2])
+    return ('checksum', lambda: conn.checksum(data, len(data)), 1)
+
+
+def bench_decode_config():
+    node = controller(rnet_connection())
+    blob = Model(1, 6, 6).config_blob(1)
+
+    def run():
+        node.ctrl_config = {'sourceInfo': {'source_count': 0, 'sources': []}, 'ctrlInfo': []}
+        node.decode_config(blob)
+    return ('decode_config', run, 1)
+
+
+def bench_rio_process():
+    conn = rio_connection()
+    node = controller(conn)
+    lines = [
+        'N C[1].Z[2].volume="25"',
+        'N C[1].Z[2].status="ON"',
+        'N C[1].Z[2].currentSource="3"',
+        'N C[1].Z[2].bass="-2"',
+        'N C[1].Z[2].mute="OFF"',
+        'S C[1].type="MCA-C5"',
+        'S S[2].name="Source 2"',
+        'S',
+        ]
+
+    def run():
+        for line in lines:
+            node.RIOProcessCommand(line)
+        conn.incoming.clear()
+        del node.ctrl_config['sourceInfo']['sources'][:]
+    return ('rio_process_command', run, len(lines))
+
+
+BENCHMARKS = [
+        bench_rnet_decoder,
+        bench_rnet_message,
+        bench_decode_paths,
+        bench_builders,
+        bench_checksum,
+        bench_decode_config,
+        bench_rio_process,
+        ]
+
+
+def collect():
+    benches = []
+    for factory in BENCHMARKS:
+        result = factory()
+        if isinstance(result, list):
+            benches.extend(result)
+        else:
+            benches.append(result)
+    return benches
+
+
+# Time fn, returns operations per second (count operations per call)
+def timeit(fn, count):
+    # find a loop size that runs for about TARGET_TIME
+    loops = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(loops):
+            fn()
+        elapsed = time.perf_counter() - start
+        if elapsed >= TARGET_TIME / 10 or loops >= 1 << 24:
+            break
+        loops *= 4
+    loops = max(1, int(loops * TARGET_TIME / max(elapsed, 1e-9)))
+
+    best = 0
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(REPEAT):
+            start = time.perf_counter()
+            for _ in range(loops):
+                fn()
+            elapsed = time.perf_counter() - start
+            best = max(best, loops * count / elapsed)
+    finally:
+        if gc_enabled:
+            gc.enable()
+    return best
+
+
+def allocations(fn, count, loops=200):
+    fn()  # warm up caches, lazy imports, ...
+    gc.collect()
+    tracemalloc.start()
+    try:
+        base = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        fn()
+        peak = tracemalloc.get_traced_memory()[1] - base
+
+        gc.collect()
+        base = tracemalloc.get_traced_memory()[0]
+        for _ in range(loops):
+            fn()
+        gc.collect()
+        kept = tracemalloc.get_traced_memory()[0] - base
+    finally:
+        tracemalloc.stop()
+    return (peak / count, max(0, kept) / (loops * count))
+
+
+def run(pattern=None):
+    results = {}
+    for (name, fn, count) in collect():
+        if pattern and pattern not in name:
+            continue
+        ops = timeit(fn, count)
+        (peak, kept) = allocations(fn, count)
+        results[name] = {'ops_per_sec': round(ops, 1), 'peak_bytes_per_op': round(peak, 1),
+                         'kept_bytes_per_op': round(kept, 2)}
+    return results
+
+
+# Returns the names of benchmarks slower than baseline by more than threshold
+def compare(results, baseline, threshold):
+    regressions = []
+    for (name, r) in results.items():
+        base = baseline.get('results', {}).get(name)
+        if base is None:
+            continue
+        change = r['ops_per_sec'] / base['ops_per_sec'] - 1
+        r['change'] = round(change, 3)
+        if change < -threshold:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Russound node server micro-benchmarks')
+    parser.add_argument('-k', dest='pattern', help='only run benchmarks with this in their name')
+    parser.add_argument('--save', help='write results to this JSON baseline file')
+    parser.add_argument('--compare', help='compare with this JSON baseline file')
+    parser.add_argument('--threshold', type=float, default=0.15,
+                        help='slowdown (fraction) that counts as a regression')
+    args = parser.parse_args()
+
+    # We're measuring the code, not the log handlers
+    logging.disable(logging.CRITICAL)
+
+    results = run(args.pattern)
+
+    regressions = []
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+
+    print('{:<34} {:>14} {:>11} {:>10} {:>8}'.format('benchmark', 'ops/s', 'peak B/op', 'kept B/op', 'change'))
+    for (name, r) in results.items():
+        change = '{:+.1%}'.format(r['change']) if 'change' in r else ''
+        flag = '  REGRESSION' if name in regressions else ''
+        print('{:<34} {:>14,.0f} {:>11.1f} {:>10.2f} {:>8}{}'.format(
+            name, r['ops_per_sec'], r['peak_bytes_per_op'], r['kept_bytes_per_op'], change, flag))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'python': platform.python_version(), 'machine': platform.machine(),
+                       'created': time.strftime('%Y-%m-%d %H:%M:%S'), 'results': results}, f, indent=2)
+        print('baseline saved to {}'.format(args.save))
+
+    if regressions:
+        print('{} benchmark(s) slower than baseline by more than {:.0%}'.format(len(regressions), args.threshold))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
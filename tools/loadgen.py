@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+"""
+End-to-end load generator.
+
+Copyright (C) 2020,2021,2022 Robert Paauwe
+
+Runs an RSController and its Zone nodes against the stand-in Polyglot
+interface (tools/stubs) and the controller simulator, then fires ISY commands at
+Zone.process_cmd at a fixed rate from a pool of worker threads, the way
+Polyglot hands commands to a node server.  At the same time the
+simulated controller changes zones on its own (someone at a keypad) so
+the receive side is loaded as well.
+
+Measured, as percentiles:
+
+  queue      how late a command started compared to when it was due.
+             Grows without bound once the workers can't keep up.
+  command    time spent in process_cmd
+  to wire    process_cmd called until its first message was written
+  to driver  controller changed a zone until setDriver was called for it
+
+Usage:
+    python3 -m tools.loadgen --protocol RNET --rate 20 --duration 30
+    python3 -m tools.loadgen --protocol RIO --workers 8 --mix VOLUME=1,DFON=1
+"""
+
+import argparse
+import json
+import logging
+import os
+import queue
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from tools import stubs
+stubs.use_if_missing()
+from nodes import russound
+from nodes import zone
+from tools.simulator import Simulator
+from tools.stubs.udi_interface import Interface
+
+# Relative weights of the ISY commands sent to zones
+DEFAULT_MIX = {
+        'VOLUME': 40,
+        'SOURCE': 10,
+        'DFON': 10,
+        'DFOF': 10,
+        'GV12': 5,   # volume up
+        'GV13': 5,   # volume down
+        'GV14': 5,   # next source (keypad)
+        'GV16': 5,   # forward (keypad)
+        'BRT': 5,    # plus (keypad)
+        'DIM': 5,    # minus (keypad)
+        }
+
+
+def percentiles(samples):
+    if not samples:
+        return {'count': 0}
+    s = sorted(samples)
+
+    def pct(p):
+        return round(s[min(len(s) - 1, int(p / 100.0 * len(s)))] * 1000, 3)
+    return {'count': len(s), 'p50_ms': pct(50), 'p90_ms': pct(90), 'p99_ms': pct(99),
+            'max_ms': round(s[-1] * 1000, 3)}
+
+
+class LoadGenerator:
+    def __init__(self, protocol='RNET', controllers=1, zones=6, sources=6, workers=4,
+                 latency=0.0, baud=0, mix=None, seed=1):
+        self.protocol = protocol.upper()
+        self.workers = workers
+        self.mix = mix or DEFAULT_MIX
+        self.random = random.Random(seed)
+        self.sim = Simulator(self.protocol, controllers, zones, sources, latency, baud)
+        self.poly = Interface([russound.RSController, zone.Zone])
+        self.zones = []
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.pending = {}     # (address, driver, value) -> time the controller changed it
+        self.samples = {'queue': [], 'command': [], 'to_wire': [], 'to_driver': []}
+        self.errors = 0
+        self.completed = 0
+
+    def setup(self):
+        port = self.sim.serve_tcp()
+        details = {'ip_addr': '127.0.0.1', 'port': port, 'nwprotocol': 'TCP',
+                   'protocol': self.protocol, 'controller': 1,
+                   'host': '127.0.0.1:{}'.format(port)}
+        self.node = russound.RSController(self.poly, 'rsmain_1', 'rsmain_1', 'Load', details)
+        conn = self.node.rnet
+        conn.Connect()
+        if not conn.connected:
+            raise RuntimeError('unable to connect to the simulator')
+
+        if self.protocol == 'RNET':
+            handler = self.node.RNETProcessCommand
+        else:
+            handler = self.node.RIOProcessCommand
+        t = threading.Thread(target=conn.MessageLoop, args=(handler,), daemon=True)
+        t.start()
+
+        # Time the first write of each command
+        write = conn.Write
+
+        def timed_write(data):
+            write(data)
+            start = getattr(self.local, 'start', None)
+            if start is not None:
+                self.local.start = None
+                self.record('to_wire', time.monotonic() - start)
+        conn.Write = timed_write
+
+        # Zone nodes, set up the way discover() does it minus the delays
+        for c in self.sim.model.controllers:
+            for (z, zinfo) in enumerate(c.zones):
+                addr = 'zone_{}_{}'.format(c.number, z + 1)
+                node = zone.Zone(self.poly, self.node.address, addr, zinfo.name)
+                node.setRNET(conn)
+                self.instrument(node)
+                self.poly.addNode(node)
+                node.Ready()
+                self.zones.append((c.number, z, node))
+                if self.protocol == 'RIO':
+                    conn.get_info(c.number, 'C[{}].Z[{}]'.format(c.number, z + 1), 'all')
+
+    def instrument(self, node):
+        set_driver = node.setDriver
+
+        def timed_set_driver(driver, value, *args, **kwargs):
+            now = time.monotonic()
+            with self.lock:
+                changed = self.pending.pop((node.address, driver, value), None)
+            if changed is not None:
+                self.record('to_driver', now - changed)
+            return set_driver(driver, value, *args, **kwargs)
+        node.setDriver = timed_set_driver
+
+    def record(self, name, value):
+        with self.lock:
+            self.samples[name].append(value)
+
+    def command(self):
+        (ctrl, z, node) = self.random.choice(self.zones)
+        name = self.random.choices(list(self.mix.keys()), list(self.mix.values()))[0]
+        if name == 'VOLUME':
+            value = self.random.randint(0, 50)
+        elif name == 'SOURCE':
+            value = self.random.randint(0, len(self.sim.model.sources) - 1)
+        else:
+            value = 0
+        return (node, {'address': node.address, 'cmd': name, 'value': str(value), 'query': {}})
+
+    def worker(self, jobs):
+        while True:
+            job = jobs.get()
+            if job is None:
+                break
+            (due, node, cmd) = job
+            start = time.monotonic()
+            self.record('queue', max(0, start - due))
+            self.local.start = start
+            try:
+                node.process_cmd(cmd)
+            except Exception as e:
+                logging.debug('{} failed: {}'.format(cmd, e))
+                with self.lock:
+                    self.errors += 1
+            self.local.start = None
+            self.record('command', time.monotonic() - start)
+            with self.lock:
+                self.completed += 1
+
+    # Somebody is using a keypad, change a zone on the controller side
+    def device_change(self):
+        (ctrl, z, node) = self.random.choice(self.zones)
+        volume = self.random.randint(0, 50)
+        with self.lock:
+            self.pending[(node.address, 'SVOL', volume)] = time.monotonic()
+        self.sim.model.update(ctrl, z, 'volume', volume)
+
+    def run(self, rate, duration, events=0.0):
+        jobs = queue.Queue()
+        threads = [threading.Thread(target=self.worker, args=(jobs,), daemon=True)
+                   for _ in range(self.workers)]
+        for t in threads:
+            t.start()
+
+        start = time.monotonic()
+        next_cmd = start
+        next_event = start
+        sent = 0
+        while True:
+            now = time.monotonic()
+            if now - start >= duration:
+                break
+            if rate > 0 and now >= next_cmd:
+                (node, cmd) = self.command()
+                jobs.put((next_cmd, node, cmd))
+                sent += 1
+                next_cmd += 1.0 / rate
+            if events > 0 and now >= next_event:
+                self.device_change()
+                next_event += 1.0 / events
+            wake = min(next_cmd if rate > 0 else start + duration,
+                       next_event if events > 0 else start + duration)
+            time.sleep(max(0, min(wake, start + duration) - time.monotonic()))
+
+        backlog = jobs.qsize()
+        for t in threads:
+            jobs.put(None)
+        for t in threads:
+            t.join(30)
+        elapsed = time.monotonic() - start
+
+        return {
+                'protocol': self.protocol,
+                'duration_s': round(elapsed, 3),
+                'offered_per_s': rate,
+                'completed_per_s': round(self.completed / elapsed, 2),
+                'commands_sent': sent,
+                'commands_completed': self.completed,
+                'backlog_at_end': backlog,
+                'errors': self.errors,
+                'publishes': self.poly.publish_counts,
+                'device_changes_lost': len(self.pending),
+                'latency': {k: percentiles(v) for (k, v) in self.samples.items()},
+                }
+
+    def close(self):
+        self.node.rnet.Drop()
+        self.sim.close()
+
+
+def parse_mix(text):
+    mix = {}
+    for item in text.split(','):
+        (name, weight) = item.split('=')
+        mix[name.strip().upper()] = float(weight)
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Russound node server load generator')
+    parser.add_argument('--protocol', default='RNET', choices=['RNET', 'RIO', 'rnet', 'rio'])
+    parser.add_argument('--controllers', type=int, default=1)
+    parser.add_argument('--zones', type=int, default=6)
+    parser.add_argument('--sources', type=int, default=6)
+    parser.add_argument('--workers', type=int, default=4, help='threads running process_cmd')
+    parser.add_argument('--rate', type=float, default=10, help='ISY commands per second')
+    parser.add_argument('--events', type=float, default=5, help='controller side changes per second')
+    parser.add_argument('--duration', type=float, default=20, help='seconds')
+    parser.add_argument('--latency', type=float, default=0.0, help='simulator reply latency (s)')
+    parser.add_argument('--baud', type=int, default=0, help='simulate a serial link at this baud rate')
+    parser.add_argument('--mix', help='command weights, i.e. VOLUME=4,SOURCE=1,DFON=1')
+    parser.add_argument('--json', help='also write the results to this file')
+    parser.add_argument('--debug', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.WARNING)
+    if not args.debug:
+        logging.disable(logging.ERROR)  # the nodes log a lot at ERROR
+
+    # discover() and the profile helpers write to profile/, keep them
+    # away from the real one.
+    if args.json:
+        args.json = os.path.abspath(args.json)
+    here = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+    work = tempfile.mkdtemp(prefix='rsload')
+    shutil.copytree(os.path.join(here, 'profile'), os.path.join(work, 'profile'))
+    os.chdir(work)
+
+    gen = LoadGenerator(args.protocol, args.controllers, args.zones, args.sources,
+                        args.workers, args.latency, args.baud,
+                        parse_mix(args.mix) if args.mix else None)
+    try:
+        gen.setup()
+        results = gen.run(args.rate, args.duration, args.events)
+    finally:
+        gen.close()
+        shutil.rmtree(work, ignore_errors=True)
+
+    print(json.dumps(results, indent=2))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
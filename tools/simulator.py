@@ -0,0 +1,833 @@
+#!/usr/bin/env python3
+"""
+Russound controller simulator for load and latency testing.
+
+Copyright (C) 2020,2021,2022 Robert Paauwe
+
+Speaks enough RNET (over TCP, UDP, a pseudo-terminal or an in-memory
+transport) and RIO
+(over TCP or an in-memory transport) that russound_main and the node
+server can run against it unmodified.  The simulated system is a chain
+of controllers, each with a number of zones, sharing a set of sources.
+
+RNET
+  - CONTROLLER_CONFIG requests are answered with a multi-packet
+    configuration blob, the next packet is sent when the previous one
+    is acknowledged (handshake), just like the real thing.
+  - Zone parameter requests (volume, source, state, all zone info,
+    bass, treble, ...) are answered with set data messages.
+  - Set data messages are acknowledged with a handshake.
+  - Events (volume, source, zone on/off, all on/off, keypad keys) update
+    the zone and the new value is sent back unsolicited.
+  - keypad() injects keypad events as if a button was pressed.
+
+RIO
+  - GET / SET / EVENT / WATCH for C[n].type, C[n].Z[n].<key>, S[n].name
+    and VERSION.  Changes are sent as N notifications to watchers.
+
+The serial link can be modelled by setting the baud rate, which paces
+everything the simulator sends, and a fixed response latency can be
+added to every reply.
+
+Usage:
+    python3 -m tools.simulator --protocol RNET --tcp 5000 --controllers 2
+    python3 -m tools.simulator --protocol RIO --tcp 9621 --zones 8
+    python3 -m tools.simulator --serial --baud 19200
+"""
+
+import argparse
+import logging
+import pty
+import socket
+import threading
+import time
+import sys
+import os
+import tty
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from rnet_message import ZONE_NAMES, SOURCE_NAMES
+
+LOGGER = logging.getLogger('simulator')
+
+# Offsets into the configuration blob that RSController.decode_config
+# reads.  Everything else in the blob is unknown and left as zero.
+CONFIG_SIZE = 0x2728 + 10 * 20
+CONFIG_SOURCE = 2
+CONFIG_SOURCE_SIZE = 24
+CONFIG_ZONE = 0x92
+CONFIG_ZONE_SIZE = 562
+
+# get_info parameter numbers to zone attribute
+RNET_ZONE_PARAMS = {
+        0x01: 'volume',
+        0x02: 'source',
+        0x06: 'power',
+        }
+RNET_ZONE_EXTRA = {
+        0x00: 'bass',
+        0x01: 'treble',
+        0x02: 'loudness',
+        0x03: 'balance',
+        0x04: 'turn_on_volume',
+        0x05: 'background',
+        0x06: 'dnd',
+        0x07: 'party',
+        }
+
+# RNET keypad key event ids
+KEYS = {
+        'previous': 0x67, 'next': 0x68, 'plus': 0x69, 'minus': 0x6a,
+        'source': 0x6b, 'power': 0x6c, 'stop': 0x6d, 'pause': 0x6e,
+        'fav1': 0x6f, 'fav2': 0x70, 'play': 0x73, 'volup': 0x7f,
+        'voldown': 0x80,
+        }
+
+RIO_PARTY = ['OFF', 'ON', 'MASTER']
+
+
+class SimZone:
+    def __init__(self, name, name_index):
+        self.name = name
+        self.name_index = name_index
+        self.power = 0
+        self.source = 0        # zero based
+        self.volume = 20
+        self.bass = 10         # 0 - 20, 10 is flat
+        self.treble = 10
+        self.balance = 10
+        self.loudness = 0
+        self.turn_on_volume = 20
+        self.background = 0
+        self.dnd = 0
+        self.party = 0
+        self.mute = 0
+
+
+class SimController:
+    def __init__(self, number, ctype, zones):
+        self.number = number   # 1 based
+        self.type = ctype
+        self.zones = zones
+
+
+'''
+The simulated system.  Protocol sessions read and change it and get
+told about every change so they can notify their client.
+'''
+class Model:
+    def __init__(self, controllers=1, zones=6, sources=6, ctype='MCA-C5'):
+        self.lock = threading.RLock()
+        self.sessions = []
+        self.controllers = []
+        zone_index = 18  # 'Living Room'
+        for c in range(1, controllers + 1):
+            zlist = []
+            for z in range(0, zones):
+                idx = zone_index % len(ZONE_NAMES)
+                zlist.append(SimZone(ZONE_NAMES[idx], idx))
+                zone_index += 1
+            self.controllers.append(SimController(c, ctype, zlist))
+
+        # 'Source 1' through 'Source 8' and then the named sources
+        self.sources = []
+        for s in range(0, sources):
+            idx = 65 + s if s < 8 else s
+            self.sources.append((SOURCE_NAMES[idx], idx))
+
+    def controller(self, ctrl):
+        if ctrl < 1 or ctrl > len(self.controllers):
+            return None
+        return self.controllers[ctrl - 1]
+
+    def zone(self, ctrl, zone):
+        c = self.controller(ctrl)
+        if c is None or zone < 0 or zone >= len(c.zones):
+            return None
+        return c.zones[zone]
+
+    def register(self, session):
+        with self.lock:
+            self.sessions.append(session)
+
+    def unregister(self, session):
+        with self.lock:
+            if session in self.sessions:
+                self.sessions.remove(session)
+
+    # Change a zone attribute and tell everyone about it
+    def update(self, ctrl, zone, attr, value, origin=None):
+        with self.lock:
+            z = self.zone(ctrl, zone)
+            if z is None:
+                return
+            setattr(z, attr, value)
+            sessions = list(self.sessions)
+
+        for s in sessions:
+            try:
+                s.zone_changed(ctrl, zone, attr, origin)
+            except Exception as e:
+                LOGGER.debug('notify failed: {}'.format(e))
+
+    # RNET configuration blob, as decode_config expects to find it
+    def config_blob(self, ctrl):
+        c = self.controller(ctrl)
+        blob = bytearray(CONFIG_SIZE)
+        blob[0] = len(self.sources)
+        blob[1] = len(c.zones)
+        for s, (name, idx) in enumerate(self.sources):
+            blob[CONFIG_SOURCE + s * CONFIG_SOURCE_SIZE] = idx
+        for z, zone in enumerate(c.zones):
+            blob[CONFIG_ZONE + z * CONFIG_ZONE_SIZE] = zone.name_index
+        return blob
+
+
+'''
+Base protocol session.  Reads from the client on its own thread and
+writes replies with the configured latency and baud rate pacing.
+'''
+class Session:
+    def __init__(self, model, send, latency=0.0, baud=0):
+        self.model = model
+        self.send_raw = send
+        self.latency = latency
+        self.byte_time = 10.0 / baud if baud > 0 else 0
+        self.write_lock = threading.Lock()
+        self.closed = False
+        self.rx_bytes = 0
+        self.tx_bytes = 0
+        self.received = []      # (monotonic time, request) log, see record
+        self.record = False
+        model.register(self)
+
+    def write(self, data, delay=True):
+        with self.write_lock:
+            if delay and self.latency > 0:
+                time.sleep(self.latency)
+            if self.byte_time > 0:
+                time.sleep(len(data) * self.byte_time)
+            try:
+                self.send_raw(bytes(data))
+                self.tx_bytes += len(data)
+            except OSError as e:
+                LOGGER.debug('write failed: {}'.format(e))
+                self.close()
+
+    def feed(self, data):
+        self.rx_bytes += len(data)
+
+    def zone_changed(self, ctrl, zone, attr, origin):
+        pass
+
+    def close(self):
+        self.closed = True
+        self.model.unregister(self)
+
+    # Read data with recv until it returns b'' or fails
+    def run(self, recv):
+        try:
+            while not self.closed:
+                data = recv(4096)
+                if data == b'':
+                    break
+                self.feed(data)
+        except OSError:
+            pass
+        self.close()
+
+
+class RNETSession(Session):
+    def __init__(self, model, send, latency=0.0, baud=0, packet_size=64):
+        super().__init__(model, send, latency, baud)
+        self.packet_size = packet_size
+        self.buf = bytearray()
+        self.active = False
+        self.invert = False
+        self.config = None     # (ctrl, target, source, blob, next packet)
+        self.bad_frames = 0
+
+    # Build a message from unencoded values.  Anything with the high bit
+    # set is sent as 0xf1 + inverted value.  The checksum is computed on
+    # the bytes as they go on the wire, the same as RNETConnection does.
+    def frame(self, values):
+        wire = bytearray(b'\xf0')
+        for v in values:
+            v &= 0xff
+            if v & 0x80:
+                wire.append(0xf1)
+                wire.append(~v & 0x7f)
+            else:
+                wire.append(v)
+        wire.append((sum(wire) + len(wire)) & 0x7f)
+        wire.append(0xf7)
+        return wire
+
+    def feed(self, data):
+        super().feed(data)
+        for b in data:
+            if b == 0xf0:
+                self.buf = bytearray(b'\xf0')
+                self.wire_sum = 0xf0
+                self.wire_count = 1
+                self.active = True
+                self.invert = False
+            elif not self.active:
+                continue
+            elif b == 0xf7:
+                self.active = False
+                cksum = self.buf[-1] if len(self.buf) > 1 else -1
+                if len(self.buf) < 9 or ((self.wire_sum - cksum) + self.wire_count - 1) & 0x7f != cksum:
+                    self.bad_frames += 1
+                    continue
+                if self.record:
+                    self.received.append((time.monotonic(), bytes(self.buf)))
+                try:
+                    self.handle(self.buf[:-1])
+                except (IndexError, ValueError) as e:
+                    LOGGER.debug('bad request {}: {}'.format(self.buf.hex(), e))
+            else:
+                self.wire_sum += b
+                self.wire_count += 1
+                if b == 0xf1:
+                    self.invert = True
+                    continue
+                if self.invert:
+                    self.invert = False
+                    b = ~b & 0xff
+                self.buf.append(b)
+
+    def paths(self, msg):
+        idx = 8
+        tlen = msg[idx]
+        target = list(msg[idx + 1:idx + 1 + tlen])
+        idx += 1 + tlen
+        slen = msg[idx]
+        source = list(msg[idx + 1:idx + 1 + slen])
+        idx += 1 + slen
+        return (target, source, idx)
+
+    def handle(self, msg):
+        mtype = msg[7]
+        if mtype == 0x00:
+            self.set_data(msg)
+        elif mtype == 0x01:
+            self.request_data(msg)
+        elif mtype == 0x02:
+            self.handshake(msg)
+        elif mtype == 0x05:
+            self.event(msg)
+
+    def handshake(self, msg):
+        if self.config is None:
+            return
+        (ctrl, target, source, blob, pkt) = self.config
+        count = (len(blob) + self.packet_size - 1) // self.packet_size
+        if pkt >= count:
+            self.config = None
+            return
+        self.send_config_packet(ctrl, target, source, blob, pkt, count)
+
+    def send_config_packet(self, ctrl, target, source, blob, pkt, count):
+        data = blob[pkt * self.packet_size:(pkt + 1) * self.packet_size]
+        values = list(target) + [ctrl - 1, 0x00, 0x7f, 0x00]
+        values += [3, 0x03, 0x00, 0x02, 3, 0x03, ctrl - 1, 0x02]
+        # packet number, count and length are little endian 16 bit values
+        values += [pkt & 0xff, pkt >> 8, count & 0xff, count >> 8, len(data) & 0xff, len(data) >> 8]
+        values += list(data)
+        self.config = (ctrl, target, source, blob, pkt + 1)
+        self.write(self.frame(values), delay=(pkt == 0))
+
+    def request_data(self, msg):
+        (tpath, spath, idx) = self.paths(msg)
+        requester = list(msg[4:7])
+
+        if len(tpath) == 3 and tpath[0] == 0x03 and tpath[2] == 0x02:
+            # controller configuration
+            ctrl = tpath[1] + 1
+            if self.model.controller(ctrl) is None:
+                return  # nothing there to answer
+            blob = self.model.config_blob(ctrl)
+            count = (len(blob) + self.packet_size - 1) // self.packet_size
+            self.send_config_packet(ctrl, requester, spath, blob, 0, count)
+        elif len(tpath) in (4, 5) and tpath[0] == 0x02:
+            self.send_zone_info(tpath[1] + 1, tpath[2], tpath[3:])
+
+    # Answer a zone parameter request (or send an unsolicited update).
+    # The reply is addressed to the zone and the path is relative to
+    # the controller, which is what RNetMessage expects.
+    def send_zone_info(self, ctrl, zone, param, delay=True):
+        z = self.model.zone(ctrl, zone)
+        if z is None:
+            return
+
+        if len(param) == 1 and param[0] in (0x04, 0x07):
+            data = [z.power, z.source, z.volume, z.bass, z.treble, z.loudness,
+                    z.balance, z.party, z.dnd, z.turn_on_volume, z.background]
+        elif len(param) == 1 and param[0] in RNET_ZONE_PARAMS:
+            data = [getattr(z, RNET_ZONE_PARAMS[param[0]])]
+        elif len(param) == 2 and param[1] in RNET_ZONE_EXTRA:
+            data = [getattr(z, RNET_ZONE_EXTRA[param[1]])]
+        else:
+            return
+
+        path = [0x02, 0x00, zone] + list(param)
+        values = [ctrl - 1, zone, 0x70, ctrl - 1, 0x00, 0x7f, 0x00]
+        values += [0, len(path)] + path
+        values += [0, 0, 1, 0, len(data), 0] + data
+        self.write(self.frame(values), delay)
+
+    def send_handshake(self, msg):
+        values = list(msg[4:7]) + list(msg[1:4]) + [0x02, msg[7]]
+        self.write(self.frame(values))
+
+    def set_data(self, msg):
+        (tpath, spath, idx) = self.paths(msg)
+        self.send_handshake(msg)
+
+        if len(tpath) == 5 and tpath[0] == 0x02 and tpath[4] in RNET_ZONE_EXTRA:
+            ctrl = msg[1] + 1
+            level = msg[idx + 6]
+            self.model.update(ctrl, tpath[2], RNET_ZONE_EXTRA[tpath[4]], level, self)
+
+    def event(self, msg):
+        (tpath, spath, idx) = self.paths(msg)
+        eid = msg[idx] | (msg[idx + 1] << 8)
+        ets = msg[idx + 2] | (msg[idx + 3] << 8)
+        edata = msg[idx + 4] | (msg[idx + 5] << 8)
+        ctrl = msg[1] + 1
+        src_zone = msg[5]
+
+        if eid == 0xdc:    # zone on/off
+            self.model.update(ctrl, edata, 'power', 1 if ets else 0)
+        elif eid == 0xdd:  # all zones on/off
+            for c in self.model.controllers:
+                for z in range(0, len(c.zones)):
+                    self.model.update(c.number, z, 'power', 1 if ets else 0)
+        elif eid == 0xde:  # volume
+            self.model.update(ctrl, edata, 'volume', min(ets, 50))
+        elif eid == 0xc1:  # select source
+            if edata < len(self.model.sources):
+                self.model.update(ctrl, src_zone, 'source', edata)
+                self.model.update(ctrl, src_zone, 'power', 1)
+        elif eid in (0x7f, 0x80):  # volume up / down
+            z = self.model.zone(ctrl, src_zone)
+            if z is not None:
+                step = 2 if eid == 0x7f else -2
+                self.model.update(ctrl, src_zone, 'volume', max(0, min(50, z.volume + step)))
+        elif eid == 0x6b:  # next source
+            z = self.model.zone(ctrl, src_zone)
+            if z is not None:
+                self.model.update(ctrl, src_zone, 'source', (z.source + 1) % len(self.model.sources))
+
+    def zone_changed(self, ctrl, zone, attr, origin):
+        # let the client know, the same as if it had asked
+        if origin is self:
+            return  # the client will read it back
+        for (param, name) in RNET_ZONE_PARAMS.items():
+            if name == attr:
+                self.send_zone_info(ctrl, zone, [param], delay=False)
+        for (param, name) in RNET_ZONE_EXTRA.items():
+            if name == attr:
+                self.send_zone_info(ctrl, zone, [0x00, param], delay=False)
+
+    # Send a keypad event as if a button on the zone's keypad was pressed
+    def keypad(self, ctrl, zone, key):
+        eid = KEYS[key] if isinstance(key, str) else key
+        values = [ctrl - 1, 0x00, 0x7f, ctrl - 1, zone, 0x70, 0x05]
+        values += [2, 0x02, 0x00, 0]
+        values += [eid & 0xff, eid >> 8, 0, 0, 0, 0, 1]
+        self.write(self.frame(values), delay=False)
+
+
+class RIOSession(Session):
+    VERSION = '1.08.00'
+
+    def __init__(self, model, send, latency=0.0, baud=0):
+        super().__init__(model, send, latency, baud)
+        self.partial = b''
+        self.watching = set()
+
+    def reply(self, line, delay=True):
+        self.write((line + '\r\n').encode(), delay)
+
+    def feed(self, data):
+        super().feed(data)
+        lines = (self.partial + data).replace(b'\n', b'\r').split(b'\r')
+        self.partial = lines.pop()
+        for line in lines:
+            line = line.decode(errors='replace').strip()
+            if line == '':
+                continue
+            if self.record:
+                self.received.append((time.monotonic(), line))
+            try:
+                self.handle(line)
+            except (IndexError, ValueError) as e:
+                self.reply('E {}'.format(e))
+
+    # Parse C[c].Z[z] into (ctrl, zero based zone)
+    def parse_zone(self, target):
+        if not target.startswith('C[') or '.Z[' not in target:
+            raise ValueError('Invalid zone {}'.format(target))
+        ctrl = int(target[2:target.index(']')])
+        zone = int(target[target.index('.Z[') + 3:target.rindex(']')]) - 1
+        return (ctrl, zone)
+
+    def zone_value(self, z, key):
+        if key == 'name':
+            return z.name
+        elif key == 'status':
+            return 'ON' if z.power else 'OFF'
+        elif key == 'volume':
+            return str(z.volume)
+        elif key == 'currentSource':
+            return str(z.source + 1)
+        elif key in ('bass', 'treble', 'balance'):
+            return str(getattr(z, key) - 10)
+        elif key == 'turnOnVolume':
+            return str(z.turn_on_volume)
+        elif key == 'loudness':
+            return 'ON' if z.loudness else 'OFF'
+        elif key == 'mute':
+            return 'ON' if z.mute else 'OFF'
+        elif key == 'doNotDisturb':
+            return 'ON' if z.dnd else 'OFF'
+        elif key == 'partyMode':
+            return RIO_PARTY[z.party]
+        raise ValueError('Unknown key {}'.format(key))
+
+    def handle(self, line):
+        (cmd, _, rest) = line.partition(' ')
+        cmd = cmd.upper()
+        if cmd == 'GET':
+            self.get(rest.strip())
+        elif cmd == 'SET':
+            self.set(rest.strip())
+        elif cmd == 'EVENT':
+            self.event(rest.strip())
+        elif cmd == 'WATCH':
+            self.watch(rest.strip())
+        else:
+            self.reply('E Unknown command')
+
+    def get(self, key):
+        if key == 'VERSION':
+            self.reply('S VERSION="{}"'.format(self.VERSION))
+            return
+
+        if key.startswith('S['):
+            s = int(key[2:key.index(']')])
+            name = self.model.sources[s - 1][0] if 0 < s <= len(self.model.sources) else ''
+            self.reply('S {}="{}"'.format(key, name))
+            return
+
+        (target, _, attr) = key.rpartition('.')
+        if '.Z[' not in target:
+            # controller key
+            c = self.model.controller(int(target[2:target.index(']')]))
+            if c is None:
+                self.reply('E Controller not found')
+            elif attr == 'type':
+                self.reply('S {}="{}"'.format(key, c.type))
+            else:
+                self.reply('E Invalid key')
+            return
+
+        (ctrl, zone) = self.parse_zone(target)
+        c = self.model.controller(ctrl)
+        if c is None:
+            self.reply('E Controller not found')
+            return
+        z = self.model.zone(ctrl, zone)
+        value = '' if z is None else self.zone_value(z, attr)
+        self.reply('S {}="{}"'.format(key, value))
+
+    def set(self, arg):
+        (key, _, value) = arg.partition('=')
+        value = value.strip().strip('"')
+        (target, _, attr) = key.strip().rpartition('.')
+        (ctrl, zone) = self.parse_zone(target)
+        if self.model.zone(ctrl, zone) is None:
+            self.reply('E Zone not found')
+            return
+
+        if attr in ('bass', 'treble', 'balance'):
+            self.model.update(ctrl, zone, attr, int(value) + 10)
+        elif attr == 'turnOnVolume':
+            self.model.update(ctrl, zone, 'turn_on_volume', int(value))
+        elif attr == 'loudness':
+            self.model.update(ctrl, zone, 'loudness', 1 if value == 'ON' else 0)
+        else:
+            self.reply('E Invalid key')
+            return
+        self.reply('S')
+
+    def event(self, arg):
+        (target, _, event) = arg.partition('!')
+        (ctrl, zone) = self.parse_zone(target.strip())
+        z = self.model.zone(ctrl, zone)
+        if z is None:
+            self.reply('E Zone not found')
+            return
+
+        words = event.split()
+        name = words[0] if words else ''
+        self.reply('S')
+
+        if name == 'ZoneOn':
+            self.model.update(ctrl, zone, 'power', 1)
+        elif name == 'ZoneOff':
+            self.model.update(ctrl, zone, 'power', 0)
+        elif name in ('AllOn', 'AllOff'):
+            for c in self.model.controllers:
+                for zn in range(0, len(c.zones)):
+                    self.model.update(c.number, zn, 'power', 1 if name == 'AllOn' else 0)
+        elif name == 'ZoneMuteOn':
+            self.model.update(ctrl, zone, 'mute', 1)
+        elif name == 'ZoneMuteOff':
+            self.model.update(ctrl, zone, 'mute', 0)
+        elif name == 'DoNotDisturb':
+            self.model.update(ctrl, zone, 'dnd', 1 if words[1] == 'On' else 0)
+        elif name == 'PartyMode':
+            self.model.update(ctrl, zone, 'party', ['Off', 'On', 'Master'].index(words[1]))
+        elif name in ('KeyPress', 'KeyRelease') and len(words) > 1:
+            key = words[1]
+            if key == 'Volume':
+                self.model.update(ctrl, zone, 'volume', max(0, min(50, int(words[2]))))
+            elif key == 'VolumeUp':
+                self.model.update(ctrl, zone, 'volume', min(50, z.volume + 1))
+            elif key == 'VolumeDown':
+                self.model.update(ctrl, zone, 'volume', max(0, z.volume - 1))
+            elif key == 'SelectSource':
+                self.model.update(ctrl, zone, 'source', int(words[2]) - 1)
+                self.model.update(ctrl, zone, 'power', 1)
+            elif key == 'NextSource':
+                self.model.update(ctrl, zone, 'source', (z.source + 1) % len(self.model.sources))
+
+    def watch(self, arg):
+        words = arg.split()
+        (ctrl, zone) = self.parse_zone(words[0])
+        z = self.model.zone(ctrl, zone)
+        if z is None:
+            self.reply('E Zone not found')
+            return
+        on = len(words) < 2 or words[1].upper() == 'ON'
+        if on:
+            self.watching.add((ctrl, zone))
+        else:
+            self.watching.discard((ctrl, zone))
+        self.reply('S')
+
+        if on:
+            for key in ('name', 'status', 'volume', 'currentSource', 'bass',
+                        'treble', 'balance', 'loudness', 'turnOnVolume',
+                        'mute', 'doNotDisturb', 'partyMode'):
+                self.reply('N {}.{}="{}"'.format(words[0], key, self.zone_value(z, key)), delay=False)
+
+    def zone_changed(self, ctrl, zone, attr, origin):
+        if (ctrl, zone) not in self.watching:
+            return
+        keys = {'power': 'status', 'source': 'currentSource', 'turn_on_volume': 'turnOnVolume',
+                'dnd': 'doNotDisturb', 'party': 'partyMode'}
+        key = keys.get(attr, attr)
+        z = self.model.zone(ctrl, zone)
+        try:
+            value = self.zone_value(z, key)
+        except ValueError:
+            return
+        self.reply('N C[{}].Z[{}].{}="{}"'.format(ctrl, zone + 1, key, value), delay=False)
+
+
+'''
+Glue between the model, the protocol sessions and the ways a client can
+reach them (TCP, UDP or an in-memory transport).
+'''
+class Simulator:
+    def __init__(self, protocol='RNET', controllers=1, zones=6, sources=6,
+                 latency=0.0, baud=0, ctype='MCA-C5', packet_size=64):
+        self.protocol = protocol.upper()
+        self.model = Model(controllers, zones, sources, ctype)
+        self.latency = latency
+        self.baud = baud
+        self.packet_size = packet_size
+        self.sessions = []
+        self.servers = []
+        self.clients = []
+        self.ptys = []
+        self.threads = []
+
+    def new_session(self, send):
+        if self.protocol == 'RNET':
+            session = RNETSession(self.model, send, self.latency, self.baud, self.packet_size)
+        else:
+            session = RIOSession(self.model, send, self.latency, self.baud)
+        self.sessions.append(session)
+        return session
+
+    def __start(self, target, args, name):
+        t = threading.Thread(target=target, args=args, name=name)
+        t.daemon = True
+        t.start()
+        self.threads = [x for x in self.threads if x.is_alive()]
+        self.threads.append(t)
+        return t
+
+    # Serve a transport end (i.e. LoopbackTransport) that a Connection
+    # is using.  The transport only needs recv/send/close.
+    def attach(self, transport):
+        session = self.new_session(transport.send)
+        self.__start(session.run, (transport.recv,), 'sim-session')
+        return session
+
+    def serve_tcp(self, host='127.0.0.1', port=0):
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind((host, port))
+        server.listen(16)
+        self.servers.append(server)
+        self.__start(self.__accept, (server,), 'sim-tcp')
+        return server.getsockname()[1]
+
+    def __accept(self, server):
+        while True:
+            try:
+                (conn, addr) = server.accept()
+            except OSError:
+                break
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            LOGGER.info('client connected from {}'.format(addr))
+            session = self.new_session(conn.sendall)
+            self.__start(self.__serve_conn, (session, conn), 'sim-client')
+
+    def __serve_conn(self, session, conn):
+        self.clients.append(conn)
+        session.run(conn.recv)
+        self.clients.remove(conn)
+        self.sessions.remove(session)
+        conn.close()
+
+    # Hang up on every TCP client, as if the controller was power cycled
+    def drop_clients(self):
+        for conn in list(self.clients):
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    # RNET over UDP. Replies go to peer or, if not set, to whoever sent
+    # the last datagram.
+    def serve_udp(self, host='127.0.0.1', port=0, peer=None):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((host, port))
+        self.servers.append(sock)
+        state = {'peer': peer}
+        session = self.new_session(lambda data: state['peer'] and sock.sendto(data, state['peer']))
+
+        def recv(size):
+            (data, addr) = sock.recvfrom(size)
+            if peer is None:
+                state['peer'] = addr
+            return data
+
+        self.__start(session.run, (recv,), 'sim-udp')
+        return sock.getsockname()[1]
+
+    '''
+    RNET over a pseudo-terminal, as if the controller was plugged in to a
+    serial port.  Returns the device to open (the SERIAL network
+    protocol), i.e. /dev/pts/3.  Both ends are raw, nothing is translated.
+    '''
+    def serve_pty(self):
+        (master, slave) = pty.openpty()
+        tty.setraw(master)
+        tty.setraw(slave)
+        self.ptys.extend((master, slave))
+
+        def send(data):
+            view = memoryview(data)
+            while len(view) > 0:
+                view = view[os.write(master, view):]
+
+        session = self.new_session(send)
+        # the slave stays open here, so the device is there until close()
+        self.__start(session.run, (lambda size: os.read(master, size),), 'sim-pty')
+        return os.ttyname(slave)
+
+    def keypad(self, ctrl, zone, key):
+        for s in list(self.sessions):
+            if isinstance(s, RNETSession) and not s.closed:
+                s.keypad(ctrl, zone, key)
+
+    def close(self):
+        for s in self.servers:
+            try:
+                s.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            s.close()
+        for s in self.sessions:
+            s.close()
+        for fd in self.ptys:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+        self.ptys = []
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Russound RNET/RIO controller simulator')
+    parser.add_argument('--protocol', default='RNET', choices=['RNET', 'RIO', 'rnet', 'rio'])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--tcp', type=int, help='listen for TCP connections on this port')
+    parser.add_argument('--udp', type=int, help='RNET over UDP on this port')
+    parser.add_argument('--peer', help='UDP peer address ip:port')
+    parser.add_argument('--serial', action='store_true', help='RNET on a pseudo-terminal')
+    parser.add_argument('--controllers', type=int, default=1)
+    parser.add_argument('--zones', type=int, default=6)
+    parser.add_argument('--sources', type=int, default=6)
+    parser.add_argument('--type', default='MCA-C5', help='RIO controller type')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to each reply')
+    parser.add_argument('--baud', type=int, default=0, help='pace output at this baud rate')
+    parser.add_argument('--keypad', type=float, default=0, help='send a random keypad event every N seconds (RNET)')
+    parser.add_argument('--debug', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO)
+    sim = Simulator(args.protocol, args.controllers, args.zones, args.sources,
+                    args.latency, args.baud, args.type)
+
+    if args.tcp is not None:
+        port = sim.serve_tcp(args.host, args.tcp)
+        LOGGER.info('{} simulator listening on TCP {}:{}'.format(sim.protocol, args.host, port))
+    if args.udp is not None:
+        peer = None
+        if args.peer:
+            (ip, p) = args.peer.split(':')
+            peer = (ip, int(p))
+        port = sim.serve_udp(args.host, args.udp, peer)
+        LOGGER.info('{} simulator on UDP {}:{}'.format(sim.protocol, args.host, port))
+
+    if args.serial:
+        device = sim.serve_pty()
+        LOGGER.info('{} simulator on serial {}'.format(sim.protocol, device))
+
+    keys = list(KEYS.keys())
+    n = 0
+    try:
+        while True:
+            if args.keypad > 0:
+                time.sleep(args.keypad)
+                ctrl = 1 + n % args.controllers
+                sim.keypad(ctrl, n % args.zones, keys[n % len(keys)])
+                n += 1
+            else:
+                time.sleep(60)
+    except KeyboardInterrupt:
+        sim.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+"""
+Long-run soak test.
+
+Copyright (C) 2020,2021,2022 Robert Paauwe
+
+Runs the whole node server (Controller, RSController, Zone nodes)
+against the stand-in Polyglot interface and the controller simulator
+for a long period of virtual time.  Along the way it
+
+  - sends bursts of ISY commands to the zones
+  - changes zones from the controller side (keypads)
+  - hangs up on the node server so it has to reconnect
+  - saves the configuration again, which re-provisions the controller
+
+and samples resident memory, tracemalloc's view of the heap (plus the
+top allocators) and the number of threads.  Once it has warmed up, any
+of them growing past its bound fails the run (exit status 1).
+
+Usage:
+    python3 -m tools.soak --hours 24
+    python3 -m tools.soak --protocol RIO --hours 72 --max-threads 4
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from tools import stubs
+stubs.use_if_missing()
+import clock
+import udi_interface
+from nodes import control
+from nodes import russound
+from nodes import zone
+from tools.simulator import Simulator
+
+
+def rss_bytes():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        # peak, not current, but it's what we have.  KB on Linux.
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Soak:
+    def __init__(self, args):
+        self.args = args
+        self.random = random.Random(args.seed)
+        self.clock = clock.VirtualClock()
+        clock.set_default(self.clock)
+        self.sim = Simulator(args.protocol, args.controllers, args.zones, args.sources)
+        self.poly = udi_interface.Interface([russound.RSController, zone.Zone])
+        self.samples = []
+        self.baseline = None
+        self.failures = []
+        self.counts = {'commands': 0, 'command_errors': 0, 'device_changes': 0,
+                       'reconnects': 0, 'config_changes': 0}
+
+    def config(self, capture='off'):
+        port = self.port
+        return {'Controller': [{'ip_addr': '127.0.0.1', 'port': port, 'nwprotocol': 'TCP',
+                                'protocol': self.args.protocol, 'capture': capture}]}
+
+    def setup(self):
+        self.port = self.sim.serve_tcp()
+        self.controller = control.Controller(self.poly)
+        self.controller.typedDataHandler(self.config())
+        self.node = self.poly.getNode('rsmain_1')
+
+        # RSController.start() never returns, it keeps the link up
+        t = threading.Thread(target=self.poly.trigger, args=(self.poly.START,),
+                             kwargs={'address': 'rsmain_1'}, name='start')
+        t.daemon = True
+        t.start()
+
+    def zones(self):
+        return [n for n in self.poly.nodes() if n.address.startswith('zone_')]
+
+    def burst(self):
+        zones = self.zones()
+        if not zones:
+            return
+        for _ in range(self.args.burst_size):
+            node = self.random.choice(zones)
+            cmd = self.random.choice(['VOLUME', 'SOURCE', 'DFON', 'DFOF', 'BASS', 'GV12'])
+            value = {'VOLUME': self.random.randint(0, 50), 'SOURCE': self.random.randint(0, 2),
+                     'BASS': self.random.randint(-10, 10)}.get(cmd)
+            try:
+                self.poly.command(node.address, cmd, value)
+            except Exception as e:
+                logging.debug('{} {} failed: {}'.format(node.address, cmd, e))
+                self.counts['command_errors'] += 1
+            self.counts['commands'] += 1
+
+    def device_change(self):
+        c = self.random.choice(self.sim.model.controllers)
+        z = self.random.randrange(len(c.zones))
+        self.sim.model.update(c.number, z, 'volume', self.random.randint(0, 50))
+        self.counts['device_changes'] += 1
+
+    def sample(self, hours):
+        gc_snapshot = tracemalloc.take_snapshot()
+        top = gc_snapshot.statistics('lineno')[:self.args.top]
+        s = {
+                'hours': round(hours, 2),
+                'rss_mb': round(rss_bytes() / 1048576, 2),
+                'traced_mb': round(tracemalloc.get_traced_memory()[0] / 1048576, 3),
+                'threads': threading.active_count(),
+                'incoming': len(self.node.rnet.incoming) if self.node and self.node.rnet else 0,
+                'events': len(self.poly.events),
+                'top': ['{}:{} {:.1f}KB'.format(t.traceback[0].filename, t.traceback[0].lineno,
+                                                t.size / 1024) for t in top],
+                }
+        # The stand-in keeps every event, that's ours not the node server's
+        self.poly.reset()
+        self.samples.append(s)
+        return s
+
+    def check(self, s):
+        b = self.baseline
+        problems = []
+        if s['rss_mb'] - b['rss_mb'] > self.args.max_rss_growth:
+            problems.append('RSS grew {:.1f}MB'.format(s['rss_mb'] - b['rss_mb']))
+        if s['traced_mb'] - b['traced_mb'] > self.args.max_traced_growth:
+            problems.append('traced memory grew {:.2f}MB'.format(s['traced_mb'] - b['traced_mb']))
+        if s['threads'] > self.args.max_threads:
+            problems.append('{} threads running'.format(s['threads']))
+        return problems
+
+    def run(self):
+        a = self.args
+        tracemalloc.start(a.frames)
+        self.setup()
+
+        hour = 3600.0
+        start = self.clock.monotonic()
+        end = start + a.hours * hour
+        due = {
+                'burst': start + a.burst_every,
+                'device': start + a.device_every,
+                'reconnect': start + a.reconnect_every,
+                'config': start + a.config_every,
+                'sample': start + a.warmup * hour,
+                }
+        capture = 'off'
+        real_start = time.monotonic()
+
+        while self.clock.monotonic() < end:
+            self.clock.sleep(a.step)
+            now = self.clock.monotonic()
+
+            if now >= due['burst']:
+                self.burst()
+                due['burst'] += a.burst_every
+            if now >= due['device']:
+                self.device_change()
+                due['device'] += a.device_every
+            if now >= due['reconnect']:
+                self.sim.drop_clients()
+                self.counts['reconnects'] += 1
+                due['reconnect'] += a.reconnect_every
+            if now >= due['config']:
+                capture = 'on' if capture == 'off' else 'off'
+                self.controller.typedDataHandler(self.config(capture))
+                self.counts['config_changes'] += 1
+                due['config'] += a.config_every
+            if now >= due['sample']:
+                s = self.sample((now - start) / hour)
+                if self.baseline is None:
+                    self.baseline = s
+                else:
+                    problems = self.check(s)
+                    if problems:
+                        self.failures.append({'hours': s['hours'], 'problems': problems, 'top': s['top']})
+                if a.verbose:
+                    print(json.dumps({k: v for (k, v) in s.items() if k != 'top'}), flush=True)
+                due['sample'] += a.sample_every
+
+        tracemalloc.stop()
+        return {
+                'virtual_hours': a.hours,
+                'real_seconds': round(time.monotonic() - real_start, 1),
+                'counts': self.counts,
+                'baseline': self.baseline,
+                'final': self.samples[-1] if self.samples else None,
+                'failures': self.failures,
+                }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Russound node server soak test')
+    parser.add_argument('--protocol', default='RNET', choices=['RNET', 'RIO'])
+    parser.add_argument('--controllers', type=int, default=1)
+    parser.add_argument('--zones', type=int, default=6)
+    parser.add_argument('--sources', type=int, default=3)
+    parser.add_argument('--hours', type=float, default=24, help='virtual hours to run')
+    parser.add_argument('--warmup', type=float, default=1, help='virtual hours before the baseline sample')
+    parser.add_argument('--step', type=float, default=5, help='virtual seconds per harness step')
+    parser.add_argument('--burst-every', type=float, default=900, help='virtual seconds between command bursts')
+    parser.add_argument('--burst-size', type=int, default=20)
+    parser.add_argument('--device-every', type=float, default=60, help='virtual seconds between keypad changes')
+    parser.add_argument('--reconnect-every', type=float, default=3 * 3600)
+    parser.add_argument('--config-every', type=float, default=8 * 3600)
+    parser.add_argument('--sample-every', type=float, default=3600)
+    parser.add_argument('--max-rss-growth', type=float, default=20, help='MB over the baseline')
+    parser.add_argument('--max-traced-growth', type=float, default=2, help='MB over the baseline')
+    parser.add_argument('--max-threads', type=int, default=12)
+    parser.add_argument('--top', type=int, default=5, help='top allocators to report')
+    parser.add_argument('--frames', type=int, default=1, help='tracemalloc traceback depth')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='also write the results to this file')
+    parser.add_argument('-v', '--verbose', action='store_true', help='print each sample')
+    args = parser.parse_args()
+    args.protocol = args.protocol.upper()
+
+    logging.basicConfig(level=logging.WARNING)
+    logging.disable(logging.ERROR)  # the nodes log a lot at ERROR
+
+    # The node server writes profile/ and logs/ in its working directory
+    if args.json:
+        args.json = os.path.abspath(args.json)
+    here = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+    work = tempfile.mkdtemp(prefix='rssoak')
+    shutil.copytree(os.path.join(here, 'profile'), os.path.join(work, 'profile'))
+    os.chdir(work)
+
+    try:
+        results = Soak(args).run()
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+    print(json.dumps(results, indent=2))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    if results['failures']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
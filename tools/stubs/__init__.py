@@ -0,0 +1,23 @@
+"""
+Stand-in packages for running the node server offline.
+
+Copyright (C) 2020,2021,2022 Robert Paauwe
+
+The tools call use_if_missing() before importing any of the node server
+modules.  The stand-ins are only put on the path for packages that are
+not installed, a real udi_interface always wins.
+"""
+
+import importlib.util
+import os
+import sys
+
+STUBS = os.path.dirname(os.path.abspath(__file__))
+PACKAGES = ['udi_interface']
+
+
+def use_if_missing():
+    missing = [p for p in PACKAGES if importlib.util.find_spec(p) is None]
+    if missing and STUBS not in sys.path:
+        sys.path.append(STUBS)
+    return missing
@@ -0,0 +1,280 @@
+"""
+Stand-in for the udi_interface package.
+
+Copyright (C) 2020,2021,2022 Robert Paauwe
+
+Implements the part of udi_interface the node server uses (Interface,
+Node, Custom and LOGGER) without Polyglot or an MQTT broker, so the
+nodes can be run, timed and profiled offline.
+
+Everything the node server asks Polyglot to do is recorded in
+Interface.events as (monotonic time, kind, address, detail) and every
+message that would have been published to the broker is counted, by
+type, in Interface.publish_counts.
+
+Only used by the tools.  See tools/stubs/__init__.py.
+"""
+
+import copy
+import logging
+import threading
+import time
+
+LOGGER = logging.getLogger('udi_interface')
+
+
+'''
+Custom data (parameters, typed data, notices, ...).  A dictionary
+that tells the interface when it is changed.
+'''
+class Custom(dict):
+    def __init__(self, poly, name):
+        super().__init__()
+        self.poly = poly
+        self.name = name
+
+    def __changed(self, key):
+        if isinstance(self.poly, Interface):
+            self.poly.record(self.name, None, key)
+            self.poly.send({self.name: dict(self)}, 'custom')
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.__changed(key)
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.__changed(key)
+
+    def clear(self):
+        had = len(self) > 0
+        super().clear()
+        if had:
+            self.__changed(None)
+
+    def load(self, data, save=False):
+        super().clear()
+        if isinstance(data, dict):
+            self.update(data)
+        else:
+            self['data'] = data
+        self.__changed(None)
+
+    def delete(self, key):
+        if key in self:
+            del self[key]
+
+
+class Node:
+    id = ''
+    drivers = []
+    commands = {}
+    hint = '0x00000000'
+
+    def __init__(self, polyglot, primary, address, name):
+        self.poly = polyglot
+        self.primary = primary
+        self.address = address
+        self.name = name
+        self.private = ''
+        self.added = False
+        # each node gets its own copy of the class driver list
+        self.drivers = copy.deepcopy(self.drivers)
+
+    def __driver(self, driver):
+        for d in self.drivers:
+            if d['driver'] == driver:
+                return d
+        return None
+
+    def setDriver(self, driver, value, report=True, force=False, uom=None, text=None):
+        d = self.__driver(driver)
+        if d is None:
+            d = {'driver': driver, 'value': None, 'uom': uom}
+            self.drivers.append(d)
+
+        changed = d['value'] != value or (uom is not None and d.get('uom') != uom)
+        d['value'] = value
+        if uom is not None:
+            d['uom'] = uom
+        if text is not None:
+            d['text'] = text
+
+        self.poly.record('driver', self.address, (driver, value, changed))
+        if report and (changed or force):
+            self.reportDriver(driver, force)
+
+    def getDriver(self, driver):
+        d = self.__driver(driver)
+        return None if d is None else d['value']
+
+    def reportDriver(self, driver, force=False):
+        d = self.__driver(driver)
+        if d is not None:
+            self.poly.send({'set': [{'address': self.address, 'driver': driver,
+                                     'value': d['value'], 'uom': d.get('uom')}]}, 'status')
+
+    def reportDrivers(self):
+        for d in self.drivers:
+            self.reportDriver(d['driver'])
+
+    def reportCmd(self, command, value=None, uom=None):
+        self.poly.record('command', self.address, (command, value))
+        self.poly.send({'command': [{'address': self.address, 'cmd': command,
+                                     'value': value, 'uom': uom}]}, 'command')
+
+    def query(self):
+        self.reportDrivers()
+
+    def delNode(self, address):
+        self.poly.delNode(address)
+
+    # Run an ISY command the way Polyglot would
+    def runCmd(self, command):
+        fun = self.commands.get(command['cmd'])
+        if fun is None:
+            LOGGER.error('{} has no command {}'.format(self.address, command['cmd']))
+            return
+        fun(self, command)
+
+
+class Interface:
+    CONFIG = 'CONFIG'
+    CONFIGDONE = 'CONFIGDONE'
+    START = 'START'
+    STOP = 'STOP'
+    POLL = 'POLL'
+    LOGLEVEL = 'LOGLEVEL'
+    DISCOVER = 'DISCOVER'
+    DELETE = 'DELETE'
+    ADDNODEDONE = 'ADDNODEDONE'
+    CUSTOMPARAMS = 'CUSTOMPARAMS'
+    CUSTOMDATA = 'CUSTOMDATA'
+    CUSTOMTYPEDPARAMS = 'CUSTOMTYPEDPARAMS'
+    CUSTOMTYPEDDATA = 'CUSTOMTYPEDDATA'
+    CUSTOMNS = 'CUSTOMNS'
+    NOTICES = 'NOTICES'
+
+    def __init__(self, classes=None, envVar=None):
+        self.classes = classes or []
+        self.lock = threading.RLock()
+        self.nodes_by_address = {}
+        self.subscribers = {}
+        self.events = []
+        self.publishes = 0
+        self.publish_counts = {}
+        self.started = None
+        self.profile_updates = 0
+        self.stopped = threading.Event()
+        self.Notices = Custom(self, 'notices')
+
+    # Keep a record of what the node server did, for the tools to look at
+    def record(self, kind, address, detail=None):
+        with self.lock:
+            self.events.append((time.monotonic(), kind, address, detail))
+
+    def send(self, message, type):
+        with self.lock:
+            self.publishes += 1
+            self.publish_counts[type] = self.publish_counts.get(type, 0) + 1
+
+    def summary(self):
+        with self.lock:
+            kinds = {}
+            for e in self.events:
+                kinds[e[1]] = kinds.get(e[1], 0) + 1
+            return {'publishes': self.publishes, 'publish_counts': dict(self.publish_counts),
+                    'events': kinds, 'nodes': len(self.nodes_by_address)}
+
+    def reset(self):
+        with self.lock:
+            self.events = []
+            self.publishes = 0
+            self.publish_counts = {}
+
+    def subscribe(self, topic, callback, address=None):
+        with self.lock:
+            self.subscribers.setdefault(topic, []).append((callback, address))
+
+    # Deliver an event to the subscribers, the way Polyglot messages are.
+    # Subscriptions for a specific address only see that address.
+    def trigger(self, topic, *args, address=None):
+        with self.lock:
+            subs = list(self.subscribers.get(topic, []))
+        for (callback, addr) in subs:
+            if addr is None or address is None or addr == address:
+                callback(*args)
+
+    def start(self, version=None):
+        self.started = time.monotonic()
+        self.record('start', None, version)
+
+    def ready(self):
+        self.record('ready', None)
+
+    def runForever(self):
+        self.stopped.wait()
+
+    # The node server disconnecting, trigger(STOP) is Polyglot stopping it
+    def stop(self):
+        self.stopped.set()
+
+    def addNode(self, node, conn_status=None, rename=False):
+        with self.lock:
+            self.nodes_by_address[node.address] = node
+        node.added = True
+        self.record('addnode', node.address, {'name': node.name, 'rename': rename})
+        self.send({'addnode': [{'address': node.address, 'name': node.name}]}, 'system')
+        self.trigger(self.ADDNODEDONE, {'address': node.address})
+        return node
+
+    def getNode(self, address):
+        with self.lock:
+            return self.nodes_by_address.get(address)
+
+    def getNodes(self):
+        with self.lock:
+            return dict(self.nodes_by_address)
+
+    def nodes(self):
+        with self.lock:
+            nodes = list(self.nodes_by_address.values())
+        for n in nodes:
+            yield n
+
+    def delNode(self, address):
+        with self.lock:
+            node = self.nodes_by_address.pop(address, None)
+        self.record('delnode', address)
+        self.send({'removenode': [{'address': address}]}, 'system')
+        return node
+
+    def updateProfile(self):
+        self.profile_updates += 1
+        self.record('profile', None)
+        self.send({'installprofile': {'reboot': False}}, 'system')
+
+    def installprofile(self):
+        self.updateProfile()
+        return True
+
+    def setCustomParamsDoc(self, doc=None):
+        self.record('paramsdoc', None)
+
+    def addNotice(self, text, key=None):
+        self.Notices[key or 'notice'] = text
+
+    def removeNoticesAll(self):
+        self.Notices.clear()
+
+    # Send an ISY command to a node, the way Polyglot would
+    def command(self, address, cmd, value=None, uom=None):
+        node = self.getNode(address)
+        if node is None:
+            raise KeyError(address)
+        command = {'address': address, 'cmd': cmd, 'query': {}}
+        if value is not None:
+            command['value'] = str(value)
+        if uom is not None:
+            command['uom'] = str(uom)
+        node.runCmd(command)
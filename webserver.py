@@ -0,0 +1,167 @@
+#
+# Small embedded HTTP server.
+#
+#  Off unless a port is configured, and only reachable from this machine
+#  unless it's told to listen on another address.  Serves read-only
+#  pages (metrics, state) straight from memory, nothing here ever talks
+#  to the controller.  Each request runs on its own short lived thread.
+
+from udi_interface import LOGGER
+import collections
+import http.server
+import threading
+
+# What a route that asks for the request gets
+Request = collections.namedtuple('Request', 'path query headers client')
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    server_version = 'RussoundNS'
+
+    def do_GET(self):
+        self.respond(True)
+
+    def do_HEAD(self):
+        self.respond(False)
+
+    def respond(self, send_body):
+        (path, _, query) = self.path.partition('?')
+        (route, args) = self.server.find(path)
+        if route is None:
+            self.send_error(404)
+            return
+
+        (route, wants_request) = route
+        if wants_request:
+            args += (Request(path, query, self.headers, self.address_string()),)
+        try:
+            result = route(*args)
+        except Exception as e:
+            LOGGER.error('HTTP {} failed: {}'.format(path, e))
+            self.send_error(500)
+            return
+        if result is None:
+            self.send_error(404)
+            return
+
+        (content_type, body) = result[:2]
+        if not isinstance(body, (str, bytes)):
+            self.stream(content_type, body, send_body)
+            return
+        etag = result[2] if len(result) > 2 else None
+        if etag is not None and etag_matches(self.headers.get('If-None-Match'), etag):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+
+        if isinstance(body, str):
+            body = body.encode()
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        if etag is not None:
+            # clients may keep it, but have to check it's still current
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+    '''
+    Send what chunks (an iterator of str) yields as it comes, until it
+    ends, the client goes away or the server is stopped.
+    '''
+    def stream(self, content_type, chunks, send_body):
+        self.close_connection = True
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        try:
+            if not send_body:
+                return
+            self.wfile.flush()
+            for chunk in chunks:
+                if self.server.stopping.is_set():
+                    break
+                self.wfile.write(chunk.encode())
+                self.wfile.flush()
+        except OSError as e:
+            LOGGER.debug('HTTP {} stream ended: {}'.format(self.address_string(), e))
+        finally:
+            chunks.close()
+
+    # Keep requests out of stderr
+    def log_message(self, format, *args):
+        LOGGER.debug('HTTP {} - {}'.format(self.address_string(), format % args))
+
+
+# True if an If-None-Match header lists etag (or is *)
+def etag_matches(header, etag):
+    if not header:
+        return False
+    for tag in header.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == etag or tag == '*':
+            return True
+    return False
+
+
+class _Server(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stopping = threading.Event()  # tells streams to end
+
+    # (function, args) for path, the longest matching prefix wins
+    def find(self, path):
+        if path in self.routes:
+            return (self.routes[path], ())
+        prefixes = [p for p in self.routes if p.endswith('/') and path.startswith(p)]
+        if not prefixes:
+            return (None, ())
+        prefix = max(prefixes, key=len)
+        return (self.routes[prefix], (path[len(prefix):],))
+
+
+'''
+routes maps a path to a function that returns (content type, body) or
+(content type, body, etag), None for a 404.  A path ending in / also
+serves everything under it, its function gets the rest of the path.
+With request set it also gets a Request.  Requests with an If-None-Match
+that has the ETag get a 304.  A body that's a generator of str instead
+of a str is streamed (i.e. Server-Sent Events) until it ends.
+start() raises OSError if the port can't be opened.
+'''
+class WebServer:
+    def __init__(self, port, host='127.0.0.1'):
+        self.port = int(port)
+        self.host = host
+        self.routes = {}
+        self.httpd = None
+        self.thread = None
+
+    def route(self, path, handler, request=False):
+        self.routes[path] = (handler, request)
+
+    def start(self):
+        self.httpd = _Server((self.host, self.port), _Handler)
+        self.httpd.routes = self.routes
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name='http-{}'.format(self.port))
+        self.thread.daemon = True
+        self.thread.start()
+        LOGGER.info('HTTP server listening on {}:{}'.format(self.host or '*', self.port))
+
+    def stop(self):
+        if self.httpd is not None:
+            self.httpd.stopping.set()
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.httpd = None
+            self.thread = None
+            LOGGER.info('HTTP server on port {} stopped'.format(self.port))
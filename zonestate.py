@@ -0,0 +1,120 @@
+#
+# Last known zone state.
+#
+#  The zone node values are saved to a file as they change, at most
+#  every INTERVAL seconds.  When the node server starts, the zones are
+#  created from that file right away so the ISY has sensible values
+#  while the controller is still being connected and queried.  Those
+#  values are marked as restored (provisional) until the controller
+#  reports the zone.
+
+from udi_interface import LOGGER
+import json
+import os
+import tempfile
+import threading
+import clock
+
+VERSION = 1
+
+
+class StateStore:
+    INTERVAL = 30  # seconds, the most often the file is written
+
+    def __init__(self, path, interval=None):
+        self.path = path
+        self.interval = self.INTERVAL if interval is None else interval
+        self.clock = clock.default()
+        self.lock = threading.Lock()
+        self.zones = {}  # address -> {'name': name, 'drivers': {driver: value}}
+        self.timer = None
+        self.dirty = False
+
+    '''
+    Read the file.  Returns address -> {'name': ..., 'drivers': {...}}
+    for each zone, empty if there's no usable file.
+    '''
+    def load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            LOGGER.warning('Unable to read zone state {}: {}'.format(self.path, e))
+            return {}
+
+        if data.get('version') != VERSION:
+            return {}
+        zones = data.get('zones') or {}
+        with self.lock:
+            for (address, z) in zones.items():
+                self.zones.setdefault(address, {'name': z.get('name'), 'drivers': dict(z.get('drivers') or {})})
+        return zones
+
+    # Saved values for a zone, None if there are none
+    def drivers(self, address):
+        with self.lock:
+            z = self.zones.get(address)
+            return dict(z['drivers']) if z is not None else None
+
+    # A zone value changed, the file is written a little later
+    def update(self, address, name, driver, value):
+        with self.lock:
+            z = self.zones.setdefault(address, {'name': name, 'drivers': {}})
+            z['name'] = name
+            if z['drivers'].get(driver) == value:
+                return
+            z['drivers'][driver] = value
+            self.dirty = True
+            if self.timer is None:
+                self.timer = self.clock.call_later(self.interval, self.flush)
+
+    def forget(self, address):
+        with self.lock:
+            if self.zones.pop(address, None) is not None:
+                self.dirty = True
+                if self.timer is None:
+                    self.timer = self.clock.call_later(self.interval, self.flush)
+
+    # Write the file now if anything changed since the last write
+    def flush(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            if not self.dirty:
+                return
+            data = json.dumps({'version': VERSION, 'time': self.clock.time(), 'zones': self.zones},
+                              indent=1, sort_keys=True)
+            self.dirty = False
+
+        try:
+            directory = os.path.dirname(self.path) or '.'
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+            (fd, tmp) = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(self.path))
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    f.write(data)
+                os.replace(tmp, self.path)
+            except:
+                os.unlink(tmp)
+                raise
+        except OSError as e:
+            LOGGER.error('Unable to save zone state {}: {}'.format(self.path, e))
+
+    # The controller is gone, so is its state
+    def remove(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            self.zones = {}
+            self.dirty = False
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            LOGGER.error('Unable to remove zone state {}: {}'.format(self.path, e))